@@ -20,6 +20,7 @@
 
 from collections import defaultdict
 from collections import Counter
+from collections import namedtuple
 from subprocess import call, Popen, PIPE
 import subprocess
 import os, os.path
@@ -28,7 +29,10 @@ import sys
 import json
 import re
 import itertools
-#import numpy as np
+try: # optional; speeds up quality scoring of large groups of reads
+    import numpy as np
+except ImportError:
+    np = None
 import time
 import pdb
 import heapq
@@ -37,6 +41,21 @@ import multiprocessing as mp
 from logging import debug, critical, error, info
 import string
 import gzip
+import mmap
+import struct
+from contextlib import contextmanager, closing
+import math
+import zlib
+import Queue
+import threading
+import shutil
+import hashlib
+import tempfile
+import traceback
+import fcntl
+from array import array
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
 
 # To do
 # 1. Check that SAM files contain a map for all the sequences so that FASTQ filtering doesn't leave some bad quality data behind
@@ -59,7 +78,1087 @@ def checkFile(filename):
     except IOError:
         return False
 
-def parallel_DBR_dict(in_dir, seqType, dbr_start, dbr_stop, threads, test_dict = False, save = None):
+################################ DECOMPRESSION ################################
+
+# All gzipped inputs, in Python and in shell pipelines, are decompressed through this layer:
+#   - BGZF files (bgzip, samtools) are split into their independent blocks and inflated on a thread pool
+#   - other gzip files go to a multi-threaded decompressor when one is on PATH
+#   - otherwise gzip runs on a reader thread that fills a bounded queue while the caller parses
+# Plain multi-member gzip files have no block index, so they can only be read member by member.
+DECOMPRESS_THREADS = 4
+DECOMPRESSORS = [('pigz', 'pigz -dc -p %(threads)d'),
+                 ('bgzip', 'bgzip -dc -@ %(threads)d')] # in order of preference
+DECOMPRESS_BLOCK_SIZE = 1024*1024 # bytes per read of a decompressor pipe or gzip reader thread
+BGZF_MAGIC = '\x1f\x8b\x08\x04' # gzip member with the FEXTRA flag set
+BGZF_BATCH = 64 # blocks (up to 64 kB each) inflated per round of the thread pool
+
+_decompressor = []
+def find_decompressor():
+    '''
+    return the shell command template of the first parallel decompressor on PATH, or None
+    '''
+    if not _decompressor:
+        _decompressor.append(None)
+        for exe, template in DECOMPRESSORS:
+            if find_executable(exe):
+                _decompressor[0] = template
+                break
+    return _decompressor[0]
+
+def is_BGZF(in_file):
+    with open(in_file, 'rb') as f:
+        header = f.read(18)
+    # BGZF blocks carry a 'BC' extra subfield holding the compressed block size
+    return len(header) == 18 and header[:4] == BGZF_MAGIC and header[12:14] == 'BC'
+
+def decompress_command(in_files, threads = DECOMPRESS_THREADS):
+    '''
+    shell command that writes the decompressed contents of in_files (space separated) to stdout
+    '''
+    if ' ' not in in_files and os.path.isfile(in_files) and is_BGZF(in_files) and find_executable('bgzip'):
+        return 'bgzip -dc -@ %d %s' % (threads, in_files) # block-parallel
+    template = find_decompressor()
+    if template:
+        return (template % {'threads': threads}) + ' ' + in_files
+    return 'zcat ' + in_files
+
+def read_BGZF_block(handle):
+    '''
+    read one BGZF block from handle; returns (raw deflate data, uncompressed size), or None at end of file
+    '''
+    header = handle.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        raise IOError('Not a BGZF block at offset %s of %s' % (handle.tell() - len(header), handle.name))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = handle.read(xlen)
+    bsize = None
+    pos = 0
+    while pos + 4 <= xlen:
+        slen = struct.unpack('<H', extra[pos+2:pos+4])[0]
+        if extra[pos:pos+2] == 'BC':
+            bsize = struct.unpack('<H', extra[pos+4:pos+6])[0]
+        pos += 4 + slen
+    if bsize is None:
+        raise IOError('BGZF block without a block size in %s' % handle.name)
+    body = handle.read(bsize + 1 - 12 - xlen)
+    return body[:-8], struct.unpack('<I', body[-4:])[0]
+
+def inflate_BGZF_block(block):
+    data = zlib.decompress(block[0], -15) # zlib releases the GIL, so blocks inflate in parallel on threads
+    if len(data) != block[1]:
+        raise IOError('BGZF block decompressed to %s bytes, expected %s' % (len(data), block[1]))
+    return data
+
+class BlockReader(object):
+    '''
+    file-like read() over a source of decompressed blocks; subclasses provide _next_block()
+    '''
+    def __init__(self):
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size = -1):
+        parts = [self._buffer]
+        n = len(self._buffer)
+        while (size < 0 or n < size) and not self._eof:
+            block = self._next_block()
+            if block is None:
+                self._eof = True
+            else:
+                parts.append(block)
+                n += len(block)
+        data = ''.join(parts)
+        if size < 0 or len(data) <= size:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def unread(self, data):
+        # push data back so the next read() returns it first
+        self._buffer = data + self._buffer
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class BGZFReader(BlockReader):
+    '''
+    read a BGZF file, inflating batches of blocks on a thread pool one batch ahead of the caller
+    '''
+    def __init__(self, in_file, threads = DECOMPRESS_THREADS):
+        BlockReader.__init__(self)
+        self.name = in_file
+        self._handle = open(in_file, 'rb')
+        self._pool = ThreadPool(threads)
+        self._pending = self._submit()
+
+    def _submit(self):
+        blocks = []
+        while len(blocks) < BGZF_BATCH:
+            block = read_BGZF_block(self._handle)
+            if block is None:
+                break
+            blocks.append(block)
+        if not blocks:
+            return None
+        return self._pool.map_async(inflate_BGZF_block, blocks)
+
+    def _next_block(self):
+        while self._pending is not None:
+            current = self._pending
+            self._pending = self._submit() # start on the next batch before waiting for this one
+            data = ''.join(current.get())
+            if data: # skip batches of empty blocks, such as the BGZF end-of-file marker
+                return data
+        return None
+
+    def close(self):
+        self._pool.terminate()
+        self._handle.close()
+
+class PipeReader(BlockReader):
+    '''
+    read the stdout of an external decompressor
+    '''
+    def __init__(self, command, in_file):
+        BlockReader.__init__(self)
+        self.name = in_file
+        self._process = Popen(command, shell = True, stdout = PIPE)
+
+    def _next_block(self):
+        data = self._process.stdout.read(DECOMPRESS_BLOCK_SIZE)
+        if data:
+            return data
+        if self._process.wait() != 0:
+            raise IOError('Decompression of %s failed: %s' % (self.name, self._process.returncode))
+        return None
+
+    def close(self):
+        if self._process.poll() is None: # stopped reading early
+            self._process.terminate()
+        self._process.stdout.close()
+        self._process.wait()
+
+class ThreadedReader(BlockReader):
+    '''
+    read a file object on a background thread into a bounded queue of blocks
+    '''
+    def __init__(self, handle, depth = 8):
+        BlockReader.__init__(self)
+        self.name = getattr(handle, 'name', None)
+        self._handle = handle
+        self._queue = Queue.Queue(depth)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._closed.is_set():
+                data = self._handle.read(DECOMPRESS_BLOCK_SIZE)
+                self._put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _next_block(self):
+        data = self._queue.get()
+        if isinstance(data, Exception):
+            raise data
+        return data or None
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self._handle.close()
+
+def open_compressed(in_file, threads = DECOMPRESS_THREADS):
+    '''
+    open a gzip or BGZF file for reading through the fastest available decompressor
+    '''
+    if is_BGZF(in_file):
+        return BGZFReader(in_file, threads)
+    template = find_decompressor()
+    if template:
+        return PipeReader((template % {'threads': threads}) + ' ' + in_file, in_file)
+    return ThreadedReader(gzip.open(in_file, 'rb'))
+
+################################ FASTQ READING ################################
+
+# Every Python-side FASTQ parser reads through fastq_batches: big reads from the file, one split per chunk,
+# and records handed out as lists of (header, sequence, plus, quality) tuples with the newlines removed.
+FASTQ_CHUNK_SIZE = 4*1024*1024 # bytes per read() call
+ID_REGEX = '(\d[:|_]\d+[:|_]\d+[:|_]\d+)' # Illumina ID as found in FASTQ headers and SAM QNAMEs
+_ID_LINES = re.compile('^.*?' + ID_REGEX, re.M) # first ID on each line of a newline-joined batch of names
+
+def open_fastq(in_file, threads = DECOMPRESS_THREADS):
+    if in_file.endswith('gz'):
+        return open_compressed(in_file, threads)
+    return open(in_file, 'rb')
+
+def fastq_batches(handle, chunk_size=FASTQ_CHUNK_SIZE):
+    '''
+    yield lists of (header, sequence, plus, quality) records from an open FASTQ file
+    '''
+    partial = '' # the unfinished last line of the previous chunk
+    leftover = [] # complete lines of the previous chunk that did not make a whole record
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        if leftover:
+            lines = leftover + lines
+        n = len(lines) - len(lines) % 4
+        leftover = lines[n:]
+        if n:
+            yield zip(lines[0:n:4], lines[1:n:4], lines[2:n:4], lines[3:n:4])
+    if partial:
+        leftover.append(partial)
+    while leftover and not leftover[-1]: # ignore blank lines at the end of the file
+        leftover.pop()
+    if leftover:
+        if len(leftover) % 4:
+            raise ValueError('Truncated FASTQ record at end of file: %s' % leftover[0])
+        yield zip(leftover[0::4], leftover[1::4], leftover[2::4], leftover[3::4])
+
+def iter_fastq(handle, chunk_size=FASTQ_CHUNK_SIZE):
+    # one record at a time, for callers that need to step through files in lockstep
+    return itertools.chain.from_iterable(fastq_batches(handle, chunk_size))
+
+def trim_batch(batch, first_base = 1, last_base = None):
+    '''
+    the records of a batch with their sequences and qualities cut down to bases first_base to last_base (counted
+    from 1, as fastx_trimmer -f and -l); reads with no bases left are dropped
+    '''
+    start = first_base - 1
+    return [(header, SEQ[start:last_base], plus, QUAL[start:last_base]) for header, SEQ, plus, QUAL in batch if len(SEQ) > start]
+
+def trim_batches(batches, first_base = 1, last_base = None):
+    # trim each batch from fastq_batches (or fastq_range_batches) on its way to the next stage
+    for batch in batches:
+        yield trim_batch(batch, first_base, last_base)
+
+def illumina_IDs(names):
+    '''
+    extract the Illumina ID from each of a batch of FASTQ headers or SAM QNAMEs
+    '''
+    # one regex pass over the whole batch instead of one re.split per name;
+    # the IDs are exactly what re.split(ID_REGEX, name)[1] returns for each name
+    IDs = _ID_LINES.findall('\n'.join(names))
+    if len(IDs) != len(names):
+        for name in names:
+            if not re.search(ID_REGEX, name):
+                raise ValueError('No Illumina ID found in %s' % name)
+    return IDs
+
+# A FastqRange is a piece of one FASTQ file that a worker can parse on its own. It owns every record whose
+# header line starts within its first `owned` bytes of data, however far the last record runs past `end`.
+#   start, end: byte offsets in the file (compressed offsets for BGZF, always at block boundaries)
+#   prev:       offset of the byte (plain) or BGZF block holding the data just before start, None at the start of the file
+#   owned:      uncompressed bytes from start to end
+FastqRange = namedtuple('FastqRange', 'start end prev owned')
+
+def _BGZF_index(in_file):
+    '''
+    list of (compressed offset, uncompressed offset) for every BGZF block in in_file
+    '''
+    index = []
+    if os.path.isfile(in_file + '.gzi'): # written by bgzip -i; lists every block after the first
+        with open(in_file + '.gzi', 'rb') as f:
+            n = struct.unpack('<Q', f.read(8))[0]
+            offsets = struct.unpack('<%dQ' % (2*n), f.read(16*n))
+        index = [(0, 0)] + zip(offsets[0::2], offsets[1::2])
+        index.append((os.path.getsize(in_file), None))
+    else: # walk the block headers; the uncompressed size is in the last 4 bytes of each block
+        size = os.path.getsize(in_file)
+        offset = 0
+        uoffset = 0
+        with open(in_file, 'rb') as f:
+            while offset < size:
+                f.seek(offset)
+                header = f.read(18)
+                if header[:4] != BGZF_MAGIC or header[12:14] != 'BC':
+                    raise IOError('Not a BGZF block at offset %s of %s' % (offset, in_file))
+                bsize = struct.unpack('<H', header[16:18])[0]
+                f.seek(offset + bsize + 1 - 4)
+                index.append((offset, uoffset))
+                uoffset += struct.unpack('<I', f.read(4))[0]
+                offset += bsize + 1
+        index.append((size, uoffset))
+    return index
+
+def split_fastq(in_file, chunk_bytes):
+    '''
+    split a plain or BGZF FASTQ file into FastqRanges of roughly chunk_bytes each (in file bytes)
+    '''
+    size = os.path.getsize(in_file)
+    if not in_file.endswith('gz'):
+        starts = range(0, size, chunk_bytes) or [0]
+        ends = starts[1:] + [size]
+        return [FastqRange(s, e, s - 1 if s else None, e - s) for s, e in zip(starts, ends)]
+    if not is_BGZF(in_file): # ordinary gzip can't be entered part way through
+        return [FastqRange(0, size, None, None)]
+    index = _BGZF_index(in_file)
+    if index[-1][1] is None: # .gzi indexes don't give the total uncompressed size
+        index[-1] = (size, index[-2][1] + len(inflate_BGZF_block(_read_block_at(in_file, index[-2][0]))))
+    ranges = []
+    first = 0
+    for i in range(1, len(index)):
+        if index[i][0] - index[first][0] >= chunk_bytes or i == len(index) - 1:
+            prev = index[first - 1][0] if first else None
+            ranges.append(FastqRange(index[first][0], index[i][0], prev, index[i][1] - index[first][1]))
+            first = i
+    return ranges
+
+def _read_block_at(in_file, offset):
+    with open(in_file, 'rb') as f:
+        f.seek(offset)
+        return read_BGZF_block(f)
+
+class _RangeReader(BlockReader):
+    # the data of a FastqRange from its start to the end of the file, read one block at a time
+    def __init__(self, in_file, fastq_range):
+        BlockReader.__init__(self)
+        self.name = in_file
+        self._bgzf = in_file.endswith('gz')
+        self._handle = open(in_file, 'rb')
+        if fastq_range.prev is None:
+            self.prev = '\n' # start of the file is always a line start
+        elif self._bgzf:
+            self._handle.seek(fastq_range.prev)
+            self.prev = inflate_BGZF_block(read_BGZF_block(self._handle))[-1:]
+        else:
+            self._handle.seek(fastq_range.prev)
+            self.prev = self._handle.read(1)
+        self._handle.seek(fastq_range.start)
+
+    def _next_block(self):
+        if self._bgzf:
+            block = read_BGZF_block(self._handle)
+            return inflate_BGZF_block(block) if block else None
+        return self._handle.read(DECOMPRESS_BLOCK_SIZE) or None
+
+    def close(self):
+        self._handle.close()
+
+def fastq_range_batches(in_file, fastq_range, chunk_size = FASTQ_CHUNK_SIZE):
+    '''
+    yield batches of the records owned by fastq_range, as fastq_batches does for a whole file
+    '''
+    if fastq_range.owned is None: # unsplittable file: the range is the whole file
+        with open_fastq(in_file) as handle:
+            for batch in fastq_batches(handle, chunk_size):
+                yield batch
+        return
+    with _RangeReader(in_file, fastq_range) as handle:
+        # find the first record start: a line beginning with '@' whose third line begins with '+'
+        # (a quality line can begin with '@' too, but then its third line is a sequence)
+        data = ''
+        pos = 0 if handle.prev == '\n' else None
+        while True:
+            if pos is None or data.count('\n', pos) < 3:
+                more = handle.read(chunk_size)
+                if more:
+                    data += more
+                    if pos is None and '\n' in data:
+                        pos = data.index('\n') + 1
+                    continue
+                if pos is None or data.count('\n', pos) < 2: # no whole record left
+                    return
+            if pos >= fastq_range.owned:
+                return
+            line1 = data.index('\n', pos) + 1
+            line2 = data.index('\n', line1) + 1
+            if data.startswith('@', pos) and data.startswith('+', line2):
+                break
+            pos = line1
+        # now read records in batches and stop at the first header that starts past the range
+        start = pos
+        handle.unread(data[pos:])
+        for batch in fastq_batches(handle, chunk_size):
+            n_bytes = sum(len(h) + len(s) + len(p) + len(q) + 4 for h, s, p, q in batch)
+            if start + n_bytes <= fastq_range.owned:
+                yield batch
+                start += n_bytes
+                continue
+            owned = []
+            for record in batch:
+                if start >= fastq_range.owned:
+                    break
+                owned.append(record)
+                start += sum(len(line) for line in record) + 4
+            if owned:
+                yield owned
+            return
+
+################################ FASTQ WRITING ################################
+
+# Filtered reads are joined into large buffers on their way to disk. Each buffer goes out in one write, as a
+# complete gzip member or run of BGZF blocks when compressed, so files written this way can be appended to or
+# joined end to end (as a sample's parts are, see CHECKPOINTS) and still be valid (multi-member) gzip. Compression runs on a background thread, with
+# BGZF blocks deflated over a thread pool (zlib releases the GIL), while the caller carries on filtering.
+OUT_COMPRESSION = (None, 'gzip', 'bgzf')
+OUT_BUFFER_SIZE = FASTQ_CHUNK_SIZE # bytes of records joined per write
+OUT_COMPRESS_LEVEL = 6
+BGZF_BLOCK_SIZE = 0xff00 # uncompressed bytes per BGZF block, as bgzip
+BGZF_EOF = BGZF_MAGIC + '\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00' # empty block
+
+def deflate_BGZF_block(data, level = OUT_COMPRESS_LEVEL):
+    '''
+    compress up to BGZF_BLOCK_SIZE bytes into one BGZF block
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = compressor.compress(data) + compressor.flush()
+    if len(body) > 65536 - 26: # incompressible; stored deflate blocks always fit
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        body = compressor.compress(data) + compressor.flush()
+    return (BGZF_MAGIC + '\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', len(body) + 25) + body +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+def deflate_gzip_member(data, level = OUT_COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits 16+15 writes the gzip header and trailer
+    return compressor.compress(data) + compressor.flush()
+
+class BlockWriter(object):
+    '''
+    buffered output to out_file; compress is None, 'gzip' or 'bgzf'. unless append is True, the output is written to
+    a temporary file that replaces out_file only when it is closed without an error
+    '''
+    def __init__(self, out_file, compress = None, threads = DECOMPRESS_THREADS, buffer_size = OUT_BUFFER_SIZE, level = OUT_COMPRESS_LEVEL, append = True):
+        if compress not in OUT_COMPRESSION:
+            raise ValueError("Output compression specified as %s. Options are None, 'gzip' or 'bgzf'." % compress)
+        self.name = out_file
+        self.compress = compress
+        self.level = level
+        self._buffer_size = buffer_size
+        self._parts = []
+        self._size = 0
+        self._tmp = None if append else '%s.tmp%d' % (out_file, os.getpid())
+        self._fd = os.open(self._tmp or out_file, os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC), 0666)
+        self._pool = ThreadPool(threads) if compress == 'bgzf' else None
+        self._errors = []
+        if compress:
+            self._queue = Queue.Queue(4) # buffers waiting to be compressed; bounded so filtering can't run far ahead
+            self._thread = threading.Thread(target=self._drain)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._errors:
+            raise self._errors[0]
+        if not self._parts:
+            return
+        data = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        if self.compress:
+            self._queue.put(data)
+        else:
+            self._write(data)
+
+    def _deflate(self, data):
+        if self.compress == 'gzip':
+            return deflate_gzip_member(data, self.level)
+        blocks = [data[i:i+BGZF_BLOCK_SIZE] for i in xrange(0, len(data), BGZF_BLOCK_SIZE)]
+        return ''.join(self._pool.map(lambda block: deflate_BGZF_block(block, self.level), blocks))
+
+    def _drain(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._errors: # keep emptying the queue so the writer never blocks
+                continue
+            try:
+                self._write(data if data is BGZF_EOF else self._deflate(data))
+            except Exception as e:
+                self._errors.append(e)
+
+    def _write(self, data):
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def close(self, discard = False):
+        # discard drops a temporary file instead of putting it in place (after an error while writing it)
+        if self._fd is None:
+            return
+        flushed = False
+        try:
+            self.flush()
+            flushed = True
+        finally:
+            if self.compress:
+                if self.compress == 'bgzf':
+                    self._queue.put(BGZF_EOF)
+                self._queue.put(None)
+                self._thread.join()
+            if self._pool:
+                self._pool.close()
+            os.close(self._fd)
+            self._fd = None
+            if self._tmp:
+                if flushed and not discard and not self._errors:
+                    os.rename(self._tmp, self.name)
+                else:
+                    os.remove(self._tmp)
+        if self._errors:
+            raise self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(discard = exc_type is not None)
+
+class FastqWriter(BlockWriter):
+    '''
+    BlockWriter for FASTQ records
+    '''
+    def write_read(self, QNAME, SEQ, QUAL, n = None):
+        # n, the read's ordinal in the input, is only needed by KeptAlignments
+        self._parts.extend(('@', QNAME, '\n', SEQ, '\n+\n', QUAL, '\n'))
+        self._size += len(QNAME) + len(SEQ) + len(QUAL) + 6
+        if self._size >= self._buffer_size:
+            self.flush()
+
+############################ BINARY DBR DICTIONARIES ##########################
+
+# A binary DBR dictionary (.dbr) holds the same {ID: DBR} map as the JSON dumps, but it can be
+# memory-mapped and searched in place instead of being parsed into a Python dict by every worker.
+# Layout (all integers big-endian):
+#   header: magic 'DBRD', format version, DBR length in bases, number of records
+#   keys:   one 8-byte integer per record (see encode_ID), sorted ascending so they can be binary searched
+#   values: one fixed-width packed DBR per record (see pack_DBR), in the same order as the keys
+DBR_MAGIC = 'DBRD'
+DBR_VERSION = 2
+DBR_READ_VERSIONS = (1, 2)
+DBR_EXTENSION = '.dbr'
+DBR_HEADER = struct.Struct('>4sBxHQ')
+DBR_KEY = struct.Struct('>Q')
+
+# 2 bits per base; an N sets the base's bit in a trailing mask. A DBR cut short by the end of its read (shorter than
+# the dictionary's DBR length) marks each missing base as N with code 1, so it unpacks to its true length. Version 1
+# files, written before that marker, are still read.
+BASE_CODE = {'A':0, 'C':1, 'G':2, 'T':3}
+CODE_BASE = 'ACGT'
+_packed_DBRs = {} # DBRs are short, so there are few distinct values -- cache the conversions both ways
+_unpacked_DBRs = {}
+
+def encode_ID(ID):
+    '''
+    pack an Illumina ID (e.g. 8:1101:15808:1492) into a sortable 64-bit integer
+    '''
+    # the ID is whatever the '(\d[:|_]\d+[:|_]\d+[:|_]\d+)' capture returned: one digit, then three numbers
+    fields = ID.replace('_', ':').replace('|', ':').split(':')
+    if len(fields) != 4 or len(fields[0]) != 1:
+        raise ValueError('Not an Illumina ID: %s' % ID)
+    first, second, third, fourth = [int(f) for f in fields]
+    if second >= 1<<20 or third >= 1<<20 or fourth >= 1<<20:
+        raise ValueError('Illumina ID field too large to encode: %s' % ID)
+    return (first<<60) | (second<<40) | (third<<20) | fourth
+
+def decode_ID(key):
+    # separators are not stored, so decoded IDs always use ':'
+    return '%d:%d:%d:%d' % (key>>60, (key>>40) & 0xFFFFF, (key>>20) & 0xFFFFF, key & 0xFFFFF)
+
+def DBR_width(dbr_len):
+    # bytes per packed DBR: 2 bits per base plus 1 bit per base for the N mask
+    return (dbr_len + 3)/4 + (dbr_len + 7)/8
+
+def pack_DBR(tag, dbr_len):
+    packed = _packed_DBRs.get((tag, dbr_len))
+    if packed is None:
+        if len(tag) > dbr_len:
+            raise ValueError('DBR %s is longer than the dictionary DBR length %d' % (tag, dbr_len))
+        bases = 0
+        nmask = 0
+        for i, base in enumerate(tag):
+            code = BASE_CODE.get(base)
+            if code is None:
+                if base != 'N':
+                    raise ValueError("DBR %s can't be stored in a binary DBR dictionary (only A, C, G, T and N can); save it as JSON" % tag)
+                nmask |= 1<<i
+                code = 0
+            bases |= code<<(2*i)
+        for i in xrange(len(tag), dbr_len): # past the end of a short DBR
+            nmask |= 1<<i
+            bases |= 1<<(2*i)
+        n_base_bytes = (dbr_len + 3)/4
+        n_mask_bytes = (dbr_len + 7)/8
+        packed = ''.join(chr((bases>>(8*b)) & 0xFF) for b in range(n_base_bytes)) + \
+                 ''.join(chr((nmask>>(8*b)) & 0xFF) for b in range(n_mask_bytes))
+        _packed_DBRs[(tag, dbr_len)] = packed
+    return packed
+
+def unpack_DBR(packed, dbr_len):
+    tag = _unpacked_DBRs.get((packed, dbr_len))
+    if tag is None:
+        n_base_bytes = (dbr_len + 3)/4
+        bases = 0
+        nmask = 0
+        for b, c in enumerate(packed[:n_base_bytes]):
+            bases |= ord(c)<<(8*b)
+        for b, c in enumerate(packed[n_base_bytes:]):
+            nmask |= ord(c)<<(8*b)
+        tag = []
+        for i in range(dbr_len):
+            code = bases>>(2*i) & 3
+            if nmask>>i & 1:
+                if code == 1: # the end of a short DBR
+                    break
+                tag.append('N')
+            else:
+                tag.append(CODE_BASE[code])
+        tag = ''.join(tag)
+        _unpacked_DBRs[(packed, dbr_len)] = tag
+    return tag
+
+def write_DBRdictionary(dbr, out_file):
+    '''
+    write an {ID: DBR} dictionary to out_file in the binary DBR dictionary format
+    '''
+    records = sorted((encode_ID(ID), tag) for ID, tag in dbr.iteritems())
+    dbr_len = max([len(tag) for key, tag in records] or [0])
+    # write to a temporary name first so an interrupted run never leaves a truncated dictionary behind
+    tmp_out = out_file + '.tmp'
+    try:
+        with open(tmp_out, 'wb') as fp:
+            fp.write(DBR_HEADER.pack(DBR_MAGIC, DBR_VERSION, dbr_len, len(records)))
+            for i in xrange(0, len(records), 65536):
+                chunk = records[i:i+65536]
+                fp.write(struct.pack('>%dQ' % len(chunk), *[key for key, tag in chunk]))
+            for i in xrange(0, len(records), 65536):
+                fp.write(''.join(pack_DBR(tag, dbr_len) for key, tag in records[i:i+65536]))
+    except:
+        if os.path.exists(tmp_out):
+            os.remove(tmp_out)
+        raise
+    os.rename(tmp_out, out_file)
+
+def is_DBRdictionary_binary(dict_in):
+    with open(dict_in, 'rb') as f:
+        return f.read(len(DBR_MAGIC)) == DBR_MAGIC
+
+class DBRDictionary(object):
+    '''
+    read-only {ID: DBR} lookups on a memory-mapped binary DBR dictionary
+    '''
+    def __init__(self, dict_in):
+        self.path = dict_in
+        with open(dict_in, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # pages are shared by every process mapping the file
+        magic, version, self.dbr_len, self._n = DBR_HEADER.unpack_from(self._mm, 0)
+        if magic != DBR_MAGIC:
+            raise IOError('Not a binary DBR dictionary: %s' % dict_in)
+        if version not in DBR_READ_VERSIONS:
+            raise IOError('Unsupported binary DBR dictionary version %s: %s' % (version, dict_in))
+        self._width = DBR_width(self.dbr_len)
+        self._keys_at = DBR_HEADER.size
+        self._values_at = self._keys_at + DBR_KEY.size*self._n
+
+    def __len__(self):
+        return self._n
+
+    def _key(self, i):
+        return DBR_KEY.unpack_from(self._mm, self._keys_at + DBR_KEY.size*i)[0]
+
+    def _value(self, i):
+        start = self._values_at + self._width*i
+        return unpack_DBR(self._mm[start:start+self._width], self.dbr_len)
+
+    def _find(self, key):
+        # binary search of the sorted keys; returns the record index or -1
+        lo = 0
+        hi = self._n
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n and self._key(lo) == key:
+            return lo
+        return -1
+
+    def get(self, ID, default=None):
+        try:
+            i = self._find(encode_ID(ID))
+        except ValueError: # not an Illumina ID, so it can't be in the dictionary
+            return default
+        if i < 0:
+            return default
+        return self._value(i)
+
+    def __getitem__(self, ID):
+        tag = self.get(ID)
+        if tag is None:
+            raise KeyError(ID)
+        return tag
+
+    def __contains__(self, ID):
+        return self.get(ID) is not None
+
+    def iteritems(self):
+        for key, tag in self.iterkeyed():
+            yield decode_ID(key), tag
+
+    def iterkeyed(self):
+        # (encoded ID, DBR) pairs in ID order, as sort_merge_SAM needs them
+        for i in xrange(self._n):
+            yield self._key(i), self._value(i)
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# A sharded DBR dictionary is a directory (<name>.shards) of small dictionaries, one per shard key, plus a
+# manifest. DBR_Filter scans the QNAMEs of a SAM file first and then opens only the shards that hold them,
+# keeping only the entries for those reads, so a worker never holds a whole library dictionary.
+SHARD_EXTENSION = '.shards'
+SHARD_MANIFEST = 'shards.json'
+
+def shard_key(ID, shard_by = 'tile', n_shards = 64):
+    '''
+    the shard of a sharded DBR dictionary that holds ID: 'tile' shards by the first two ID fields (lane and tile),
+    'hash' spreads IDs evenly over n_shards shards
+    '''
+    try:
+        key = encode_ID(ID)
+    except ValueError:
+        return 'other'
+    if shard_by == 'tile':
+        return '%d_%d' % (key>>60, (key>>40) & 0xFFFFF)
+    elif shard_by == 'hash':
+        return '%d' % (_mix64(key) % n_shards)
+    raise ValueError("Shard type specified as %s. Options are 'tile' or 'hash'." % shard_by)
+
+def write_sharded_DBRdictionary(dbr, out_dir, saveType = 'dbr', shard_by = 'tile', n_shards = 64):
+    '''
+    write an {ID: DBR} dictionary to out_dir as a sharded DBR dictionary
+    '''
+    shards = defaultdict(dict)
+    for ID, tag in dbr.iteritems():
+        shards[shard_key(ID, shard_by, n_shards)][ID] = tag
+    # build the whole directory under a temporary name, then swap it in
+    tmp_dir = out_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    manifest = {'shard_by': shard_by, 'n_shards': n_shards, 'saveType': saveType, 'shards': {}}
+    for key, shard in shards.iteritems():
+        if saveType == 'dbr':
+            shard_file = key + DBR_EXTENSION
+            write_DBRdictionary(shard, os.path.join(tmp_dir, shard_file))
+        else:
+            shard_file = key + '.json'
+            with open(os.path.join(tmp_dir, shard_file), 'w') as fp:
+                json.dump(shard, fp)
+        manifest['shards'][key] = shard_file
+    with open(os.path.join(tmp_dir, SHARD_MANIFEST), 'w') as fp:
+        json.dump(manifest, fp)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+def is_DBRdictionary_sharded(dict_in):
+    return os.path.isdir(dict_in) and os.path.isfile(os.path.join(dict_in, SHARD_MANIFEST))
+
+class ShardedDBRDictionary(object):
+    '''
+    read-only {ID: DBR} lookups across the memory-mapped shards of a sharded binary DBR dictionary.
+    shards given in paths ({shard key: path}) are only mapped when a lookup first needs them
+    '''
+    def __init__(self, tables, shard_by, n_shards, paths = None):
+        self._tables = tables
+        self._shard_by = shard_by
+        self._n_shards = n_shards
+        self._paths = dict(paths or {})
+
+    def _table(self, key):
+        table = self._tables.get(key)
+        if table is None and key in self._paths:
+            table = self._tables[key] = DBRDictionary(self._paths.pop(key))
+        return table
+
+    def _open_all(self):
+        for key in self._paths.keys():
+            self._table(key)
+
+    def get(self, ID, default = None):
+        table = self._table(shard_key(ID, self._shard_by, self._n_shards))
+        if table is None:
+            return default
+        return table.get(ID, default)
+
+    def __getitem__(self, ID):
+        tag = self.get(ID)
+        if tag is None:
+            raise KeyError(ID)
+        return tag
+
+    def __contains__(self, ID):
+        return self.get(ID) is not None
+
+    def __len__(self):
+        self._open_all()
+        return sum(len(table) for table in self._tables.itervalues())
+
+    def iteritems(self):
+        self._open_all()
+        return itertools.chain.from_iterable(table.iteritems() for table in self._tables.itervalues())
+
+    def tables(self):
+        self._open_all()
+        return self._tables.values()
+
+    def close(self):
+        for table in self._tables.itervalues():
+            table.close()
+
+def read_shard_manifest(dict_in):
+    with open(os.path.join(dict_in, SHARD_MANIFEST)) as f:
+        return json.load(f)
+
+def load_DBRdictionary(dict_in, IDs = None, lazy = False):
+    '''
+    load a DBR dictionary made by DBR_dict: binary dictionaries are memory-mapped, JSON dictionaries are loaded whole.
+    for sharded dictionaries, only the shards holding IDs (if given) are opened; with lazy, binary shards are only
+    mapped once a lookup needs them
+    '''
+    if is_DBRdictionary_sharded(dict_in):
+        manifest = read_shard_manifest(dict_in)
+        shard_by = manifest['shard_by']
+        n_shards = manifest['n_shards']
+        if lazy and manifest['saveType'] == 'dbr':
+            return ShardedDBRDictionary({}, shard_by, n_shards, dict((key, os.path.join(dict_in, shard_file)) for key, shard_file in manifest['shards'].iteritems()))
+        wanted = defaultdict(list) # {shard key: [IDs]}
+        if IDs is None:
+            for key in manifest['shards']:
+                wanted[key] = None
+        else:
+            for ID in IDs:
+                wanted[shard_key(ID, shard_by, n_shards)].append(ID)
+        keys = [key for key in wanted if key in manifest['shards']]
+        if manifest['saveType'] == 'dbr':
+            return ShardedDBRDictionary(dict((key, DBRDictionary(os.path.join(dict_in, manifest['shards'][key]))) for key in keys), shard_by, n_shards)
+        # load one JSON shard at a time and keep only the entries asked for
+        dbr = {}
+        for key in keys:
+            with open(os.path.join(dict_in, manifest['shards'][key]), 'r') as f:
+                shard = json.load(f)
+            if wanted[key] is None:
+                dbr.update(shard)
+            else:
+                dbr.update((ID, shard[ID]) for ID in wanted[key] if ID in shard)
+            shard = None # free it before the next shard is parsed
+        return dbr
+    elif is_DBRdictionary_binary(dict_in):
+        return DBRDictionary(dict_in)
+    else:
+        with open(dict_in, 'r') as f:
+            return json.load(f)
+
+@contextmanager
+def open_DBRdictionary(dict_in, IDs = None):
+    '''
+    load_DBRdictionary as a context manager that closes memory-mapped dictionaries afterwards
+    '''
+    dbr = load_DBRdictionary(dict_in, IDs)
+    try:
+        yield dbr
+    finally:
+        if not isinstance(dbr, dict):
+            dbr.close()
+
+def save_DBRdictionary(dbr, save, in_file, saveType = 'json', suffix = '', shard_by = None, n_shards = 64):
+    # DBR dictionaries inherit the name of the file used to create them
+    if not os.path.exists(save):
+        os.makedirs(save)
+    fq_name = os.path.splitext(in_file)[0] + suffix
+    if shard_by and saveType in ('dbr', 'json'):
+        fq_dbr_out = os.path.join(save, fq_name + SHARD_EXTENSION)
+        print 'Writing sharded dictionary to ' + fq_dbr_out
+        write_sharded_DBRdictionary(dbr, fq_dbr_out, saveType, shard_by, n_shards)
+    elif saveType == 'dbr':
+        fq_dbr_out = os.path.join(save, fq_name + DBR_EXTENSION)
+        print 'Writing dictionary to ' + fq_dbr_out
+        write_DBRdictionary(dbr, fq_dbr_out)
+    elif saveType == 'json':
+        fq_dbr_out = os.path.join(save, fq_name + '.json')
+        print 'Writing dictionary to ' + fq_dbr_out
+        with open(fq_dbr_out, 'w') as fp:
+            json.dump(dbr, fp)
+    elif saveType == 'text': # {DBR: count} tables only
+        fq_dbr_out = os.path.join(save, fq_name + '.txt')
+        print 'Writing dictionary to ' + fq_dbr_out
+        with open(fq_dbr_out, 'w') as fp:
+            for key, value in dbr.iteritems():
+                fp.write(key + ',' + str(value) + '\n')
+    else:
+        raise ValueError("Dictionary save type specified as %s. Options are 'dbr', 'json' or 'text'." % saveType)
+    return fq_dbr_out
+
+############################## DICTIONARY CACHE ###############################
+
+# parallel_DBR_dict(cache = True) records, in the save directory, the fingerprint of every input file and the
+# parameters it was built with. On the next run a file whose fingerprint, parameters and saved dictionaries all
+# still match is skipped, so adding one library to a project only builds that library.
+BUILD_CACHE = 'DBR_dict_cache.json'
+
+def file_fingerprint(in_file, hash_inputs = False):
+    '''
+    size and modification time of in_file, plus an md5 of its contents if hash_inputs
+    '''
+    stat = os.stat(in_file)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if hash_inputs:
+        md5 = hashlib.md5()
+        with open(in_file, 'rb') as f:
+            for block in iter(lambda: f.read(FASTQ_CHUNK_SIZE), ''):
+                md5.update(block)
+        fingerprint['md5'] = md5.hexdigest()
+    return fingerprint
+
+def file_unchanged(in_file, fingerprint):
+    '''
+    true if in_file still has the size, and the mtime or (when one was recorded) md5, of fingerprint
+    '''
+    if not os.path.exists(in_file): # (a sharded dictionary is a directory)
+        return False
+    current = file_fingerprint(in_file)
+    if current['size'] != fingerprint['size']:
+        return False
+    if current['mtime'] == fingerprint['mtime']:
+        return True
+    # touched or copied: the contents decide
+    return 'md5' in fingerprint and file_fingerprint(in_file, True)['md5'] == fingerprint['md5']
+
+def write_json(obj, out_file):
+    # write to a temporary file and rename it over out_file, so a crash never leaves half a file behind
+    tmp = '%s.tmp%d' % (out_file, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(obj, fp, indent = 1, sort_keys = True)
+    os.rename(tmp, out_file)
+
+def load_build_cache(save):
+    cache_file = os.path.join(save, BUILD_CACHE)
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except ValueError: # a damaged cache just means everything is rebuilt
+        warnings.warn('Ignoring unreadable DBR dictionary cache %s' % cache_file)
+        return {}
+
+def write_build_cache(cache, save):
+    write_json(cache, os.path.join(save, BUILD_CACHE))
+
+def cached_build(cache, input, fingerprint, params):
+    '''
+    the dictionaries saved by an earlier build of input with the same fingerprint and parameters, or None
+    '''
+    entry = cache.get(input)
+    if not entry or entry['params'] != params:
+        return None
+    # with an md5 on both sides the contents decide (a touched file is still cached); otherwise size and mtime do
+    old = entry['fingerprint']
+    if 'md5' in old and 'md5' in fingerprint:
+        keys = ('size', 'md5')
+    else:
+        keys = ('size', 'mtime')
+    if any(old[key] != fingerprint[key] for key in keys):
+        return None
+    if not all(os.path.exists(saved) for saved in entry['saved']):
+        return None
+    return entry['saved']
+
+################################ JOB SCHEDULING ###############################
+
+# parallel_DBR_dict and parallel_DBR_Filter hand their jobs to the pool largest first (longest processing time
+# first), so a big file never starts last and holds up the end of the run, and take the results back as each job
+# finishes. A failed job doesn't stop the others; its traceback is printed, and once the rest are done the run
+# raises an error naming every job that failed, rather than leaving a silent partial run.
+def _timed_job(job):
+    name, function, args = job
+    start = time.time()
+    try:
+        result = function(*args)
+    except Exception:
+        return name, time.time() - start, None, traceback.format_exc() # tracebacks don't pickle, so send the text
+    return name, time.time() - start, result, None
+
+def schedule_jobs(pool, jobs):
+    '''
+    run jobs, a list of (size, name, function, args), on pool largest first and close the pool; yields (name, result)
+    as each job finishes, then raises a RuntimeError if any of them failed
+    '''
+    jobs = sorted(jobs, key=lambda job: job[0], reverse=True) # stable, so equal sizes keep their order
+    results = pool.imap_unordered(_timed_job, [job[1:] for job in jobs])
+    pool.close()
+    failed = []
+    for name, seconds, result, error in results:
+        if error:
+            print 'Failed %s after %.1f s:\n%s' % (name, seconds, error)
+            failed.append((name, error))
+            continue
+        print 'Finished %s in %.1f s' % (name, seconds)
+        yield name, result
+    if failed:
+        raise RuntimeError('%d of %d jobs failed: %s. The first failure was:\n%s' % (len(failed), len(jobs), ', '.join(str(name) for name, error in failed), failed[0][1]))
+
+######################### DBR DICTIONARY CONSTRUCTION #########################
+
+# the dictionaries that build_DBR_dicts can fill from one pass over a FASTQ file
+DBR_OUTPUTS = ('forward', # {ID: DBR}, as made by DBR_dict and used by DBR_Filter
+               'reverse', # {DBR: [IDs]}, as made by rev_DBR_dict
+               'counts') # {DBR: count}, as made by DBR_count
+
+def DBR_slice(dbr_start, dbr_stop):
+    '''
+    the slice of a sequence that holds the DBR. negative positions count from the end of the sequence line with its
+    newline, as the original line-by-line parser read it, so they move one base along for the stripped sequences
+    '''
+    if dbr_start is not None and dbr_start < 0:
+        if dbr_start == -1:
+            raise ValueError('A DBR starting at position -1 would start at the newline.')
+        dbr_start += 1
+    if dbr_stop is not None and dbr_stop < 0:
+        dbr_stop = dbr_stop + 1 or None # -1 stopped at the newline, i.e. the end of the sequence
+    return slice(dbr_start, dbr_stop)
+
+def parallel_DBR_dict(in_dir, seqType, dbr_start, dbr_stop, threads, test_dict = False, save = None, saveType = 'json', outputs = ('forward',), dup_check = 'exact', dup_fpr = 0.001, chunk_bytes = None, shard_by = None, n_shards = 64, cache = False, hash_inputs = False, engine = 'dict', tmp_dir = None):
     #if not checkDir(in_dir):
     #    raise IOError("Input is not a directory: %s" % in_dir)
     if seqType == 'read2':
@@ -68,55 +1167,347 @@ def parallel_DBR_dict(in_dir, seqType, dbr_start, dbr_stop, threads, test_dict =
         warnings.warn('Expect directory containing only merged Read 1 and Read 2 files; any other files present in %s will be incorporated into DBR directory' % in_dir)
     else:
         raise IOError("Input sequence type specified as %s. Options are 'pear' or 'read2'." % seqType)
+    if engine == 'sortmerge':
+        # the external sort writes the binary {ID: DBR} dictionary directly, a record at a time
+        if tuple(outputs) != ('forward',) or saveType != 'dbr' or not save or shard_by:
+            raise ValueError("The 'sortmerge' engine only saves unsharded binary forward dictionaries (outputs = ('forward',), saveType = 'dbr').")
+    elif engine != 'dict':
+        raise ValueError("Dictionary engine specified as %s. Options are 'dict' or 'sortmerge'." % engine)
     file_list = os.listdir(in_dir)
     
+    # the cache only applies to saved dictionaries; anything that changes what gets saved is part of the key
+    if cache and save:
+        build_cache = load_build_cache(save)
+        params = {'dbr_start': dbr_start, 'dbr_stop': dbr_stop, 'outputs': sorted(outputs), 'saveType': saveType,
+                  'shard_by': shard_by, 'n_shards': n_shards if shard_by == 'hash' else None}
+    else:
+        build_cache = None
+    
     pool = mp.Pool(processes=threads)
+    jobs = [] # (size, name, function, args); the name of each piece of a split file is (file name, piece)
+    split_parts = {} # file name -> [pieces built so far, pieces still to come]
+    fingerprints = {} # input -> its fingerprint before the build, which is what the cache records
     for in_file in file_list:
-        if in_file.endswith('.fastq'):
+        if in_file.endswith('.fastq') or in_file.endswith('.fastq.gz'):
             if 'undetermined' not in in_file:
-                pool.apply_async(DBR_dict, args=(in_dir,
-                                                 in_file, 
-                                                 dbr_start,
-                                                 dbr_stop,
-                                                 test_dict,
-                                                 save)) 
+                if build_cache is not None:
+                    input = os.path.abspath(os.path.join(in_dir, in_file))
+                    fingerprint = file_fingerprint(input, hash_inputs)
+                    if cached_build(build_cache, input, fingerprint, params):
+                        print 'Using cached DBR dictionaries for ' + in_file
+                        build_cache[input]['fingerprint'] = fingerprint
+                        continue
+                    fingerprints[input] = fingerprint
+                size = os.path.getsize(os.path.join(in_dir, in_file))
+                if engine == 'sortmerge':
+                    jobs.append((size, in_file, sorted_DBR_dict, (in_dir, in_file, dbr_start, dbr_stop, save, tmp_dir)))
+                    continue
+                # with chunk_bytes, big plain or BGZF files are parsed in pieces by several workers and merged here
+                if chunk_bytes:
+                    ranges = split_fastq(os.path.join(in_dir, in_file), chunk_bytes)
+                else:
+                    ranges = []
+                if len(ranges) > 1:
+                    # duplicate IDs can be in different pieces, so they are checked when the pieces are merged
+                    split_parts[in_file] = [[None]*len(ranges), len(ranges)]
+                    for i, r in enumerate(ranges):
+                        jobs.append((r.end - r.start, (in_file, i), build_DBR_dicts, (os.path.join(in_dir, in_file),
+                                                                                      dbr_start,
+                                                                                      dbr_stop,
+                                                                                      outputs,
+                                                                                      None,
+                                                                                      dup_fpr,
+                                                                                      r)))
+                else:
+                    jobs.append((size, in_file, fused_DBR_dict, (in_dir,
+                                                                 in_file, 
+                                                                 dbr_start,
+                                                                 dbr_stop,
+                                                                 outputs,
+                                                                 test_dict,
+                                                                 save,
+                                                                 saveType,
+                                                                 dup_check,
+                                                                 dup_fpr,
+                                                                 shard_by,
+                                                                 n_shards)))
     
-    pool.close()
-    pool.join()
+    try:
+        for name, saved in schedule_jobs(pool, jobs):
+            if isinstance(name, tuple): # a piece of a split file; merge the file once all of its pieces are in
+                in_file, i = name
+                parts = split_parts[in_file]
+                parts[0][i] = saved
+                parts[1] -= 1
+                if parts[1]:
+                    continue
+                built = merge_DBR_dicts(parts[0], dup_check, dup_fpr)
+                del split_parts[in_file]
+                saved = report_DBR_dicts(built, in_file, test_dict, save, saveType, shard_by, n_shards)
+                built = None
+            else:
+                in_file = name
+            if build_cache is not None:
+                if not isinstance(saved, list): # sorted_DBR_dict saves a single dictionary
+                    saved = [saved]
+                # record the fingerprint taken before the build; a file that changed while it was read is left out
+                # of the cache, so it is rebuilt next time (size and mtime tell, so the file isn't hashed again)
+                input = os.path.abspath(os.path.join(in_dir, in_file))
+                before = fingerprints[input]
+                after = file_fingerprint(input)
+                if after['size'] == before['size'] and after['mtime'] == before['mtime']:
+                    build_cache[input] = {'fingerprint': before, 'params': params, 'saved': saved}
+                else:
+                    print 'Not caching the DBR dictionaries of %s, which changed while it was read' % in_file
+                    build_cache.pop(input, None)
+    finally:
+        # even after a failure, the files that were built are cached
+        if build_cache is not None:
+            write_build_cache(build_cache, save)
+        pool.join()
      
     #for dP in dbrProcess:
     #    dP.start()
     #for dP in dbrProcess:
     #    dP.join()
 
-def DBR_dict(in_dir, in_file, dbr_start, dbr_stop, test_dict = False, save = None):
+############################ DUPLICATE ID DETECTION ###########################
+
+# Each Illumina ID should occur only once in a FASTQ file; a repeat means something is wrong with the data.
+# DuplicateIDs remembers the IDs seen so far without the linear list search that made rev_DBR_dict quadratic.
+
+def _mix64(x):
+    # splitmix64 finaliser: spreads an encoded Illumina ID over all 64 bits
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+class BloomFilter(object):
+    '''
+    fixed-size Bloom filter for capacity items at false positive rate fpr
+    '''
+    def __init__(self, capacity, fpr):
+        self.capacity = capacity
+        self.n = 0
+        self.n_bits = int(math.ceil(-capacity*math.log(fpr)/(math.log(2)**2)))
+        self.n_hashes = max(1, int(round(float(self.n_bits)/capacity*math.log(2))))
+        self.bits = bytearray((self.n_bits + 7)//8)
+
+    def _positions(self, h1, h2):
+        # double hashing: k bit positions from two 64-bit hashes
+        return [(h1 + i*h2) % self.n_bits for i in xrange(self.n_hashes)]
+
+    def __contains__(self, hashes):
+        bits = self.bits
+        for pos in self._positions(*hashes):
+            if not bits[pos>>3] & (1<<(pos & 7)):
+                return False
+        return True
+
+    def add(self, hashes):
+        bits = self.bits
+        for pos in self._positions(*hashes):
+            bits[pos>>3] |= 1<<(pos & 7)
+        self.n += 1
+
+class DuplicateIDs(object):
+    '''
+    remember Illumina IDs and report repeats.
+    mode 'exact' keeps a set of integer-encoded IDs, so seen() is always right;
+    mode 'bloom' keeps a scalable Bloom filter, so seen() can also be true (with probability ~fpr) for a new ID.
+    in 'bloom' mode the caller passes each hit to candidate() and, once every ID has been stored, confirm() finds
+    the candidates that really are repeated, so both modes report the same duplicates
+    '''
+    def __init__(self, mode = 'exact', fpr = 0.001, capacity = 1<<20):
+        if mode not in ('exact', 'bloom'):
+            raise ValueError("Duplicate ID check specified as %s. Options are 'exact', 'bloom' or None." % mode)
+        self.mode = mode
+        self.fpr = fpr
+        self._seen = set()
+        self._candidates = defaultdict(list) # {key: [line of each Bloom filter hit]}
+        # each new filter doubles the capacity and halves the error rate, so the total stays below fpr
+        self._filters = [BloomFilter(capacity, fpr/2.0)]
+
+    def _key(self, ID):
+        try:
+            # shift into the signed 64-bit range so the set holds plain ints rather than longs
+            return int(encode_ID(ID) - (1<<63))
+        except ValueError: # IDs that can't be encoded are kept as strings
+            return ID
+
+    def seen(self, ID):
+        '''
+        return True if ID (probably, for 'bloom') has been seen before, and remember it
+        '''
+        key = self._key(ID)
+        if self.mode == 'exact':
+            if key in self._seen:
+                return True
+            self._seen.add(key)
+            return False
+        h1 = _mix64(hash(key) & 0xFFFFFFFFFFFFFFFF)
+        hashes = (h1, _mix64(h1) | 1)
+        for f in self._filters:
+            if hashes in f:
+                return True
+        if self._filters[-1].n >= self._filters[-1].capacity:
+            last = self._filters[-1]
+            self._filters.append(BloomFilter(last.capacity*2, self.fpr/2.0**(len(self._filters) + 1)))
+        self._filters[-1].add(hashes)
+        return False
+
+    def candidate(self, ID, line = None):
+        self._candidates[self._key(ID)].append(line)
+
+    def confirm(self, revDBR):
+        '''
+        the first candidate that occurs more than once in revDBR ({DBR: [IDs]}), as (ID, line of the repeat), or None
+        '''
+        if not self._candidates:
+            return None
+        counts = dict.fromkeys(self._candidates, 0)
+        found = {}
+        for IDs in revDBR.itervalues():
+            for ID in IDs:
+                key = self._key(ID)
+                if key in counts:
+                    counts[key] += 1
+                    found[key] = ID
+        repeats = []
+        for key, lines in self._candidates.iteritems():
+            if counts[key] > 1:
+                # the first occurrence may itself have been a false hit; the repeats are the last counts - 1 hits
+                repeats.append((lines[len(lines) - counts[key] + 1], found[key]))
+        if not repeats:
+            return None
+        line, ID = min(repeats)
+        return ID, line
+
+def build_DBR_dicts(input, dbr_start, dbr_stop, outputs = ('forward',), dup_check = 'exact', dup_fpr = 0.001, fastq_range = None):
+    '''
+    read a FASTQ file (or one FastqRange of it) once and fill every requested dictionary (see DBR_OUTPUTS)
+    '''
+    for output in outputs:
+        if output not in DBR_OUTPUTS:
+            raise ValueError("DBR dictionary output specified as %s. Options are 'forward', 'reverse' or 'counts'." % output)
     # DBR is in read 2
     # if merged, it will be the last -2 to -9 (inclusive) bases, starting with base 0 and counting from the end
     # if not merged, it will be bases 2 to 9
+    window = DBR_slice(dbr_start, dbr_stop)
+    dbr = {}
+    revDBR = defaultdict(list)
+    counts = defaultdict(int)
+    n_records = 0
+    if 'reverse' in outputs and dup_check:
+        seen = DuplicateIDs(dup_check, dup_fpr)
+    else:
+        seen = None
+    if fastq_range is None:
+        batches = _whole_fastq_batches(input)
+    else:
+        batches = fastq_range_batches(input, fastq_range)
+    for batch in batches:
+        tags = [record[1][window] for record in batch]
+        if 'counts' in outputs:
+            for tag in tags:
+                counts[tag] += 1
+        if 'forward' in outputs or 'reverse' in outputs: # the counts don't need the IDs
+            IDs = illumina_IDs([record[0] for record in batch])
+            if 'forward' in outputs:
+                dbr.update(itertools.izip(IDs, tags))
+            if 'reverse' in outputs:
+                for i, (ID, tag) in enumerate(itertools.izip(IDs, tags)):
+                    # each Illumina ID should occur only once; if there are duplicates that indicates a data problem!
+                    if seen is not None and seen.seen(ID):
+                        fq_line = 4*(n_records + i) + 1 # header line of the repeated record
+                        if seen.mode == 'exact':
+                            raise ValueError('Duplicate Illumina ID %s found at line %s' % (ID, fq_line))
+                        seen.candidate(ID, fq_line) # a Bloom filter hit is confirmed once all the IDs are in
+                    revDBR[tag].append(ID)
+        n_records += len(batch)
+    if seen is not None:
+        duplicate = seen.confirm(revDBR)
+        if duplicate:
+            raise ValueError('Duplicate Illumina ID %s found at line %s' % duplicate)
+    built = {}
+    if 'forward' in outputs:
+        built['forward'] = dbr
+    if 'reverse' in outputs:
+        built['reverse'] = revDBR
+    if 'counts' in outputs:
+        built['counts'] = dict(counts)
+    return built
+
+def _whole_fastq_batches(input):
+    with open_fastq(input) as db:
+        for batch in fastq_batches(db):
+            yield batch
+
+def merge_DBR_dicts(parts, dup_check = 'exact', dup_fpr = 0.001):
+    '''
+    combine the dictionaries built from the FastqRanges of one file, in file order
+    '''
+    built = {}
+    for part in parts:
+        if 'forward' in part:
+            built.setdefault('forward', {}).update(part['forward'])
+        if 'reverse' in part:
+            revDBR = built.setdefault('reverse', defaultdict(list))
+            for tag, IDs in part['reverse'].iteritems():
+                revDBR[tag].extend(IDs)
+        if 'counts' in part:
+            counts = built.setdefault('counts', {})
+            for tag, count in part['counts'].iteritems():
+                counts[tag] = counts.get(tag, 0) + count
+    if 'reverse' in built and dup_check:
+        seen = DuplicateIDs(dup_check, dup_fpr)
+        for IDs in built['reverse'].itervalues():
+            for ID in IDs:
+                if seen.seen(ID):
+                    if seen.mode == 'exact':
+                        raise ValueError('Duplicate Illumina ID %s found' % ID)
+                    seen.candidate(ID)
+        duplicate = seen.confirm(built['reverse'])
+        if duplicate:
+            raise ValueError('Duplicate Illumina ID %s found' % duplicate[0])
+    return built
+
+def fused_DBR_dict(in_dir, in_file, dbr_start, dbr_stop, outputs = ('forward',), test_dict = False, save = None, saveType = 'json', dup_check = 'exact', dup_fpr = 0.001, shard_by = None, n_shards = 64):
+    input = os.path.join(in_dir, in_file)
+    if not checkFile(input):
+        raise IOError("where is the input file: %s" % in_file)
+    info('Creating %s DBR dictionaries from %s.' % (', '.join(outputs), in_file))
+    built = build_DBR_dicts(input, dbr_start, dbr_stop, outputs, dup_check, dup_fpr)
+    return report_DBR_dicts(built, in_file, test_dict, save, saveType, shard_by, n_shards)
+
+def report_DBR_dicts(built, in_file, test_dict = False, save = None, saveType = 'json', shard_by = None, n_shards = 64):
+    if test_dict:
+        for output in DBR_OUTPUTS:
+            if output not in built:
+                continue
+            print 'Checking %s DBR dictionary format.' % output
+            x = itertools.islice(built[output].iteritems(), 0, 4)
+            for key, value in x:
+                print key, value
+    saved = [] # paths of the saved dictionaries
+    if save:
+        # the forward dictionary keeps the plain file name (it is the one DBR_Filter looks for);
+        # the binary format only holds {ID: DBR}, so the other dictionaries are always saved as JSON
+        if 'forward' in built:
+            saved.append(save_DBRdictionary(built['forward'], save, in_file, saveType, shard_by = shard_by, n_shards = n_shards))
+        if 'reverse' in built:
+            saved.append(save_DBRdictionary(built['reverse'], save, in_file, 'json', suffix = '_rev'))
+        if 'counts' in built:
+            saved.append(save_DBRdictionary(built['counts'], save, in_file, 'json', suffix = '_counts'))
+    return saved
+
+def DBR_dict(in_dir, in_file, dbr_start, dbr_stop, test_dict = False, save = None, saveType = 'json', shard_by = None, n_shards = 64):
     input = os.path.join(in_dir, in_file)
     if not checkFile(input):
         raise IOError("where is the input file: %s" % in_file)
     info('Creating {dbr: ID} dictionary from %s.' % in_file)
-    dbr = {}
-    fq_line = 1
-    if in_file.endswith('gz'):
-        openFxn = gzip.open
-    else:
-        openFxn = open
-    with openFxn(input, 'r') as db:
-        for line in db:
-            if fq_line == 1:
-                ID = re.split('(\d[:|_]\d+[:|_]\d+[:|_]\d+)', line)[1]
-                fq_line = 2
-            elif fq_line == 2:
-                seq = list(line) # split the sequence line into a list
-                tag = ''.join(seq[dbr_start:dbr_stop])
-                dbr[ID] = tag
-                fq_line = 3
-            elif fq_line == 3:
-                fq_line = 4
-            elif fq_line == 4:
-                fq_line = 1
+    dbr = build_DBR_dicts(input, dbr_start, dbr_stop, ('forward',))['forward']
     if test_dict:
         print 'Checking DBR dictionary format.'
         x = itertools.islice(dbr.iteritems(), 0, 4)
@@ -124,63 +1515,14 @@ def DBR_dict(in_dir, in_file, dbr_start, dbr_stop, test_dict = False, save = Non
             print key, value
         #print dbr['8:1101:15808:1492'] # this is the first entry in /home/antolinlab/Downloads/CWD_RADseq/pear_merged_Library12_L8.assembled.fastq
     if save:
-        if not os.path.exists(save):
-            os.makedirs(save)
-        fq_name = os.path.splitext(in_file)[0]
-        fq_dbr_out = save + fq_name + '.json'
-        print 'Writing dictionary to ' + fq_dbr_out
-        with open(fq_dbr_out, 'w') as fp:          
-            json.dump(dbr, fp)
+        save_DBRdictionary(dbr, save, in_file, saveType, shard_by = shard_by, n_shards = n_shards)
 
-def rev_DBR_dict(in_dir, in_file, dbr_start, dbr_stop, test_dict = False, save = None):
-    # DBR is in read 2
-    # if merged, it will be the last -2 to -9 (inclusive) bases, starting with base 0 and counting from the end
-    # if not merged, it will be bases 2 to 9
+def rev_DBR_dict(in_dir, in_file, dbr_start, dbr_stop, test_dict = False, save = None, saveType = 'json', dup_check = 'exact', dup_fpr = 0.001):
     input = os.path.join(in_dir, in_file)
     if not checkFile(input):
         raise IOError("where is the input file: %s" % in_file)
     info('Creating {ID: dbr} dictionary from %s.' % in_file)
-    #dbr = {}
-    #revDBR = {}
-    revDBR = defaultdict(list)
-    #fq_line = 1
-    fq_line = 0
-    if in_file.endswith('gz'):
-        openFxn = gzip.open
-    else:
-        openFxn = open
-    with openFxn(input, 'r') as db:
-        for line in db:
-            #print fq_line, line
-            if fq_line %4 == 0:
-                ID = re.split('(\d[:|_]\d+[:|_]\d+[:|_]\d+)', line)[1]
-                #print ID
-                fq_line += 1 #increment 1 line
-            elif fq_line %4 == 1:
-                fq_line += 1
-                seq = list(line) # split the sequence line into a list
-                tag = ''.join(seq[dbr_start:dbr_stop])
-                #print tag
-                if ID not in revDBR[tag]:
-                    revDBR[tag].append(ID)
-                else:
-                    raise ValueError('Duplicate Illumina ID found at line %s' % fq_line-1)
-                #if tag in revDBR.keys():
-                #    if ID in revDBR.get(tag):
-                #        # each Illumina ID should occur only once; if there are duplicates that indicates a data problem!
-                #        raise ValueError('Duplicate Illumina ID found at line %s' % fq_line-1)
-                #    else:
-                #        revDBR[tag].append(ID) 
-                #else:
-                #    revDBR[tag] = [ID]
-            elif fq_line %4 == 2:
-                fq_line += 1
-            elif fq_line %4 == 3:
-                fq_line +=1
-    # this would be useful if building dictionaries with sets, but it is untested
-    # I decided sets weren't the way to go anyway (see above)
-    #for key, value in revDBR.items():
-    #    revDBR[key] = list(value)
+    revDBR = build_DBR_dicts(input, dbr_start, dbr_stop, ('reverse',), dup_check, dup_fpr)['reverse']
     if test_dict:
         print 'Checking DBR dictionary format.'
         x = itertools.islice(revDBR.iteritems(), 0, 4)
@@ -188,77 +1530,28 @@ def rev_DBR_dict(in_dir, in_file, dbr_start, dbr_stop, test_dict = False, save =
             print key, value
         #print dbr['8:1101:15808:1492'] # this is the first entry in /home/antolinlab/Downloads/CWD_RADseq/pear_merged_Library12_L8.assembled.fastq
     if save:
-        if not os.path.exists(save):
-            os.makedirs(save)
-        fq_name = os.path.splitext(in_file)[0]
-        fq_dbr_out = os.path.join(save, (fq_name + '.json'))
-        print 'Writing dictionary to ' + fq_dbr_out
-        with open(fq_dbr_out, 'w') as fp:          
-            #json.dump(dbr, fp)
-            json.dump(revDBR, fp)
-'''
-def parallel_DBR_count(in_dir, dbr_start, dbr_stop, save = None, saveType = 'json'):
-    #if not checkDir(in_dir):
-    #    raise IOError("Input is not a directory: %s" % in_dir)
-    infiles = os.listdir(in_dir)
-    dbrCountProcess = [mp.Process(target=DBR_count, args=(os.path.join(in_dir+in_file), 
-                                                          dbr_start,
-                                                          dbr_stop,
-                                                          save,
-                                                          saveType)) for in_file in infiles]
-     
-    for dc in dbrCountProcess:
-        dc.start()
-    for dc in dbrCountProcess:
-        dc.join()
+        if saveType == 'dbr':
+            # the binary format stores {ID: DBR}; the {DBR: [IDs]} view is the same set of records
+            save_DBRdictionary(dict((ID, tag) for tag, IDs in revDBR.iteritems() for ID in IDs), save, in_file, saveType)
+        else:
+            save_DBRdictionary(revDBR, save, in_file, saveType)
 
+# for a whole directory use parallel_DBR_dict(..., outputs = ('counts',))
 def DBR_count(in_file, dbr_start, dbr_stop, save = None, saveType = None):
-    # DBR is in read 2
-    # if merged, it will be the last -2 to -9 (inclusive) bases, starting with base 0 and counting from the end
-    # if not merged, it will be bases 2 to 9
     if not checkFile(in_file):
         raise IOError("where is the input file: %s" % in_file)
+    if saveType and not save:
+        raise ValueError('DBR_count needs a save directory to write a %s dictionary.' % saveType)
+    if saveType == 'dbr': # the binary format is keyed by Illumina ID; a {DBR: count} table has DBRs for keys
+        raise ValueError("DBR_count can't save a binary (.dbr) dictionary of DBR counts. Use saveType = 'json' or 'text'.")
     info('Creating {dbr : count} dictionary from %s.' % in_file)
-    dbr = {}
-    fq_line = 1
-    if in_file.endswith('gz'):
-        openFxn = gzip.open
-    else:
-        openFxn = open
-    with openFxn(in_file, 'r') as db:
-        for line in db:
-            if fq_line == 1:
-                fq_line = 2
-            elif fq_line == 2:
-                dbr_value = line[dbr_start:dbr_stop]
-                if dbr_value in dbr:
-                    dbr[dbr_value]+=1
-                else:
-                    dbr[dbr_value]=1
-                fq_line = 3
-            elif fq_line == 3:
-                fq_line = 4
-            elif fq_line == 4:
-                fq_line = 1
+    dbr = build_DBR_dicts(in_file, dbr_start, dbr_stop, ('counts',))['counts']
     if saveType:
-        if not os.path.exists(save):
-            os.makedirs(save)
-        fq_base = os.path.splitext(os.path.split(in_file)[1])[0]
-        #fq_name = os.path.splitext(in_file)[0]
-        if saveType == 'json':
-            fq_dbr_out = save + fq_base + '.json'
-            print 'Writing dictionary to ' + fq_dbr_out
-            with open(fq_dbr_out, 'w') as fp:          
-                json.dump(dbr, fp)
-        elif saveType == 'text':
-            fq_dbr_out = save + fq_base + '.txt'
-            with open(fq_dbr_out, 'w') as fp:
-                for key, value in dbr.items():
-                    fp.write(key + ',' + str(value) + '\n')
-'''
-phred_dict = {'"':1.0,"#":2.0,"$":3.0,"%":4.0,"&":5.0,"'":6.0,"(":7.0,")":8.0,"*":9.0,"+":10.0,
+        save_DBRdictionary(dbr, save, os.path.split(in_file)[1], saveType)
+
+phred_dict = {"!":0.0,'"':1.0,"#":2.0,"$":3.0,"%":4.0,"&":5.0,"'":6.0,"(":7.0,")":8.0,"*":9.0,"+":10.0,
               ",":11.0,"-":12.0,".":13.0,"/":14.0,"0":15.0,"1":16,"2":17.0,"3":18.0,"4":19.0,"5":20.0,
-              "6":21.0,"7":22.0,"8":23.0,"9":24.0,":":25.0,";":26,"<":27.0,"+":28.0,">":29.0,"?":30.0,
+              "6":21.0,"7":22.0,"8":23.0,"9":24.0,":":25.0,";":26,"<":27.0,"=":28.0,">":29.0,"?":30.0,
               "@":31.0,"A":32.0,"B":33.0,"C":34.0,"D":35.0,"E":36,"F":37.0,"G":38.0,"H":39.0,"I":40.0,
               "J":41.0,"K":42.0}
 # conversion reference: http://drive5.com/usearch/manual/quality_score.html
@@ -270,21 +1563,255 @@ out_seqs = '/home/antolinlab/Desktop/CSU_ChronicWasting/PilotAnalysis/DBR_filter
 barcode_file = '/home/antolinlab/Desktop/CSU_ChronicWasting/PilotAnalysis/pilot_barcode_file'
 '''
 
+# Quality scores for DBR_Filter's tie breaks, for a whole group of reads at once. With the standard phred_dict the
+# scores come straight from the bytes of the quality strings (ASCII - 33) instead of a dictionary lookup per
+# character; quality strings of the same length are scored together, with NumPy if it is installed.
+QUAL_METRICS = ('median', # median Phred score
+                'mean', # mean Phred score
+                'expected_errors') # expected number of errors in the read, sum(10^(-Q/10)); scored as its negative
+PHRED_OFFSET = 33
+NUMPY_MIN_BATCH = 32 # smaller groups are quicker in plain Python
+EE_DIGITS = 9 # expected errors are rounded so that reads with the same qualities in a different order tie
+_ERROR_PROBS = [10**(-(c - PHRED_OFFSET)/10.0) for c in range(256)] # by ASCII code
+
+def _is_phred33(phred_dict):
+    return phred_dict is None or all(ord(q) - PHRED_OFFSET == score for q, score in phred_dict.iteritems())
+
+def _qual_score(scores, metric):
+    # scores: sortable, summable Phred scores of one read (ASCII codes if offset is set)
+    if metric == 'median':
+        scores = sorted(scores)
+        qlen = len(scores)
+        if qlen % 2 == 0: # even length list -- take the average of the two middle values
+            return (scores[(qlen/2)-1]+scores[(qlen/2)])/2.0
+        return float(scores[qlen/2])
+    elif metric == 'mean':
+        return float(sum(scores))/len(scores)
+    return -round(sum(scores), EE_DIGITS)
+
+def _numpy_qual_scores(QUALs, metric):
+    quals = np.frombuffer(''.join(QUALs), dtype=np.uint8).reshape(len(QUALs), -1)
+    if metric == 'median':
+        return (np.median(quals, axis=1) - PHRED_OFFSET).tolist()
+    elif metric == 'mean':
+        return (quals.sum(axis=1, dtype=np.int64)/float(quals.shape[1]) - PHRED_OFFSET).tolist()
+    return (-np.round(np.take(np.array(_ERROR_PROBS), quals).sum(axis=1), EE_DIGITS)).tolist()
+
+def qual_scores(QUALs, metric = 'median', phred_dict = phred_dict):
+    '''
+    score a list of ASCII quality strings by metric (see QUAL_METRICS); higher scores are always better
+    '''
+    if metric not in QUAL_METRICS:
+        raise ValueError("Quality metric specified as %s. Options are 'median', 'mean' or 'expected_errors'." % metric)
+    if not _is_phred33(phred_dict): # a non-standard phred_dict: look up every character
+        if metric == 'expected_errors':
+            return [_qual_score([10**(-phred_dict[q]/10.0) for q in QUAL], metric) for QUAL in QUALs]
+        return [_qual_score([phred_dict[q] for q in QUAL], metric) for QUAL in QUALs]
+    scores = [None]*len(QUALs)
+    by_length = defaultdict(list)
+    for i, QUAL in enumerate(QUALs):
+        by_length[len(QUAL)].append(i)
+    for qlen, group in by_length.iteritems():
+        if np is not None and len(group) >= NUMPY_MIN_BATCH and qlen:
+            for i, score in itertools.izip(group, _numpy_qual_scores([QUALs[i] for i in group], metric)):
+                scores[i] = score
+        elif metric in ('median', 'mean'):
+            for i in group:
+                scores[i] = _qual_score(bytearray(QUALs[i]), metric) - PHRED_OFFSET
+        else:
+            for i in group:
+                scores[i] = _qual_score(map(_ERROR_PROBS.__getitem__, bytearray(QUALs[i])), metric)
+    return scores
+
+_LOW_QUALS = {} # by quality q: the Phred+33 characters below q, which str.translate deletes to count the rest
+
+def count_good_bases(QUALs, q):
+    '''
+    the number of bases with Phred quality q or more in each of a list of ASCII quality strings
+    '''
+    threshold = min(q + PHRED_OFFSET, 256)
+    if np is not None and len(QUALs) >= NUMPY_MIN_BATCH:
+        # one pass over all the qualities; each read's count is a difference of the running total at its ends
+        lengths = np.fromiter(itertools.imap(len, QUALs), dtype=np.int64, count=len(QUALs))
+        ends = np.cumsum(lengths)
+        good = np.zeros(ends[-1] + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(''.join(QUALs), dtype=np.uint8) >= threshold, out=good[1:])
+        return (good[ends] - good[ends - lengths]).tolist()
+    low = _LOW_QUALS.get(q)
+    if low is None:
+        low = _LOW_QUALS[q] = ''.join(chr(c) for c in xrange(threshold))
+    return [len(QUAL.translate(None, low)) for QUAL in QUALs]
+
 def qual_median(QUAL, phred_dict):
+    return qual_scores([QUAL], 'median', phred_dict)[0]
     
-    listQUAL = list(QUAL)
-    list_intQUAL =[]
-    for q in listQUAL:
-        list_intQUAL.append(phred_dict[q])
-    #return np.median(list_intQUAL)
-    #pdb.set_trace()
-    list_intQUAL.sort() # this modifies the list in place -- you can't assign it to a new variable. alt, qsort = sorted(list_intQUAL) if we need the original list preserved for some reason
-    qlen = len(list_intQUAL)
-    if qlen % 2 == 0: # even length list -- take the average of the two middle values
-        median_qual = (list_intQUAL[(qlen/2)-1]+list_intQUAL[(qlen/2)])/2
-    else: # odd length list -- take the middle value (list length / 2 will be automatically rounded up by python integer division)
-        median_qual = list_intQUAL[qlen/2]
-    return median_qual
+class SAMRead(object):
+    '''
+    the parts of a primary SAM read that DBR_Filter writes out, and its ordinal in the input (see KeptAlignments)
+    '''
+    __slots__ = ('QNAME', 'QUAL', 'SEQ', 'n')
+
+    def __init__(self, QNAME, QUAL, SEQ, n = None):
+        self.QNAME = QNAME
+        self.QUAL = QUAL
+        self.SEQ = SEQ
+        self.n = n
+
+    def __repr__(self):
+        return repr([self.QNAME, self.QUAL, self.SEQ])
+
+class LocusReads(object):
+    '''
+    primary reads by locus and DBR, {RNAME: {DBR: [SAMRead, ...]}}; the count of a DBR at a locus is the length
+    of its list. RNAMEs and DBRs repeat on every read, so one interned copy of each is kept as the key
+    '''
+    def __init__(self):
+        self.loci = {}
+
+    def add(self, RNAME, dbr_value, QNAME, QUAL, SEQ, n = None):
+        locus = self.loci.get(RNAME)
+        if locus is None:
+            locus = self.loci[intern(RNAME)] = {}
+        reads = locus.get(dbr_value)
+        if reads is None:
+            if type(dbr_value) is str: # JSON dictionaries give unicode DBRs, which can't be interned
+                dbr_value = intern(dbr_value)
+            reads = locus[dbr_value] = []
+        reads.append(SAMRead(QNAME, QUAL, SEQ, n))
+
+    def pop(self, RNAME):
+        return self.loci.pop(RNAME, None)
+
+    def iteritems(self):
+        return self.loci.iteritems()
+
+class ColumnarReads(object):
+    '''
+    primary reads as columns, for DBR_Filter(columnar = True): a locus id and a DBR id per read (one id for each
+    distinct RNAME and DBR) plus the QNAME, SEQ and QUAL lists and the reads' ordinals in the input (-1 if not
+    given); a read's row is its place in these columns
+    '''
+    def __init__(self):
+        self.locus_ids = {}
+        self.dbr_ids = {}
+        self.loci = array('l')
+        self.dbrs = array('l')
+        self.QNAMEs = []
+        self.SEQs = []
+        self.QUALs = []
+        self.ordinals = array('l')
+
+    def add(self, RNAME, dbr_value, QNAME, QUAL, SEQ, n = None):
+        locus = self.locus_ids.get(RNAME)
+        if locus is None:
+            locus = self.locus_ids[RNAME] = len(self.locus_ids)
+        dbr = self.dbr_ids.get(dbr_value)
+        if dbr is None:
+            dbr = self.dbr_ids[dbr_value] = len(self.dbr_ids)
+        self.loci.append(locus)
+        self.dbrs.append(dbr)
+        self.QNAMEs.append(QNAME)
+        self.SEQs.append(SEQ)
+        self.QUALs.append(QUAL)
+        self.ordinals.append(-1 if n is None else n)
+
+    def __len__(self):
+        return len(self.QNAMEs)
+
+    def iteritems(self):
+        # (RNAME, {DBR: [SAMRead, ...]}) one locus at a time, the same view as LocusReads (for checking only). only the
+        # rows, sorted by locus, are held; each locus's dictionary is made as it is reached
+        RNAMEs = dict((locus, RNAME) for RNAME, locus in self.locus_ids.iteritems())
+        DBRs = dict((dbr, dbr_value) for dbr_value, dbr in self.dbr_ids.iteritems())
+        if np is not None:
+            rows = np.argsort(np.array(self.loci, dtype=np.int64), kind='mergesort').tolist()
+        else:
+            rows = sorted(xrange(len(self)), key=self.loci.__getitem__)
+        for locus, locus_rows in itertools.groupby(rows, self.loci.__getitem__):
+            reads = defaultdict(list)
+            for i in locus_rows:
+                reads[DBRs[self.dbrs[i]]].append(SAMRead(self.QNAMEs[i], self.QUALs[i], self.SEQs[i], self.ordinals[i]))
+            yield RNAMEs[locus], dict(reads)
+
+    def _ranked(self, scores):
+        # rows grouped by (locus, DBR), best first within each group, and the first row of each group
+        n = len(self)
+        if np is not None:
+            # best first: highest score, then SEQ and QUAL as tie breaks (as heapq.nlargest does on the same tuple)
+            seq_rank = np.unique(np.array(self.SEQs), return_inverse=True)[1]
+            qual_rank = np.unique(np.array(self.QUALs), return_inverse=True)[1]
+            loci = np.array(self.loci, dtype=np.int64)
+            dbrs = np.array(self.dbrs, dtype=np.int64)
+            order = np.lexsort((-qual_rank, -seq_rank, -np.array(scores), dbrs, loci))
+            new_group = np.ones(n, dtype=bool)
+            new_group[1:] = (loci[order][1:] != loci[order][:-1]) | (dbrs[order][1:] != dbrs[order][:-1])
+            return order, np.flatnonzero(new_group)
+        order = sorted(xrange(n), key=lambda i: (scores[i], self.SEQs[i], self.QUALs[i]), reverse=True)
+        order.sort(key=lambda i: (self.loci[i], self.dbrs[i])) # stable, so each group stays best first
+        starts = [j for j in xrange(n) if j == 0 or (self.loci[order[j]], self.dbrs[order[j]]) != (self.loci[order[j-1]], self.dbrs[order[j-1]])]
+        return order, starts
+
+    def resolve(self, n_expected, out_file, qual_metric = 'median', phred_dict = phred_dict):
+        '''
+        write the best n_expected reads of each (locus, DBR) group to out_file (a FastqWriter or KeptAlignments), skipping unmapped reads (RNAME '*');
+        returns the number of reads removed
+        '''
+        n = len(self)
+        if not n:
+            return 0
+        order, starts = self._ranked(qual_scores(self.QUALs, qual_metric, phred_dict))
+        unmapped = self.locus_ids.get('*', -1)
+        if np is not None:
+            # rank of each read within its group, from the start of the group it falls in
+            group_start = np.zeros(n, dtype=np.int64)
+            group_start[starts] = starts
+            rank = np.arange(n) - np.maximum.accumulate(group_start)
+            mapped = np.array(self.loci, dtype=np.int64)[order] != unmapped
+            sizes = np.diff(np.append(starts, n))
+            n_removed = int(np.maximum(sizes - n_expected, 0)[mapped[starts]].sum())
+            kept = order[(rank < n_expected) & mapped].tolist()
+        else:
+            n_removed = 0
+            kept = []
+            for start, stop in itertools.izip(starts, starts[1:] + [n]):
+                if self.loci[order[start]] != unmapped:
+                    n_removed += max(stop - start - n_expected, 0)
+                    kept.extend(order[start:min(stop, start + n_expected)])
+        for i in kept:
+            out_file.write_read(self.QNAMEs[i], self.SEQs[i], self.QUALs[i], self.ordinals[i])
+        return n_removed
+
+def filter_locus(locus, n_expected, phred_dict, out_file, qual_metric = 'median'):
+    '''
+    write the reads kept at one locus ({DBR: [SAMRead, ...]}) to out_file (a FastqWriter or KeptAlignments), keeping at most n_expected reads per DBR
+    (the best by qual_metric); returns the number of reads removed
+    '''
+    n_removed = 0
+    # get all the DBRs and reads that went into that locus in that sample
+    for dbr_value, locus_reads in locus.iteritems():
+        count = len(locus_reads)
+        if count > n_expected:
+            ##################################################
+            ## THIS IS WHERE THE FILTERING HAPPENS           #
+            ##################################################
+            ID_quals = {} # we'll make yet another dictionary to store the QNAME and the QUAL score
+            ID_reads = {}
+            scores = qual_scores([read.QUAL for read in locus_reads], qual_metric, phred_dict)
+            for read, score in itertools.izip(locus_reads, scores):
+                ID_quals[read.QNAME] = (score, read.SEQ, read.QUAL)
+                ID_reads[read.QNAME] = read
+            n_remove = count - n_expected
+            n_removed += n_remove
+            to_keep = heapq.nlargest(n_expected, ID_quals, key=lambda x:ID_quals[x])
+            #to_keep = max(ID_quals, key=lambda x:ID_quals[x]) 
+            for k in to_keep:
+                keep = ID_quals[k] # get the full data for the highest median sequences
+                #write out the data to keep, appending the original barcode to the beginning of the sequence
+                out_file.write_read(k, keep[1], keep[2], ID_reads[k].n)
+        else: # if count <= n_expected, we can just keep every entry associated with that RNAME
+            for read in locus_reads:
+                out_file.write_read(read.QNAME, read.SEQ, read.QUAL, read.n)
+    return n_removed
     
 def find_SampleID(filename, r):
     sampleID_regex = re.compile(r)
@@ -320,13 +1847,34 @@ def find_BarcodeFile(library, directory):
     else:
         return None
     
+def stale_conversion(dict_in):
+    '''
+    true if dict_in is a binary copy made by share_DBRdictionaries whose JSON dictionary has changed since (a
+    dictionary saved over the copy is no longer described by its checkpoint, so it is used as it is)
+    '''
+    saved = read_checkpoint(dict_in)
+    if not saved or not file_unchanged(dict_in, saved['output']):
+        return False
+    return not all(file_unchanged(in_file, fingerprint) for in_file, fingerprint in saved['inputs'].iteritems())
+
 def find_DBRdictionary(match_string, directory):
     if match_string: # library can also be returned as 'None' for files with improper naming
         if os.path.isdir(directory):
-            dcs = os.listdir(directory)
+            dcs = sorted(os.listdir(directory))
+            # prefer a binary dictionary, then a sharded one, over a JSON dump of the same library
+            dcs.sort(key=lambda d: (not d.endswith(DBR_EXTENSION), not d.endswith(SHARD_EXTENSION)))
             for d in dcs:
+                if re.search(r'\.tmp\d*$', d): # left behind by an interrupted write
+                    continue
+                if re.search(r'_(rev|counts)\.(json|txt)$', d): # the other dictionaries saved by parallel_DBR_dict
+                    continue
+                if d.endswith(CHECKPOINT_EXTENSION):
+                    continue
                 if match_string in d:
                     dcf = directory + '/' + d
+                    if stale_conversion(dcf):
+                        print 'Ignoring %s, which was converted from a dictionary that has changed since' % dcf
+                        continue
                     return dcf
         else: # if it's just a single file
             if os.path.isfile(directory):
@@ -336,6 +1884,580 @@ def find_DBRdictionary(match_string, directory):
     else:
         return None
         
+################################# SAM READING #################################
+
+# DBR_Filter only needs QNAME, FLAG, RNAME, SEQ and QUAL from each alignment. iter_SAM splits off just the first
+# eleven columns, tests FLAG as an integer against include/exclude masks (like samtools view -f/-F) and finds the
+# Illumina IDs of a whole batch of QNAMEs with one scan, the same one the FASTQ side uses for the dictionary keys.
+SAM_FLAG_EXCLUDE = 0x904 # unmapped (0x4), secondary (0x100) and supplementary (0x800) alignments
+SAM_REVERSE = 0x10
+_COMPLEMENT = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+def locus_partition(RNAME, n_partitions):
+    # which of n_partitions parts the reads mapped to RNAME go to; crc32 is the same in every process and run
+    return (zlib.crc32(RNAME) & 0xffffffff) % n_partitions
+
+# the SAM and BAM readers (and write_alignments) select reads through these two lookups, so they always agree
+class SelectedFlags(dict):
+    '''
+    {FLAG: (FLAG as an integer, selected?)} for FLAG given as the SAM column or as an integer, filled in as values turn
+    up (a file only uses a handful of distinct FLAGs): selected reads have all the flag_include bits and none of the
+    flag_exclude bits
+    '''
+    def __init__(self, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE):
+        dict.__init__(self)
+        self.flag_include = flag_include
+        self.flag_exclude = flag_exclude
+
+    def __missing__(self, key):
+        FLAG = int(key)
+        flag = self[key] = (FLAG, FLAG & self.flag_include == self.flag_include and not FLAG & self.flag_exclude)
+        return flag
+
+class OwnedLoci(dict):
+    '''
+    {RNAME: in part i of k?} for partition = (i, k) (see locus_partition), filled in as RNAMEs turn up
+    '''
+    def __init__(self, partition):
+        dict.__init__(self)
+        self.partition = partition
+
+    def __missing__(self, RNAME):
+        mine = self[RNAME] = locus_partition(RNAME, self.partition[1]) == self.partition[0]
+        return mine
+
+def iter_SAM(sam_file, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE, partition = None):
+    '''
+    (QNAME, RNAME, SEQ, QUAL, n) for each read of a SAM file whose FLAG has all the flag_include bits and none of the
+    flag_exclude bits, where n counts these selected reads from 0. QNAME is reduced to the Illumina ID, and
+    reverse-strand reads are turned back into the orientation they were sequenced in. With partition = (i, k), only
+    the reads whose RNAME is in part i of k (see locus_partition) are given, though n counts them all
+    '''
+    wanted = SelectedFlags(flag_include, flag_exclude)
+    if partition is not None:
+        owned = OwnedLoci(partition)
+    n = 0
+    with open(sam_file, 'r') as inFile:
+        for lines in iter(lambda: inFile.readlines(FASTQ_CHUNK_SIZE), []):
+            selected = []
+            for line in lines:
+                if line[0] in '@\n': # ignore the header lines
+                    continue
+                fields = line.split('\t', 11)
+                flag = wanted[fields[1]]
+                if flag[1]:
+                    if partition is not None and not owned[fields[2]]:
+                        n += 1
+                        continue
+                    selected.append((flag[0], n, fields))
+                    n += 1
+            for QNAME, (FLAG, n_read, fields) in itertools.izip(illumina_IDs([read[2][0] for read in selected]), selected):
+                SEQ = fields[9]
+                QUAL = fields[10]
+                if len(fields) == 11: # no optional fields, so QUAL ends the line
+                    QUAL = QUAL.rstrip('\r\n')
+                if FLAG & SAM_REVERSE:
+                    SEQ = SEQ.translate(_COMPLEMENT)[::-1]
+                    QUAL = QUAL[::-1]
+                yield QNAME, fields[2], SEQ, QUAL, n_read
+
+# BAM records are decoded straight from the inflated BGZF stream (BGZFReader inflates blocks on a thread pool)
+BAM_MAGIC = 'BAM\x01'
+_BAM_CORE = struct.Struct('<iiBBHHHiiii') # refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next refID, next pos, tlen
+_BAM_BASES = '=ACMGRSVTWYHKDBN'
+_BAM_BASE_PAIRS = [a + b for a in _BAM_BASES for b in _BAM_BASES] # both bases of a packed byte
+_BAM_QUAL = string.maketrans(''.join(chr(q) for q in range(94)), ''.join(chr(q + PHRED_OFFSET) for q in range(94)))
+
+def is_BAM(in_file):
+    if not is_BGZF(in_file):
+        return False
+    with gzip.open(in_file, 'rb') as f:
+        return f.read(len(BAM_MAGIC)) == BAM_MAGIC
+
+def read_BAM_header(bam):
+    '''
+    read the header from the start of an open BAM file; returns (the header as stored, [RNAME, ...] by refID)
+    '''
+    parts = [bam.read(8)]
+    magic, l_text = struct.unpack('<4si', parts[0])
+    if magic != BAM_MAGIC:
+        raise IOError('Not a BAM file: %s' % bam.name)
+    parts.append(bam.read(l_text + 4))
+    RNAMEs = []
+    for i in xrange(struct.unpack('<i', parts[-1][-4:])[0]):
+        parts.append(bam.read(4))
+        parts.append(bam.read(struct.unpack('<i', parts[-1])[0] + 4)) # name and l_ref
+        RNAMEs.append(parts[-1][:-5])
+    return ''.join(parts), RNAMEs
+
+def BAM_records(bam, bam_file):
+    '''
+    the alignment records of an open BAM file, read past its header, as (data, [(start, end), ...]) for each chunk
+    of the file: data[start:end] is a whole record, from its block_size field on
+    '''
+    data = ''
+    while True:
+        more = bam.read(FASTQ_CHUNK_SIZE)
+        data += more
+        records = []
+        pos = 0
+        while pos + 4 <= len(data):
+            end = pos + 4 + struct.unpack_from('<i', data, pos)[0]
+            if end > len(data):
+                break
+            records.append((pos, end))
+            pos = end
+        yield data, records
+        data = data[pos:]
+        if not more:
+            if data:
+                raise IOError('Truncated BAM record at end of %s' % bam_file)
+            break
+
+def iter_BAM(bam_file, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE, threads = DECOMPRESS_THREADS, partition = None):
+    '''
+    (QNAME, RNAME, SEQ, QUAL, n) for each selected read of a BAM file, as iter_SAM gives them for a SAM file
+    '''
+    wanted = SelectedFlags(flag_include, flag_exclude)
+    n = 0
+    with BGZFReader(bam_file, threads) as bam:
+        RNAMEs = read_BAM_header(bam)[1]
+        if partition is not None: # by refID, with the unmapped reads (refID -1) last
+            owned = OwnedLoci(partition)
+            owned = [owned[RNAME] for RNAME in RNAMEs + ['*']]
+        for data, records in BAM_records(bam, bam_file):
+            selected = []
+            for pos, end in records:
+                refID, _, l_read_name, _, _, n_cigar_op, FLAG, l_seq, _, _, _ = _BAM_CORE.unpack_from(data, pos + 4)
+                if wanted[FLAG][1]:
+                    if partition is None or owned[refID]:
+                        name_at = pos + 4 + _BAM_CORE.size
+                        seq_at = name_at + l_read_name + 4*n_cigar_op
+                        qual_at = seq_at + (l_seq + 1)//2
+                        selected.append((FLAG, refID, data[name_at:name_at + l_read_name - 1], data[seq_at:qual_at], l_seq, data[qual_at:qual_at + l_seq], n))
+                    n += 1
+            for QNAME, (FLAG, refID, name, seq, l_seq, qual, n_read) in itertools.izip(illumina_IDs([read[2] for read in selected]), selected):
+                SEQ = ''.join(map(_BAM_BASE_PAIRS.__getitem__, bytearray(seq)))[:l_seq]
+                if qual[:1] == '\xff': # no qualities stored
+                    QUAL = '*'
+                else:
+                    QUAL = qual.translate(_BAM_QUAL)
+                if FLAG & SAM_REVERSE:
+                    SEQ = SEQ.translate(_COMPLEMENT)[::-1]
+                    QUAL = QUAL[::-1]
+                yield QNAME, RNAMEs[refID] if refID >= 0 else '*', SEQ, QUAL, n_read
+
+# samtools_view_sort_index leaves X.bam and X.sorted.bam next to X.sam; the reads are the same, so only one is filtered
+ALIGNMENT_EXTENSIONS = ('.sorted.bam', '.bam', '.sam') # most preferred first
+
+def alignment_files(file_names):
+    '''
+    the alignment files to filter from a directory listing: for each X, the first of X.sorted.bam, X.bam and X.sam
+    present. anything else (BAM indexes, logs) is left out
+    '''
+    chosen = {} # X -> (rank, file name)
+    for name in file_names:
+        for rank, extension in enumerate(ALIGNMENT_EXTENSIONS):
+            if name.endswith(extension):
+                stem = name[:-len(extension)]
+                if stem not in chosen or rank < chosen[stem][0]:
+                    chosen[stem] = (rank, name)
+                break
+    return sorted(name for rank, name in chosen.itervalues())
+
+def iter_alignments(in_file, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE, partition = None):
+    '''
+    iter_BAM for BAM files, iter_SAM for anything else
+    '''
+    if is_BAM(in_file):
+        return iter_BAM(in_file, flag_include, flag_exclude, partition = partition)
+    return iter_SAM(in_file, flag_include, flag_exclude, partition)
+
+# DBR_Filter(out_format = 'alignments') notes which selected reads it keeps by their ordinal in the input (the n in
+# dict_SAM and sort_merge_SAM), then copies the header and those records to the output in a second pass, unchanged
+# and in their original order, so a coordinate-sorted file stays sorted and can go straight to genotype calling.
+class KeptAlignments(object):
+    '''
+    the ordinals of the reads DBR_Filter keeps, as a bitmap; takes the place of a FastqWriter
+    '''
+    def __init__(self):
+        self.kept = bytearray()
+
+    def write_read(self, QNAME, SEQ, QUAL, n = None):
+        if n >= len(self.kept):
+            self.kept.extend(bytearray(max(n + 1, 2*len(self.kept)) - len(self.kept)))
+        self.kept[n] = 1
+
+    def update(self, other):
+        # add the reads kept by another part of the same file (see DBR_Filter's partition)
+        n = other.kept.find('\x01')
+        while n >= 0:
+            self.write_read(None, None, None, n)
+            n = other.kept.find('\x01', n + 1)
+
+    def __contains__(self, n):
+        return n < len(self.kept) and self.kept[n] == 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+def alignments_out(in_file, out_dir, compress = None):
+    '''
+    file name for the kept alignments of in_file: BAM stays BAM, SAM stays SAM (gzip or BGZF compressed if asked)
+    '''
+    out_file = os.path.join(out_dir, 'DBR_filtered_' + os.path.basename(in_file))
+    if compress and not is_BAM(in_file):
+        out_file += '.gz'
+    return out_file
+
+def write_alignments(in_file, out_file, kept, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE, compress = None):
+    '''
+    write the header of a SAM or BAM file and those of its reads selected by flag_include and flag_exclude (as in
+    iter_SAM) whose ordinals are in kept; returns the number of alignments written
+    '''
+    n = 0
+    n_written = 0
+    wanted = SelectedFlags(flag_include, flag_exclude)
+    if is_BAM(in_file):
+        with BGZFReader(in_file) as bam, BlockWriter(out_file, 'bgzf', append = False) as out:
+            out.write(read_BAM_header(bam)[0])
+            out.flush() # the header gets blocks of its own, as samtools writes it
+            for data, records in BAM_records(bam, in_file):
+                for pos, end in records:
+                    if wanted[struct.unpack_from('<H', data, pos + 18)[0]][1]:
+                        if n in kept:
+                            out.write(data[pos:end])
+                            n_written += 1
+                        n += 1
+        return n_written
+    with open(in_file, 'r') as inFile, BlockWriter(out_file, compress, append = False) as out:
+        for lines in iter(lambda: inFile.readlines(FASTQ_CHUNK_SIZE), []):
+            for line in lines:
+                if line[0] == '@':
+                    out.write(line)
+                    continue
+                if line[0] == '\n':
+                    continue
+                if wanted[line.split('\t', 2)[1]][1]:
+                    if n in kept:
+                        out.write(line)
+                        n_written += 1
+                    n += 1
+    return n_written
+
+############################### SORT-MERGE JOIN ###############################
+
+# DBR_Filter(engine = 'sortmerge') never builds an {ID: DBR} lookup. The SAM records are sorted by encoded
+# Illumina ID in bounded runs on disk and merged against the DBRs, which a binary dictionary already stores in ID
+# order; sorted_DBR_dict makes such a dictionary from a FASTQ file the same way, so neither side is ever held in
+# memory.
+SORT_RUN_SIZE = 500000 # lines sorted in memory per run
+_NO_KEY = 'x'*16 # sorts after every hex key: names that aren't Illumina IDs never match a DBR
+
+def _sort_key(ID):
+    try:
+        return '%016x' % encode_ID(ID)
+    except ValueError:
+        return _NO_KEY
+
+def external_sort(lines, tmp_dir, run_size = SORT_RUN_SIZE):
+    '''
+    sort an iterator of lines through sorted runs of at most run_size lines in tmp_dir. every line comes back ending
+    in a single '\n', whatever it ended with before (so a last line with no newline can't run into the next one).
+    the runs are all written before this returns; the returned iterator merges them
+    '''
+    runs = []
+    for run in iter(lambda: [line.rstrip('\r\n') + '\n' for line in itertools.islice(lines, run_size)], []):
+        run.sort()
+        fd, run_file = tempfile.mkstemp(suffix = '.run', dir = tmp_dir)
+        with os.fdopen(fd, 'w') as fp:
+            fp.writelines(run)
+        runs.append(run_file)
+    run = None
+    return _merge_runs(runs)
+
+def _merge_runs(runs):
+    files = [open(run_file, 'r') for run_file in runs]
+    try:
+        for line in heapq.merge(*files):
+            yield line
+    finally:
+        for f in files:
+            f.close()
+
+def dict_SAM(sam_file, dbr, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE, partition = None):
+    '''
+    (QNAME, RNAME, SEQ, QUAL, DBR, n) for each selected read of a SAM or BAM file (see iter_SAM), in file order,
+    looking each DBR up in dbr
+    '''
+    for QNAME, RNAME, SEQ, QUAL, n in iter_alignments(sam_file, flag_include, flag_exclude, partition):
+        yield QNAME, RNAME, SEQ, QUAL, dbr.get(QNAME), n
+
+def sort_merge_SAM(sam_file, dbr_items, tmp_dir = None, run_size = SORT_RUN_SIZE, flag_include = 0, flag_exclude = SAM_FLAG_EXCLUDE, partition = None):
+    '''
+    (QNAME, RNAME, SEQ, QUAL, DBR, n) for each selected read of a SAM or BAM file (see iter_SAM), in Illumina ID order,
+    found by merging the reads against dbr_items, an iterator of (encoded ID, DBR) pairs in ID order
+    '''
+    sort_dir = tempfile.mkdtemp(prefix = 'DBR_sort_', dir = tmp_dir)
+    try:
+        keyed_reads = ('%s\t%s\t%s\t%s\t%s\t%d\n' % ((_sort_key(read[0]),) + read) for read in iter_alignments(sam_file, flag_include, flag_exclude, partition))
+        reads = external_sort(keyed_reads, sort_dir, run_size)
+        dbr_key, tag = next(dbr_items, (None, None))
+        for read in reads:
+            key, QNAME, RNAME, SEQ, QUAL, n = read[:-1].split('\t')
+            n = int(n)
+            if key == _NO_KEY:
+                yield QNAME, RNAME, SEQ, QUAL, None, n
+                continue
+            key = int(key, 16)
+            while dbr_key is not None and dbr_key < key:
+                dbr_key, tag = next(dbr_items, (None, None))
+            # several alignments of one read share the ID, so the DBR stream only moves on once the reads do
+            yield QNAME, RNAME, SEQ, QUAL, tag if dbr_key == key else None, n
+    finally:
+        shutil.rmtree(sort_dir, ignore_errors = True)
+
+@contextmanager
+def sorted_DBRdictionary(dict_in):
+    '''
+    open a DBR dictionary made by DBR_dict as an iterator of (encoded ID, DBR) pairs in ID order.
+    binary dictionaries (and sharded binary dictionaries) are read straight from the file; JSON ones have to be
+    loaded and sorted, so use saveType = 'dbr' or sorted_DBR_dict to keep the join in bounded memory
+    '''
+    if is_DBRdictionary_sharded(dict_in) or is_DBRdictionary_binary(dict_in):
+        with open_DBRdictionary(dict_in) as dbr:
+            if isinstance(dbr, ShardedDBRDictionary):
+                yield heapq.merge(*[table.iterkeyed() for table in dbr.tables()])
+            elif isinstance(dbr, DBRDictionary):
+                yield dbr.iterkeyed()
+            else:
+                yield _sorted_DBR_items(dbr)
+    else:
+        with open(dict_in, 'r') as f:
+            yield _sorted_DBR_items(json.load(f))
+
+def _sorted_DBR_items(dbr):
+    items = []
+    for ID, tag in dbr.iteritems():
+        key = _sort_key(ID)
+        if key != _NO_KEY:
+            items.append((int(key, 16), tag))
+    items.sort()
+    return iter(items)
+
+def sorted_DBR_dict(in_dir, in_file, dbr_start, dbr_stop, save, tmp_dir = None, run_size = SORT_RUN_SIZE):
+    '''
+    write the binary {ID: DBR} dictionary for a FASTQ file by external sort, never holding it in memory
+    '''
+    input = os.path.join(in_dir, in_file)
+    if not checkFile(input):
+        raise IOError("where is the input file: %s" % in_file)
+    if not os.path.exists(save):
+        os.makedirs(save)
+    fq_dbr_out = os.path.join(save, os.path.splitext(in_file)[0] + DBR_EXTENSION)
+    sort_dir = tempfile.mkdtemp(prefix = 'DBR_sort_', dir = tmp_dir)
+    try:
+        window = DBR_slice(dbr_start, dbr_stop)
+        def keyed_DBRs():
+            # the record number breaks ties, so the reads of a repeated ID stay in file order
+            n_record = 0
+            for batch in _whole_fastq_batches(input):
+                IDs = illumina_IDs([record[0] for record in batch])
+                for ID, record in itertools.izip(IDs, batch):
+                    yield '%016x\t%012x\t%s\n' % (encode_ID(ID), n_record, record[1][window])
+                    n_record += 1
+        # the keys go straight into the dictionary; the DBRs wait in a side file until the longest one is known
+        print 'Writing dictionary to ' + fq_dbr_out
+        n = 0
+        dbr_len = 0
+        keys = []
+        try:
+            with open(fq_dbr_out + '.tmp', 'wb') as fp, open(os.path.join(sort_dir, 'tags'), 'w+') as tags:
+                fp.write(DBR_HEADER.pack(DBR_MAGIC, DBR_VERSION, 0, 0))
+                last = None
+                for line in itertools.chain(external_sort(keyed_DBRs(), sort_dir, run_size), [None]):
+                    # a repeated ID keeps the DBR of its last read, as the dictionary built by DBR_dict does
+                    if last is not None and (line is None or line[:16] != last[:16]):
+                        keys.append(int(last[:16], 16))
+                        if len(keys) == 65536:
+                            fp.write(struct.pack('>%dQ' % len(keys), *keys))
+                            keys = []
+                        tag = last[30:]
+                        tags.write(tag)
+                        dbr_len = max(dbr_len, len(tag) - 1)
+                        n += 1
+                    last = line
+                fp.write(struct.pack('>%dQ' % len(keys), *keys))
+                tags.seek(0)
+                for chunk in iter(lambda: list(itertools.islice(tags, 65536)), []):
+                    fp.write(''.join(pack_DBR(tag[:-1], dbr_len) for tag in chunk))
+                fp.seek(0)
+                fp.write(DBR_HEADER.pack(DBR_MAGIC, DBR_VERSION, dbr_len, n))
+        except:
+            if os.path.exists(fq_dbr_out + '.tmp'):
+                os.remove(fq_dbr_out + '.tmp')
+            raise
+        os.rename(fq_dbr_out + '.tmp', fq_dbr_out)
+    finally:
+        shutil.rmtree(sort_dir, ignore_errors = True)
+    return fq_dbr_out
+
+def sam_IDs(sam_file):
+    '''
+    set of the Illumina IDs of all reads in a SAM file
+    '''
+    IDs = set()
+    if is_BAM(sam_file):
+        IDs.update(read[0] for read in iter_BAM(sam_file, 0, 0))
+        return IDs
+    with open(sam_file, 'r') as inFile:
+        for lines in iter(lambda: inFile.readlines(FASTQ_CHUNK_SIZE), []):
+            IDs.update(illumina_IDs([line.split('\t', 1)[0] for line in lines if not line.startswith('@')]))
+    return IDs
+
+# DBR dictionaries already opened by this process, for parallel_DBR_Filter's shared dictionary mode
+_shared_DBRdictionaries = {}
+
+@contextmanager
+def shared_DBRdictionary(dict_in):
+    '''
+    like open_DBRdictionary, but each dictionary is opened once per process and kept open for later SAM files.
+    the shards of a sharded binary dictionary are mapped as lookups reach them
+    '''
+    if dict_in not in _shared_DBRdictionaries:
+        _shared_DBRdictionaries[dict_in] = load_DBRdictionary(dict_in, lazy = True)
+    yield _shared_DBRdictionaries[dict_in]
+
+def share_DBRdictionaries(file_list, dict_dir, sample_regex):
+    '''
+    convert the JSON dictionaries matched by the SAM files in file_list to binary dictionaries, once, so that
+    every worker memory-maps the same read-only pages instead of parsing its own copy
+    '''
+    converted = {}
+    for in_file in file_list:
+        dict_in = find_DBRdictionary(find_SampleID(in_file, sample_regex), dict_dir)
+        if not dict_in or dict_in in converted or is_DBRdictionary_sharded(dict_in) or is_DBRdictionary_binary(dict_in):
+            continue
+        # find_DBRdictionary prefers this from now on, for as long as its checkpoint shows the JSON is unchanged
+        dict_out = os.path.splitext(dict_in)[0] + DBR_EXTENSION
+        print 'Converting DBR dictionary ' + dict_in + ' to ' + dict_out
+        source = {'inputs': {dict_in: file_fingerprint(dict_in)}, 'settings': {}} # before it is read
+        with open(dict_in, 'r') as f:
+            dbr = json.load(f)
+        try:
+            write_DBRdictionary(dbr, dict_out) # which leaves no partial file behind if it fails
+        except ValueError as e: # IDs or DBRs that don't encode; leave the workers to load the JSON
+            print 'Could not convert %s: %s' % (dict_in, e)
+        else:
+            write_checkpoint(dict_out, source)
+            converted[dict_in] = dict_out
+        dbr = None
+    return converted
+
+################################# CHECKPOINTS #################################
+
+# DBR_Filter can be rerun after a crash, or with more SAM/BAM files, without redoing finished work or writing any read
+# twice. Each file it writes (the kept reads of one SAM/BAM file, or of one part of it, or its kept alignments) is
+# renamed into place only once complete, next to a checkpoint recording the fingerprints of the SAM/BAM file and DBR
+# dictionary it was made from, the settings that decide its contents and the counts for the logfile. A rerun skips
+# the files whose checkpoint still matches. A sample's FASTQ file is rebuilt from the finished parts of its SAM/BAM
+# files (kept in DBR_filtered_parts/<sample ID>/) rather than appended to. The parts are kept after the FASTQ file is
+# written, at the cost of their disk space, since a rerun that adds, changes or removes one SAM/BAM file rebuilds
+# the sample from the parts of the others.
+CHECKPOINT_EXTENSION = '.done.json'
+PARTS_DIR = 'DBR_filtered_parts'
+
+def dictionary_fingerprints(dict_in):
+    '''
+    {file: fingerprint} for a DBR dictionary: the manifest and every shard of a sharded one, whose directory's own
+    size and mtime don't change with its contents
+    '''
+    if is_DBRdictionary_sharded(dict_in):
+        files = [os.path.join(dict_in, f) for f in [SHARD_MANIFEST] + sorted(read_shard_manifest(dict_in)['shards'].values())]
+    else:
+        files = [dict_in]
+    return dict((f, file_fingerprint(f)) for f in files)
+
+def write_checkpoint(out_file, record):
+    write_json(dict(record, output = file_fingerprint(out_file)), out_file + CHECKPOINT_EXTENSION)
+
+def read_checkpoint(out_file):
+    try:
+        with open(out_file + CHECKPOINT_EXTENSION, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError): # none yet, or unreadable: the file is made again
+        return None
+
+def valid_checkpoint(out_file, record):
+    '''
+    the checkpoint of out_file if out_file is intact and was made from the same inputs, with the same settings, as
+    record ({'inputs': {path: fingerprint}, 'settings': {...}}); otherwise None
+    '''
+    saved = read_checkpoint(out_file)
+    if not saved or saved['settings'] != record['settings'] or sorted(saved['inputs']) != sorted(record['inputs']):
+        return None
+    if not all(file_unchanged(in_file, fingerprint) for in_file, fingerprint in saved['inputs'].iteritems()):
+        return None
+    if not file_unchanged(out_file, saved['output']):
+        return None
+    return saved
+
+def assemble_parts(out_file, parts_dir, settings, in_files):
+    '''
+    replace out_file with the finished parts in parts_dir that were written with settings from one of in_files (the
+    SAM/BAM files being filtered now), one after another. parts left by files since removed or replaced are ignored
+    '''
+    in_files = set(in_files)
+    with open(parts_dir + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # parts finishing at once take turns, so the last rebuild includes them all
+        with BlockWriter(out_file, append = False) as out: # compressed parts are whole gzip members or BGZF runs
+            for part in sorted(os.listdir(parts_dir)):
+                part = os.path.join(parts_dir, part)
+                saved = read_checkpoint(part)
+                if not saved or saved['settings'] != settings or not file_unchanged(part, saved['output']):
+                    continue
+                if not in_files.intersection(saved['inputs']):
+                    continue
+                with open(part, 'rb') as f:
+                    for block in iter(lambda: f.read(FASTQ_CHUNK_SIZE), ''):
+                        out.write(block)
+
+def assemble_sample(out_dir, sampleID, assembled_dir, settings):
+    # rebuild the sample's FASTQ file from the parts of the SAM/BAM files in assembled_dir
+    out_seqs_final = out_dir + '/DBR_filtered_sequences_' + sampleID + '.fastq'
+    if settings['out_compress']:
+        out_seqs_final += '.gz'
+    print 'Writing kept reads to ' + out_seqs_final
+    in_files = [os.path.join(assembled_dir, f) for f in alignment_files(os.listdir(assembled_dir))]
+    assemble_parts(out_seqs_final, os.path.join(out_dir, PARTS_DIR, sampleID), settings, in_files)
+
+def finish_DBR_Filter(logfile, sampleID, path, out_dir, total_removed, n_primary, record, kept = None, skipped = False, assemble = True):
+    '''
+    the last of DBR_Filter for one SAM/BAM file: rebuild the sample's FASTQ file from its parts (unless assemble is
+    False, as for all but the last file of a sample in parallel_DBR_Filter), or write the alignments in kept (a
+    KeptAlignments, for out_format = 'alignments'), then add the file's row to the logfile unless it was skipped as
+    already done
+    '''
+    settings = record['settings']
+    if skipped:
+        print 'Skipping ' + path + ', which is already filtered.'
+    if settings['out_format'] == 'fastq':
+        if assemble:
+            assemble_sample(out_dir, sampleID, os.path.dirname(path), settings)
+    elif not skipped:
+        out_alignments = alignments_out(path, out_dir, settings['out_compress'])
+        print 'Writing kept alignments to ' + out_alignments
+        write_alignments(path, out_alignments, kept, settings['flag_include'], settings['flag_exclude'], settings['out_compress'])
+        write_checkpoint(out_alignments, dict(record, removed = total_removed, primary = n_primary))
+    if skipped:
+        return
+    with open(logfile,'a') as log:
+        log.write(sampleID+','+str(total_removed)+','+str(n_primary)+','+time.strftime("%d/%m/%Y")+','+(time.strftime("%H:%M:%S"))+'\n')
+    print 'Removed ' + str(total_removed) + ' PCR duplicates out of ' + str(n_primary) + ' primary mapped reads.'
+
 def parallel_DBR_Filter(assembled_dir, # the SAM files for the data mapped to pseudoreference
                out_dir, # the output file, full path, ending with .fasta
                n_expected, # the number of differences to be tolerated
@@ -346,7 +2468,18 @@ def parallel_DBR_Filter(assembled_dir, # the SAM files for the data mapped to ps
                sam_list = None, # optional text file containing names of files for which to make DBR dicts
                test_dict=True, # optionally print testing info to stdout for checking the dictionary construction
                phred_dict=phred_dict, # dictionary containing ASCII quality filter scores to help with tie breaks
-               samMapLen=None): # expected sequence length will help when primary reads are still not perfectly aligned with reference
+               samMapLen=None, # expected sequence length will help when primary reads are still not perfectly aligned with reference
+               shared_dict=False, # convert JSON dictionaries to binary once and keep them mapped in each worker between SAM files
+               engine='dict', # 'dict' looks each read's DBR up in the dictionary; 'sortmerge' joins them by sorting instead
+               tmp_dir=None, # where 'sortmerge' writes its sorted runs (local disk is best)
+               streaming=False, # SAM files are sorted by coordinate or grouped by RNAME, so filter and free one locus at a time
+               qual_metric='median', # how tie breaks rank reads: 'median', 'mean' or 'expected_errors' (see QUAL_METRICS)
+               columnar=False, # resolve duplicates for the whole sample at once with array operations (NumPy, if installed)
+               flag_include=0, # only use reads with all of these FLAG bits set (as samtools view -f)
+               flag_exclude=SAM_FLAG_EXCLUDE, # and none of these (as samtools view -F); the default keeps primary mapped reads on either strand
+               out_compress=None, # None writes plain FASTQ; 'gzip' or 'bgzf' compress it as it is written (the file name gains .gz)
+               out_format='fastq', # 'fastq' writes the kept reads of each sample to one FASTQ file; 'alignments' copies the kept records of each SAM/BAM file
+               partitions=1): # split each SAM file's loci into this many parts, filtered in parallel, so one deep sample can use every process
     file_list = []
     
     ## untested ##
@@ -355,14 +2488,20 @@ def parallel_DBR_Filter(assembled_dir, # the SAM files for the data mapped to ps
             for line in fl:
                 file_list.append(line)
     else:
-        for i in os.listdir(assembled_dir):
+        for i in alignment_files(os.listdir(assembled_dir)): # one of X.sam, X.bam and X.sorted.bam
             if 'unmatched' not in i: # skip the SAM files with sequences that didn't match
                 file_list.append(i)
     #print file_list
+    if shared_dict:
+        share_DBRdictionaries(file_list, dict_dir, sample_regex)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
     pool = mp.Pool(processes=num_threads)
     
-    for in_file in file_list:
-        pool.apply_async(DBR_Filter, args=(assembled_dir, # the SAM files for the data mapped to pseudoreference
+    jobs = [] # (size, name, function, args); the name of each part of a partitioned file is (file name, part)
+    for in_file, partition in itertools.product(file_list, [(i, partitions) for i in xrange(partitions)] if partitions > 1 else [None]):
+        jobs.append((os.path.getsize(os.path.join(assembled_dir, in_file)), (in_file, partition[0]) if partition else in_file, DBR_Filter,
+              (assembled_dir, # the SAM files for the data mapped to pseudoreference
                in_file, # the input file name
                out_dir, # the output file, full path, ending with .fasta
                n_expected, # the number of differences to be tolerated
@@ -371,10 +2510,49 @@ def parallel_DBR_Filter(assembled_dir, # the SAM files for the data mapped to ps
                sample_regex, # regular expression to find the sample ID
                test_dict, # optionally print testing info to stdout for checking the dictionary construction
                phred_dict, # dictionary containing ASCII quality filter scores to help with tie breaks
-               samMapLen)) 
+               samMapLen,
+               shared_dict,
+               engine,
+               tmp_dir,
+               streaming,
+               qual_metric,
+               columnar,
+               flag_include,
+               flag_exclude,
+               out_compress,
+               out_format,
+               partition,
+               False)))
     
-    pool.close()
-    pool.join()     
+    # add up the parts of each file as they come in, then write its kept alignments and logfile row; each sample's
+    # FASTQ file is rebuilt once, after the last of its files
+    parts = defaultdict(list)
+    files_left = defaultdict(int) # sample ID -> files not yet finished
+    for in_file in file_list:
+        files_left[find_SampleID(in_file, sample_regex)] += 1
+    try:
+        for name, result in schedule_jobs(pool, jobs):
+            in_file = name[0] if isinstance(name, tuple) else name
+            parts[in_file].append(result)
+            if len(parts[in_file]) < partitions:
+                continue
+            results = parts.pop(in_file)
+            sampleID = find_SampleID(in_file, sample_regex)
+            files_left[sampleID] -= 1
+            if None in results: # no sample ID or DBR dictionary
+                continue
+            skipped = all(result[4] for result in results)
+            kept = None
+            if out_format == 'alignments' and not skipped:
+                kept = KeptAlignments()
+                for result in results:
+                    if result[2] is not None:
+                        kept.update(result[2])
+            finish_DBR_Filter(out_dir + '/DBR_filtered_sequences_logfile.csv', sampleID, os.path.join(assembled_dir, in_file), out_dir,
+                              sum(result[0] for result in results), sum(result[1] for result in results), results[0][3], kept, skipped,
+                              assemble = not files_left[sampleID])
+    finally:
+        pool.join()
     
     #for dP in dbrProcess:
     #    dP.start()
@@ -390,7 +2568,19 @@ def DBR_Filter(assembled_dir, # the SAM files for the data mapped to pseudorefer
                sample_regex, # regular expression to find the sample ID
                test_dict=True, # optionally print testing info to stdout for checking the dictionary construction
                phred_dict=phred_dict, # dictionary containing ASCII quality filter scores to help with tie breaks
-               samMapLen=None): # expected sequence length will help when primary reads are still not perfectly aligned with reference
+               samMapLen=None, # expected sequence length will help when primary reads are still not perfectly aligned with reference
+               shared_dict=False, # keep the dictionary open in this process for the next SAM file from the same library
+               engine='dict', # 'dict' looks each read's DBR up in the dictionary; 'sortmerge' joins them by sorting instead
+               tmp_dir=None, # where 'sortmerge' writes its sorted runs (local disk is best)
+               streaming=False, # SAM file is sorted by coordinate or grouped by RNAME, so filter and free one locus at a time
+               qual_metric='median', # how tie breaks rank reads: 'median', 'mean' or 'expected_errors' (see QUAL_METRICS)
+               columnar=False, # resolve duplicates for the whole sample at once with array operations (NumPy, if installed)
+               flag_include=0, # only use reads with all of these FLAG bits set (as samtools view -f)
+               flag_exclude=SAM_FLAG_EXCLUDE, # and none of these (as samtools view -F); the default keeps primary mapped reads on either strand
+               out_compress=None, # None writes plain FASTQ; 'gzip' or 'bgzf' compress it as it is written (the file name gains .gz)
+               out_format='fastq', # 'fastq' writes the kept reads of each sample to one FASTQ file; 'alignments' copies the kept records of each SAM/BAM file
+               partition=None, # (i, k): only filter the loci in part i of k (see locus_partition), returning the counts, kept reads, checkpoint record and whether it was skipped instead of logging them
+               finish=True): # False returns them for a whole file too, for parallel_DBR_Filter to finish each sample once
                
     #pdb.set_trace()
     #logfile = os.path.splitext(out_seqs)[0] + '_logfile.csv'
@@ -411,151 +2601,142 @@ def DBR_Filter(assembled_dir, # the SAM files for the data mapped to pseudorefer
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
     
-        out_seqs_final = out_dir + '/DBR_filtered_sequences_' + sampleID + '.fastq'
+        if out_format not in ('fastq', 'alignments'):
+            raise ValueError("Output format specified as %s. Options are 'fastq' or 'alignments'." % out_format)
     
-        with open(out_seqs_final, 'a') as out_file:
+        path=os.path.join(assembled_dir, in_file)
+        
+        # the kept reads go to this file's part of the sample's FASTQ file (see CHECKPOINTS), which is skipped if
+        # an earlier run already made it from the same SAM file and dictionary with the same settings
+        settings = {'n_expected': n_expected, 'samMapLen': samMapLen, 'qual_metric': qual_metric, 'flag_include': flag_include,
+                    'flag_exclude': flag_exclude, 'out_compress': out_compress, 'out_format': out_format, 'partitions': partition[1] if partition else 1}
+        inputs = dictionary_fingerprints(dict_in)
+        inputs[path] = file_fingerprint(path)
+        record = {'inputs': inputs, 'settings': settings}
+        if out_format == 'fastq':
+            parts_dir = os.path.join(out_dir, PARTS_DIR, sampleID)
+            if not os.path.exists(parts_dir):
+                try:
+                    os.makedirs(parts_dir)
+                except OSError: # made by another process in the meantime
+                    pass
+            out_part = os.path.join(parts_dir, in_file + ('.part%dof%d' % partition if partition else '') + '.fastq' + ('.gz' if out_compress else ''))
+        else:
+            out_part = alignments_out(path, out_dir, out_compress)
+        saved = valid_checkpoint(out_part, record)
+        if saved:
+            if partition is not None or not finish:
+                return saved['removed'], saved['primary'], None, record, True
+            finish_DBR_Filter(logfile, sampleID, path, out_dir, saved['removed'], saved['primary'], record, skipped = True)
+            return
+        
+        # a sharded dictionary only needs the shards (and entries) for the reads in this SAM file. JSON shards can't
+        # be shared without loading every one of them whole, so they are always loaded this way
+        if is_DBRdictionary_sharded(dict_in) and shared_dict and read_shard_manifest(dict_in)['saveType'] != 'dbr':
+            shared_dict = False
+        if is_DBRdictionary_sharded(dict_in) and not shared_dict and engine == 'dict':
+            print 'Scanning read names in ' + path
+            sam_reads = sam_IDs(path)
+        else:
+            sam_reads = None
+    
+        # for 'alignments', note which reads are kept and copy their records from the input afterwards
+        with (FastqWriter(out_part, out_compress, append = False) if out_format == 'fastq' else KeptAlignments()) as out_file:
     
             print 'Opening DBR dictionary ' + dict_in  
-            with open(dict_in, 'r') as f:
-                dbr = json.load(f)
+            if engine == 'sortmerge':
+                dbr_opened = sorted_DBRdictionary(dict_in)
+                if streaming: # the merge hands back reads in Illumina ID order, not grouped by locus
+                    raise ValueError("streaming needs the reads in SAM file order; it can't be used with engine = 'sortmerge'.")
+            elif engine != 'dict':
+                raise ValueError("Filtering engine specified as %s. Options are 'dict' or 'sortmerge'." % engine)
+            elif shared_dict:
+                dbr_opened = shared_DBRdictionary(dict_in)
+            else:
+                dbr_opened = open_DBRdictionary(dict_in, sam_reads)
+            with dbr_opened as dbr:
                 
-                # initialize an empty dictionary with each iteration of the for-loop
-                assembly_dict_2 = {}
-                assembly_dict_3 = defaultdict(list)
+                # initialize an empty read store with each iteration of the for-loop
+                if columnar:
+                    if streaming:
+                        raise ValueError("columnar resolves the whole sample at once; it can't be used with streaming.")
+                    assembly_reads = ColumnarReads()
+                else:
+                    assembly_reads = LocusReads()
                 
                 # print some info to track progress
-                path=os.path.join(assembled_dir, in_file)
                 print 'Creating filtering dictionaries from ' + path
                 
-                # start counter for the number of primary reads
+                # start counters for the number of primary reads and the number removed
                 n_primary = 0
+                total_removed = 0
+                
+                # when streaming, the locus being collected and the loci already written out
+                locus = None
+                finished = set()
                 
                 delete_list = []
                 keep_list = []
                 
-                # open the sam file and process its contents
-                with open(path, 'r') as inFile:
-                    for line in inFile:
-                        if not line.startswith("@"): # ignore the header lines
-                            fields = line.split("\t")
-                            
-                            # extract the info for the dictionary for each line
-                            QNAME = re.split('(\d[:|_]\d+[:|_]\d+[:|_]\d+)', fields[0])[1] # FASTQ ID = QNAME column in sam file
-                            FLAG = fields[1] # bitwise flag with map info; == 0 if primary read
-                            RNAME = fields[2] # ref sequence name -- where did the sequence map?
-                            POS = fields[3] # position of map
-                            MAPQ = fields[4] # mapping quality
-                            CIGAR = fields[5] # additional mapping info
-                            SEQ = fields[9] # the actual sequence
-                            QUAL = fields[10] # sequence quality score
-                            
-                            # A MORE GENERAL SOLUTION THAT SHOULD WORK FOR A VARIETY OF CIRCUMSTANCES:
-                            # bitwise FLAG == 0 means that the read is the PRIMARY READ. There will only be one of these per sequence, so only mapped primary reads should be considered.
-                            if FLAG == '0':
-                                
-                                dbr_value = dbr.get(QNAME) 
-                                
-                                if samMapLen:
-                                    if len(SEQ) == samMapLen: #if we specify an expected sequence length in the samfile
-                                        # tally the new primary read
-                                        #n_primary += 1
-                                    
-                                        # WE NEED TWO DICTIONARIES TO REPRESENT ALL THE RELATIONSHIP BETWEEN RNAME, QNAME, dbr_value, QUAL, AND count
-                                        # build a dictionary with structure {DBR: (locus: count)}                    
-                                        if RNAME in assembly_dict_2:
-                                            if dbr_value in assembly_dict_2.get(RNAME):
-                                                assembly_dict_2[RNAME][dbr_value]=assembly_dict_2[RNAME][dbr_value]+1
-                                            else:
-                                                assembly_dict_2.setdefault(RNAME, {})[dbr_value]=1
-                                        else:
-                                            assembly_dict_2.setdefault(RNAME, {})[dbr_value]=1 # add the new DBR and its associated locus and count
+                # open the sam file and process its contents, with each read's DBR attached;
+                # only the reads selected by flag_include and flag_exclude (by default, the primary mapped reads) are considered
+                if engine == 'sortmerge':
+                    reads = sort_merge_SAM(path, dbr, tmp_dir, flag_include = flag_include, flag_exclude = flag_exclude, partition = partition)
+                else:
+                    reads = dict_SAM(path, dbr, flag_include, flag_exclude, partition)
+                with closing(reads):
+                    for QNAME, RNAME, SEQ, QUAL, dbr_value, n in reads:
                         
-                                        # build a dictionary with structure {RNAME: {DBR:[[QNAME, QUAL]]}}        
-                                        if RNAME in assembly_dict_3:
-                                            if dbr_value in assembly_dict_3.get(RNAME):
-                                                assembly_dict_3[RNAME][dbr_value].append([QNAME, QUAL, SEQ])
-                                            else:
-                                                assembly_dict_3.setdefault(RNAME, {})[dbr_value]=[[QNAME, QUAL, SEQ]]
-                                        else:
-                                            assembly_dict_3.setdefault(RNAME, {})[dbr_value]=[[QNAME, QUAL, SEQ]]
-                                        # tally the new primary read
-                                        n_primary += 1
-                                        
-                                else: #if we're not using stacks to re-assemble and we don't care about expected lengths...
-                                    
-                                    # WE NEED TWO DICTIONARIES TO REPRESENT ALL THE RELATIONSHIP BETWEEN RNAME, QNAME, dbr_value, QUAL, AND count
-                                    # build a dictionary with structure {DBR: (locus: count)}                    
-                                    if RNAME in assembly_dict_2:
-                                        if dbr_value in assembly_dict_2.get(RNAME):
-                                            assembly_dict_2[RNAME][dbr_value]=assembly_dict_2[RNAME][dbr_value]+1
-                                        else:
-                                            assembly_dict_2.setdefault(RNAME, {})[dbr_value]=1
-                                    else:
-                                        assembly_dict_2.setdefault(RNAME, {})[dbr_value]=1 # add the new DBR and its associated locus and count
-                    
-                                    # build a dictionary with structure {RNAME: {DBR:[[QNAME, QUAL]]}}        
-                                    if RNAME in assembly_dict_3:
-                                        if dbr_value in assembly_dict_3.get(RNAME):
-                                            assembly_dict_3[RNAME][dbr_value].append([QNAME, QUAL, SEQ])
-                                        else:
-                                            assembly_dict_3.setdefault(RNAME, {})[dbr_value]=[[QNAME, QUAL, SEQ]]
-                                    else:
-                                        assembly_dict_3.setdefault(RNAME, {})[dbr_value]=[[QNAME, QUAL, SEQ]]
-                                    # tally the new primary read
-                                    n_primary += 1
+                        # streaming: a new RNAME means the last locus is complete, so filter it, write it out and free it
+                        if streaming and RNAME != locus:
+                            if RNAME in finished:
+                                raise ValueError('%s is not grouped by RNAME: reads mapped to %s appear again after other loci. Sort it by coordinate or run DBR_Filter without streaming.' % (path, RNAME))
+                            done = assembly_reads.pop(locus)
+                            if done and locus != '*':
+                                total_removed += filter_locus(done, n_expected, phred_dict, out_file, qual_metric)
+                            finished.add(locus)
+                            locus = RNAME
                         
+                        # with samMapLen, only reads of the expected length are counted (useful if we're using stacks to re-assemble)
+                        if not samMapLen or len(SEQ) == samMapLen:
+                            # build a store with structure {RNAME: {DBR: [reads]}}; the count of each DBR at a locus is its number of reads
+                            assembly_reads.add(RNAME, dbr_value, QNAME, QUAL, SEQ, n if out_format == 'alignments' else None)
+                            # tally the new primary read
+                            n_primary += 1
+                    
                     # NOW THAT DICTIONARIES ARE MADE, REMOVE DUPLICATE SEQUENCES BASED ON DBR COUNTS
-                    # for each assembled locus, get the associated dbr_value and count
+                    # for each assembled locus (just the last one when streaming), get the associated dbr_value and count
                     print 'Checking DBR counts against expectations.'
-                    total_removed = 0
-                    for RNAME, value in assembly_dict_2.iteritems():
-                        #print 'RNAME', RNAME
-                        # ignore the data where the reference is "unmapped" -- RNAME = '*'
-                        if RNAME != '*':
-                            # get all the DBRs and counts that went into that locus in that sample
-                            for subvalue in value.iteritems():
-                                #print 'Subvalue', subvalue
-                                dbr_value = subvalue[0] 
-                                count = subvalue[1]
-                                qname_qual = assembly_dict_3[RNAME][dbr_value] #this is a list of lists: [[QNAME, QUAL, SEQ], [QNAME, QUAL, SEQ], ...]
-                                if count > n_expected:
-                                    ##################################################
-                                    ## THIS IS WHERE THE FILTERING HAPPENS           #
-                                    ##################################################
-                                    ID_quals = {} # we'll make yet another dictionary to store the QNAME and the median QUAL
-                                    for i in qname_qual:
-                                        id_val=i[0] # this is the QNAME (Illumina ID)
-                                        id_seq=i[2] # the full sequence
-                                        id_qual=i[1] # the full quality
-                                        ID_quals[id_val] = (qual_median(i[1], phred_dict), id_seq, id_qual)
-                                    n_remove = count - n_expected
-                                    total_removed += n_remove
-                                    to_keep = heapq.nlargest(n_expected, ID_quals, key=lambda x:ID_quals[x])
-                                    #to_keep = max(ID_quals, key=lambda x:ID_quals[x]) 
-                                    for k in to_keep:
-                                        keep = ID_quals[k] # get the full data for the highest median sequences
-                                        #write out the data to keep, appending the original barcode to the beginning of the sequence
-                                        out_file.write('@'+k+'\n'+ keep[1]+'\n+\n'+ keep[2]+'\n')
-                                else: # if count <= n_expected, we can just keep every entry associated with that RNAME
-                                    for i in qname_qual:
-                                        out_file.write('@'+i[0]+'\n'+i[2]+'\n+\n'+i[1]+'\n') # see above for i[index] definitions
-                                    
-                    with open(logfile,'a') as log:
-                        log.write(sampleID+','+str(total_removed)+','+str(n_primary)+','+time.strftime("%d/%m/%Y")+','+(time.strftime("%H:%M:%S"))+'\n')
-                        print 'Removed ' + str(total_removed) + ' PCR duplicates out of ' + str(n_primary) + ' primary mapped reads.'                                                    
-                            
+                    if columnar:
+                        total_removed += assembly_reads.resolve(n_expected, out_file, qual_metric, phred_dict)
+                    else:
+                        for RNAME, value in assembly_reads.iteritems():
+                            #print 'RNAME', RNAME
+                            # ignore the data where the reference is "unmapped" -- RNAME = '*'
+                            if RNAME != '*':
+                                total_removed += filter_locus(value, n_expected, phred_dict, out_file, qual_metric)
+                    
                     if test_dict: # check construction by printing first entries to screen
-                        print 'Checking dictionary format (version 3).'
-                        x = itertools.islice(assembly_dict_3.iteritems(), 0, 4)
+                        print 'Checking read store format.'
+                        x = itertools.islice(assembly_reads.iteritems(), 0, 4)
                         for keyX, valueX in x:
                             print keyX, valueX
-                        print 'Checking dictionary format (version 2).'
-                        y = itertools.islice(assembly_dict_2.iteritems(), 0, 4)
+                        print 'Checking DBR counts format.'
+                        y = itertools.islice(assembly_reads.iteritems(), 0, 4)
                         for keyY, valueY in y:
-                            print keyY, valueY
+                            print keyY, dict((dbr_value, len(locus_reads)) for dbr_value, locus_reads in valueY.iteritems())
+
+        if out_format == 'fastq':
+            write_checkpoint(out_part, dict(record, removed = total_removed, primary = n_primary))
+        kept = out_file if out_format == 'alignments' else None
+        # one part of a partitioned file, or a file of a parallel run: parallel_DBR_Filter adds up the parts and finishes the file
+        if partition is not None or not finish:
+            return total_removed, n_primary, kept, record, False
+        finish_DBR_Filter(logfile, sampleID, path, out_dir, total_removed, n_primary, record, kept)
 
 
 #TODO: why does DBR_filter need to write out a single fastq file -- why redo all that demultiplexing??
+# (out_format = 'alignments' keeps the filtered alignments instead, so they don't have to be mapped again)
 '''
 # OTHER METRICS FOR DESCRIBING OVERALL SEQUENCE QUALITY (QUAL = ASCII character string)
 
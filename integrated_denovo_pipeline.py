@@ -38,18 +38,20 @@ import gzip
 import multiprocessing as mp
 from collections import defaultdict
 from collections import Counter
+from collections import deque
 import time
 import pdb
+import tempfile
+import shutil
+import pipes
 import multiprocessing
-from Queue import Queue
-from threading import Thread
+from multiprocessing.pool import ThreadPool
+from assembled_DBR_filtering import open_fastq, iter_fastq, decompress_command, file_fingerprint, file_unchanged, write_json
+from assembled_DBR_filtering import fastq_batches, count_good_bases, trim_batch, trim_batches, BlockWriter, deflate_gzip_member, OUT_COMPRESS_LEVEL
 
 
 ################################## GLOBALS ####################################
 
-# Process queue
-processQueue = Queue()
-
 # paths to executables on cluster (all paths are in ~./bashrc)
 pearPath = 'pear-0.9.6-bin-64'
 qualityFilter = 'fastq_quality_filter'
@@ -60,9 +62,9 @@ stacks_executables = '/home/pierce/bin/stacks-1.35/' # this is where ustacks liv
 BWA = 'bwa'
 samtoolsPath = 'samtools'
 bcftoolsPath = 'bcftools'
-phred_dict = {'"':1.0,"#":2.0,"$":3.0,"%":4.0,"&":5.0,"'":6.0,"(":7.0,")":8.0,"*":9.0,"+":10.0,
+phred_dict = {"!":0.0,'"':1.0,"#":2.0,"$":3.0,"%":4.0,"&":5.0,"'":6.0,"(":7.0,")":8.0,"*":9.0,"+":10.0,
               ",":11.0,"-":12.0,".":13.0,"/":14.0,"0":15.0,"1":16,"2":17.0,"3":18.0,"4":19.0,"5":20.0,
-              "6":21.0,"7":22.0,"8":23.0,"9":24.0,":":25.0,";":26,"<":27.0,"+":28.0,">":29.0,"?":30.0,
+              "6":21.0,"7":22.0,"8":23.0,"9":24.0,":":25.0,";":26,"<":27.0,"=":28.0,">":29.0,"?":30.0,
               "@":31.0,"A":32.0,"B":33.0,"C":34.0,"D":35.0,"E":36,"F":37.0,"G":38.0,"H":39.0,"I":40.0,
               "J":41.0,"K":42.0}
 # conversion reference: http://drive5.com/usearch/manual/quality_score.html
@@ -87,30 +89,253 @@ phred_dict = {'"':1.0,"#":2.0,"$":3.0,"%":4.0,"&":5.0,"'":6.0,"(":7.0,")":8.0,"*
 #               out_seqs = '/path/to/filtered_library1.fastq',
 #               n_expected = 2)
 
-## Parallelization things from Joe
-class Work():
-    def __init__(self, commandline, shell, cwd = os.getcwd(), libraryPath = None, analysisFile = None):
+def wait_pipe(*stages):
+    '''
+    wait for the processes of a shell pipe, given as (command line, Popen) from first to last, and raise a
+    CalledProcessError for the last one that failed: a stage that dies takes the ones feeding it down with a broken
+    pipe, so the failure furthest downstream is the one that matters
+    '''
+    failed = None
+    for commandline, process in stages:
+        code = process.wait()
+        if code != 0:
+            failed = subprocess.CalledProcessError(code, commandline)
+    if failed:
+        raise failed
+
+############################## STAGE SCHEDULING ###############################
+
+# A run of the pipeline is a DAG of Steps, one per sample per stage. A step starts once the steps that make its
+# inputs (or that it is told to wait for) have finished and its inputs exist, and only while the threads it declares
+# fit within a node-wide CPU budget alongside the steps already running, so that tools with threads of their own
+# (bwa mem -t, samtools -@) don't oversubscribe the node when many samples or libraries are processed at once.
+# Each parallel_* wrapper runs the steps made by a *_steps function (qc_steps, quality_filter_steps, ...), which
+# returns them instead, so the steps of several stages can be run as one DAG.
+CPU_BUDGET = multiprocessing.cpu_count()
+POLL_INTERVAL = 0.2 # seconds between checks on running steps
+
+# Given a run manifest (a JSON file), run_pipeline records each step that finishes: its command, the fingerprints
+# of its inputs and md5 checksums of its outputs. On a rerun, a step whose command is unchanged and whose inputs and
+# outputs still match the manifest is marked done without running, so a crashed run picks up where it stopped.
+# Files are compared by size and mtime, or by checksum once the mtime has changed, so a step that is redone and
+# writes exactly what it wrote before doesn't make the steps after it stale. The outputs of a failed step are
+# removed, so a half-written file is never mistaken for a finished one. Steps that declare no outputs always run.
+MANIFEST_HASH_THREADS = 2 # outputs are checksummed in the background while later steps run
+
+class Step(object):
+    '''
+    one node of a pipeline DAG: a shell command line, or a Python function called with args in a process of its own
+    '''
+    def __init__(self, name, commandline = None, inputs = (), outputs = (), threads = 1, function = None, args = (), after = (), cwd = None):
+        if (commandline is None) == (function is None):
+            raise ValueError('Step %s needs either a command line or a function.' % name)
+        self.name = name
         self.commandline = commandline
-        # probably do not need this libraryPath code... for Joe's dynamically loaded libraries with duplicate names
-        if libraryPath is not None:
-            self.env = os.environ.copy()
-            self.env["LD_LIBRARY_PATH"] = "%s:%s" % (libraryPath, self.env["LD_LIBRARY_PATH"])
+        self.function = function
+        self.args = args
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.threads = threads
+        self.after = list(after) # names of other steps to wait for, besides the ones that make the inputs
+        self.cwd = cwd
+        self.status = 'waiting' # then 'running', and 'done', 'failed' or 'skipped' (after a failure upstream)
+        self.seconds = None
+        self._process = None
+
+    def start(self):
+        self._started = time.time()
+        if self.commandline is not None:
+            self._process = Popen(self.commandline, shell = True, cwd = self.cwd)
         else:
-            self.env = os.environ.copy()
-            self.shell = shell
-            self.cwd = cwd
-
-def worker():
-    'run subprocesses in an orderly fashion'
-    while True:
-        workItem = processQueue.get()
-        if workItem.commandline != None:
-            p = Popen(workItem.commandline,
-                      env = workItem.env,
-                      shell = workItem.shell,
-                      cwd = workItem.cwd)
-            p.wait()
-            processQueue.task_done()
+            self._process = mp.Process(target = self.function, args = self.args)
+            self._process.start()
+        self.status = 'running'
+
+    def poll(self):
+        # None while the step runs, then its exit code
+        if self.commandline is not None:
+            code = self._process.poll()
+        elif self._process.is_alive():
+            code = None
+        else:
+            self._process.join()
+            code = self._process.exitcode
+        if code is not None:
+            self.seconds = time.time() - self._started
+        return code
+
+    def terminate(self):
+        if self.status == 'running':
+            self._process.terminate()
+            if self.commandline is not None:
+                self._process.wait()
+            else:
+                self._process.join()
+            self.remove_outputs()
+
+    def remove_outputs(self):
+        for out in self.outputs:
+            if os.path.isfile(out):
+                os.remove(out)
+
+    def command(self):
+        # what the step runs, as recorded in a run manifest
+        if self.commandline is not None:
+            return self.commandline
+        return '%s.%s%r' % (self.function.__module__, self.function.__name__, tuple(self.args))
+
+def load_manifest(manifest):
+    if not os.path.isfile(manifest):
+        return {}
+    try:
+        with open(manifest, 'r') as f:
+            return json.load(f)
+    except ValueError: # an unreadable manifest just means every step runs
+        warnings.warn('Ignoring unreadable run manifest %s' % manifest)
+        return {}
+
+def step_up_to_date(step, record):
+    '''
+    true if record (a step's entry in the run manifest) shows the step already ran with the same command on the
+    same inputs, and its outputs are still as it left them
+    '''
+    if not record or not step.outputs or record['command'] != step.command():
+        return False
+    if sorted(record['inputs']) != sorted(set(map(os.path.abspath, step.inputs))) or sorted(record['outputs']) != sorted(map(os.path.abspath, step.outputs)):
+        return False
+    return all(file_unchanged(p, fingerprint) for p, fingerprint in itertools.chain(record['inputs'].iteritems(), record['outputs'].iteritems()))
+
+def step_record(step, records):
+    '''
+    the run manifest entry of a step that has just finished; the inputs that are (unchanged) outputs of steps in
+    records keep their checksums
+    '''
+    known = dict((p, fingerprint) for record in records.itervalues() for p, fingerprint in record['outputs'].iteritems())
+    inputs = {}
+    for p in set(map(os.path.abspath, step.inputs)):
+        fingerprint = file_fingerprint(p)
+        if p in known and all(known[p][key] == fingerprint[key] for key in ('size', 'mtime')):
+            fingerprint = known[p]
+        inputs[p] = fingerprint
+    return {'command': step.command(), 'inputs': inputs, 'outputs': dict((p, None) for p in map(os.path.abspath, step.outputs))}
+
+def checksum_outputs(record):
+    # run on the hashing threads
+    for p in record['outputs']:
+        record['outputs'][p] = file_fingerprint(p, True)
+    return record
+
+def run_pipeline(steps, cpu_budget = CPU_BUDGET, manifest = None):
+    '''
+    run a list of Steps in dependency order without using more than cpu_budget threads at once; steps that are ready
+    start in the order given, with smaller ones filling in around a step that doesn't fit yet. with a manifest file,
+    steps already done by an earlier run are skipped. raises a RuntimeError naming the steps that failed or couldn't
+    run, once everything that could run has finished
+    '''
+    by_name = {}
+    producers = {}
+    for step in steps:
+        if step.name in by_name:
+            raise ValueError('More than one step is named %s.' % step.name)
+        by_name[step.name] = step
+        for out in step.outputs:
+            if os.path.abspath(out) in producers:
+                raise ValueError('%s is an output of both %s and %s.' % (out, producers[os.path.abspath(out)].name, step.name))
+            producers[os.path.abspath(out)] = step
+    upstream = {}
+    for step in steps:
+        unknown = [name for name in step.after if name not in by_name]
+        if unknown:
+            raise ValueError('Step %s waits for unknown steps: %s' % (step.name, ', '.join(unknown)))
+        deps = set(by_name[name] for name in step.after)
+        deps.update(producers[p] for p in map(os.path.abspath, step.inputs) if p in producers)
+        deps.discard(step)
+        upstream[step] = deps
+    
+    records = load_manifest(manifest) if manifest else {}
+    hashing = ThreadPool(MANIFEST_HASH_THREADS) if manifest else None
+    checksumming = [] # (step, its manifest entry on the way)
+    
+    running = []
+    used = 0
+    try:
+        while True:
+            # running steps that have finished give their threads back
+            for step in running[:]:
+                code = step.poll()
+                if code is None:
+                    continue
+                running.remove(step)
+                used -= min(step.threads, cpu_budget)
+                step.status = 'done' if code == 0 else 'failed'
+                print '%s %s in %.1f s (exit code %s)' % ('Finished' if code == 0 else 'FAILED:', step.name, step.seconds, code)
+                if code != 0:
+                    step.remove_outputs()
+                elif manifest:
+                    records.pop(step.name, None) # whatever an earlier run recorded no longer holds
+                    missing = [out for out in step.outputs if not os.path.isfile(out)]
+                    if missing:
+                        print 'Not adding %s to the run manifest: it did not write %s' % (step.name, ', '.join(missing))
+                    else:
+                        checksumming.append((step, hashing.apply_async(checksum_outputs, (step_record(step, records),))))
+            # record the steps whose outputs have been checksummed
+            for step, record in checksumming[:]:
+                if record.ready():
+                    checksumming.remove((step, record))
+                    try:
+                        records[step.name] = record.get()
+                    except (IOError, OSError) as e: # an output went away before it was checksummed
+                        print 'Not adding %s to the run manifest: %s' % (step.name, e)
+                        continue
+                    write_json(records, manifest)
+            changed = False
+            for step in steps:
+                if step.status != 'waiting':
+                    continue
+                if any(dep.status in ('failed', 'skipped') for dep in upstream[step]):
+                    step.status = 'skipped'
+                    print 'Skipping %s: an earlier step failed' % step.name
+                    changed = True
+                    continue
+                if any(dep.status != 'done' for dep in upstream[step]):
+                    continue
+                missing = [p for p in step.inputs if not os.path.exists(p)]
+                if missing:
+                    step.status = 'failed'
+                    print 'FAILED: %s is missing its inputs: %s' % (step.name, ', '.join(missing))
+                    changed = True
+                    continue
+                if manifest and step_up_to_date(step, records.get(step.name)):
+                    step.status = 'done'
+                    print 'Skipping %s: it is already done' % step.name
+                    changed = True
+                    continue
+                threads = min(step.threads, cpu_budget) # a step wider than the budget runs on its own
+                if used + threads > cpu_budget:
+                    continue
+                print 'Starting %s (%d of %d threads in use)' % (step.name, used + threads, cpu_budget)
+                step.start()
+                used += threads
+                running.append(step)
+            if running or checksumming:
+                time.sleep(POLL_INTERVAL)
+            elif not changed: # nothing left that can start
+                break
+    except BaseException:
+        for step in running:
+            step.terminate()
+        raise
+    finally:
+        if hashing:
+            hashing.terminate()
+    
+    for step in steps:
+        if step.status == 'waiting': # nothing running and still not ready: the steps wait on each other
+            step.status = 'skipped'
+            print 'Skipping %s: it is in (or waits on) a cycle of steps' % step.name
+    failed = [step.name for step in steps if step.status != 'done']
+    if failed:
+        raise RuntimeError('%d of %d pipeline steps failed or were skipped: %s' % (len(failed), len(steps), ', '.join(failed)))
 
 def checkFile(filename):
     '''
@@ -132,22 +357,6 @@ def checkExe(filename):
         raise TypeError("need a string, got a %s" % type(filename))
     return (os.path.exists(filename) and os.path.isfile(filename) and os.access(filename, X_OK))
 
-def qual_median(QUAL, phred_dict):
-    
-    listQUAL = list(QUAL)
-    list_intQUAL =[]
-    for q in listQUAL:
-        list_intQUAL.append(phred_dict[q])
-    #return np.median(list_intQUAL)
-    #pdb.set_trace()
-    list_intQUAL.sort() # this modifies the list in place -- you can't assign it to a new variable. alt, qsort = sorted(list_intQUAL) if we need the original list preserved for some reason
-    qlen = len(list_intQUAL)
-    if qlen % 2 == 0: # even length list -- take the average of the two middle values
-        median_qual = (list_intQUAL[(qlen/2)-1]+list_intQUAL[(qlen/2)])/2
-    else: # odd length list -- take the middle value (list length / 2 will be automatically rounded up by python integer division)
-        median_qual = list_intQUAL[qlen/2]
-    return median_qual
-    
 def find_SampleID(filename, regexSample):
     #sampleID_match = re.match(".*(\d{3}[a-z]?).*", filename)
     # this revision is VERY specific to my technical replicates
@@ -211,8 +420,13 @@ def find_DBRdictionary(library, directory):
     else:
         return None
 
-def qc_loop(in_dir, out_dir, cut_min, cut_max, read=None):
-    files = os.listdir(in_dir)
+def qc_loop(in_dir, out_dir, cut_min, cut_max, read=None, cpu_budget=CPU_BUDGET, manifest=None):
+    run_pipeline(qc_steps(in_dir, out_dir, cut_min, cut_max, read), cpu_budget, manifest)
+
+def qc_steps(in_dir, out_dir, cut_min, cut_max, read=None, files=None):
+    # the steps of qc_loop; files are the names in in_dir to use (by default, all of them)
+    if files is None:
+        files = os.listdir(in_dir)
     
     # search for either read 1 or read 2
     rexTemplate = Template(".*($read).*")
@@ -224,8 +438,9 @@ def qc_loop(in_dir, out_dir, cut_min, cut_max, read=None):
     else:
         correct_reads = files
     
-    cmdTemplate = Template("zcat $f | sed -n '2~4'p | cut -c $cut_min-$cut_max | sort | uniq -c | sort -nr -k 1 > $out")
+    cmdTemplate = Template("$decompress | sed -n '2~4'p | cut -c $cut_min-$cut_max | sort | uniq -c | sort -nr -k 1 > $out")
     
+    steps = []
     for f in correct_reads:
         f_in = os.path.join(in_dir, f)
         if "_" in f: # if the naming convention includes underscores we can split on that (assume also the first element in the resulting list is informative)
@@ -235,21 +450,26 @@ def qc_loop(in_dir, out_dir, cut_min, cut_max, read=None):
         if read:
             f_out = fq_name + '_' + read + '_output.txt'
         else:
-            f_out = fq_name + '_' + read + '_output.txt'
+            f_out = fq_name + '_output.txt'
         out = os.path.join(out_dir, f_out)
-        cmd = cmdTemplate.substitute(f=f_in,
+        cmd = cmdTemplate.substitute(decompress=decompress_command(f_in) if f_in.endswith('gz') else 'cat ' + f_in,
                                      cut_min=cut_min,
                                      cut_max=cut_max,
                                      out=out)
-        processQueue.put(Work(commandline = cmd, shell = True), True, 360)
-    
-    processQueue.join()
+        # the decompressor and the sorts run side by side; with pipefail, a decompressor that fails fails the step
+        cmd = 'bash -o pipefail -c ' + pipes.quote(cmd)
+        steps.append(Step('qc ' + f, commandline = cmd, inputs = [f_in], outputs = [out], threads = 2))
+    return steps
 
-# parallel_FASTQ_quality_filter uses process queues for parallelization
-# should be updated to use worker pools
-def parallel_concatenate(in_dir, regexR1, regexR2, out_dir):
+# parallel_concatenate runs its samples through run_pipeline
+def parallel_concatenate(in_dir, regexR1, regexR2, out_dir, cpu_budget=CPU_BUDGET, manifest=None):
+    run_pipeline(concatenate_steps(in_dir, regexR1, regexR2, out_dir), cpu_budget, manifest)
+
+def concatenate_steps(in_dir, regexR1, regexR2, out_dir, files=None):
+    # the steps of parallel_concatenate; files are the names in in_dir to use (by default, all of them)
     # this function won't work if in_dir has other files (that contain the regexes)
-    files = os.listdir(in_dir)
+    if files is None:
+        files = os.listdir(in_dir)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
     #print(in_dir, files)
@@ -257,33 +477,27 @@ def parallel_concatenate(in_dir, regexR1, regexR2, out_dir):
     read1 = fnmatch.filter(files, '*'+regexR1+'*')
     #read2 = fnmatch.filter(files, '*'+regexR2+'*')
     
-    # assemble parallel processes (calls to function PEAR_assemble)
-    catProcess = [mp.Process(target=concatenate, args=(os.path.join(in_dir, r1),
-                                                            os.path.join(in_dir, re.sub(regexR1, regexR2, r1)),
-                                                            os.path.join(out_dir, r1+'.cat'))) for r1 in read1]
-    for cP in catProcess:
-        cP.start()
-    for cP in catProcess:
-        cP.join()
+    # one step (a call to function concatenate) per pair of reads
+    catSteps = [Step('concatenate ' + r1, function=concatenate, args=(os.path.join(in_dir, r1),
+                                                                      os.path.join(in_dir, re.sub(regexR1, regexR2, r1)),
+                                                                      os.path.join(out_dir, r1+'.cat')),
+                     inputs=[os.path.join(in_dir, r1), os.path.join(in_dir, re.sub(regexR1, regexR2, r1))],
+                     outputs=[os.path.join(out_dir, r1+'.cat')]) for r1 in read1]
+    return catSteps
         
 def concatenate(read1, read2, out_name):
-    fq_line = 0
-    with gzip.open(read1) as f1:
-        with gzip.open(read2) as f2:
+    with open_fastq(read1) as f1:
+        with open_fastq(read2) as f2:
             with open(out_name, 'w') as outf:
                 rmwhite = re.compile(r'\s+')
-                for line in itertools.izip(f1, f2):
-                    if fq_line %2 == 0: # even lines are header and spacer -- no changes necessary
-                        outf.write(line[0])
-                        fq_line += 1
-                    else: # odd lines are sequence & quality; read 2 should be reversed before concatenating
-                        #raise Exception((line[0], read1, read2))
-                        part1 = line[0].strip()
-                        part2 = line[1][::-1].strip()
-                        concat = ''.join([part1, part2])
-                        finalConcat = rmwhite.sub('', concat)
-                        outf.write(finalConcat+'\n')
-                        fq_line += 1
+                for rec1, rec2 in itertools.izip_longest(iter_fastq(f1), iter_fastq(f2)):
+                    if rec1 is None or rec2 is None: # don't leave a silently truncated file
+                        raise IOError('%s and %s have different numbers of reads' % (read1, read2))
+                    # header and spacer come from read 1 -- no changes necessary
+                    # sequence & quality: read 2 should be reversed before concatenating
+                    seq = rmwhite.sub('', rec1[1].strip() + rec2[1][::-1].strip())
+                    qual = rmwhite.sub('', rec1[3].strip() + rec2[3][::-1].strip())
+                    outf.write(rec1[0]+'\n'+seq+'\n'+rec1[2]+'\n'+qual+'\n')
 
 ## not properly working
 # parallel_FASTQ_quality_filter uses process queues for parallelization
@@ -318,10 +532,10 @@ def merge_lanes(laneList, out_dir, out_name):
 	if not os.path.exists(out_dir):
 		os.makedirs(out_dir)
 		
-	mergeLanesTemplate = Template('zcat $f > $out')
+	mergeLanesTemplate = Template('$decompress > $out')
 	formatted_inputs = ' '.join(laneList) # so that the brackets and quotes don't print
 	print 'parsed serial input', formatted_inputs
-	commandLine = mergeLanesTemplate.substitute(f = formatted_inputs, out = out_name)
+	commandLine = mergeLanesTemplate.substitute(decompress = decompress_command(formatted_inputs), out = out_name)
 	print commandLine
 	subprocess.call(commandLine, shell=True)
 
@@ -389,20 +603,89 @@ def PEAR_assemble(R1, R2, out_dir, out_file, pearPath, extra_params=None):
     #pearProcess = Popen(commandLine, shell=True)
     #pearProcess.wait()
 
-# parallel_FASTQ_quality_filter uses process queues for parallelization
-# should be updated to use worker pools
-def parallel_FASTQ_quality_filter(in_dir, out_dir, out_name, q, p, qualityFilter, read='*'):
-    
-    # find all the files in the input directory
-    files = os.listdir(in_dir)
+########################### IN-PROCESS QUALITY FILTER ##########################
+
+# FASTQ_quality_filter(engine = 'python') applies the rule of fastq_quality_filter -q q -p p itself: a read is kept
+# if at least p percent of its bases (in whole percent, rounded down, as fastq_quality_filter counts) have Phred+33
+# quality q or more, and kept reads are written as they were read. The input is decompressed in this process and
+# handed to a pool of workers a batch at a time; each worker counts the good bases of its batch (see
+# count_good_bases) and gzips the reads it keeps, and the batches are written out in their original order. Given
+# first_base or last_base, the kept reads are also trimmed as Trim would, in the same pass.
+QUALITY_FILTER_ENGINES = ('fastx', 'python')
+JOB_WINDOW = 2 # batches in flight per worker, so reading can't run far ahead of the workers
+
+def ordered_jobs(pool, function, jobs, window):
+    '''
+    the results of function on each of jobs, run on pool (or in this process if it is None), in order, with no more
+    than window jobs given to the pool at once
+    '''
+    if pool is None:
+        for job in jobs:
+            yield function(job)
+        return
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def quality_filter_batch(batch, q, p):
+    # the records of a batch (as from fastq_batches) that pass the -q/-p rule; an empty read never does
+    return [record for record, good in itertools.izip(batch, count_good_bases([record[3] for record in batch], q))
+            if record[3] and good*100 // len(record[3]) >= p]
+
+def _quality_filter_job(job):
+    batch, q, p, level, first_base, last_base = job
+    kept = quality_filter_batch(batch, q, p)
+    if first_base != 1 or last_base:
+        kept = trim_batch(kept, first_base, last_base)
+    data = deflate_gzip_member('\n'.join(itertools.chain.from_iterable(kept)) + '\n', level) if kept else ''
+    return len(batch), len(kept), data
+
+def quality_filter_fastq(in_file, out_file, q, p, threads = 1, level = OUT_COMPRESS_LEVEL, first_base = 1, last_base = None):
+    '''
+    write the reads of in_file that pass the -q/-p rule of fastq_quality_filter (trimmed to first_base..last_base) to
+    out_file, gzipped, with threads worker processes; returns the number of reads read and the number kept
+    '''
+    q = int(q)
+    p = int(p)
+    pool = mp.Pool(threads) if threads > 1 else None
+    n_reads = 0
+    n_kept = 0
+    try:
+        with open_fastq(in_file) as handle, BlockWriter(out_file, append = False) as out:
+            jobs = ((batch, q, p, level, int(first_base), int(last_base) if last_base else None) for batch in fastq_batches(handle))
+            for n, kept, data in ordered_jobs(pool, _quality_filter_job, jobs, threads*JOB_WINDOW):
+                n_reads += n
+                n_kept += kept
+                out.write(data)
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+    return n_reads, n_kept
+
+# parallel_FASTQ_quality_filter runs its files through run_pipeline
+def parallel_FASTQ_quality_filter(in_dir, out_dir, out_name, q, p, qualityFilter, read='*', cpu_budget=CPU_BUDGET, manifest=None, engine='fastx', threads=1, first_base=1, last_base=None):
+    run_pipeline(quality_filter_steps(in_dir, out_dir, out_name, q, p, qualityFilter, read, engine, threads, first_base, last_base), cpu_budget, manifest)
+
+def quality_filter_steps(in_dir, out_dir, out_name, q, p, qualityFilter, read='*', engine='fastx', threads=1, first_base=1, last_base=None, files=None):
+    # the steps of parallel_FASTQ_quality_filter; files are the names in in_dir to use (by default, all of them)
+    if files is None:
+        files = os.listdir(in_dir)
     print 'Inputs:', in_dir, files
     print 'Outputs:', out_dir
     # make the output directory
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
         
-    # container for parallel processes
-    filterProcess = []
+    # one pipeline step per file
+    filterSteps = []
     
     # iterate through the input files
     for f in files:
@@ -414,15 +697,18 @@ def parallel_FASTQ_quality_filter(in_dir, out_dir, out_name, q, p, qualityFilter
             # untested: file path for outputs. they went to the wrong place in part3, so I fixed what I thought was the bug in the file path, but just moved the data to the expected directory manually isntead of re-running
             out_file = out_dir + fileRoot + out_name
             in_file = in_dir + f
-            # add the process to the list
-            filterProcess.append(mp.Process(target=FASTQ_quality_filter, args=(in_file, out_file, q, p, qualityFilter)))
-            
-    for fP in filterProcess:
-        fP.start()
-    for fP in filterProcess:
-        fP.join()
+            # add the step to the list; a gzipped input has its decompressor running alongside the filter
+            # (FASTQ_quality_filter adds .gz to the output name if it isn't there)
+            filterSteps.append(Step('quality filter ' + f, function=FASTQ_quality_filter, args=(in_file, out_file, q, p, qualityFilter, engine, threads, first_base, last_base),
+                                    inputs=[in_file], outputs=[out_file if 'gz' in out_file else out_file + '.gz'],
+                                    threads=threads if engine == 'python' else 2 if in_file.endswith('gz') else 1))
+    return filterSteps
 
-def FASTQ_quality_filter(in_file, out_file, q, p, qualityFilter):
+def FASTQ_quality_filter(in_file, out_file, q, p, qualityFilter, engine='fastx', threads=1, first_base=1, last_base=None):
+    if engine not in QUALITY_FILTER_ENGINES:
+        raise ValueError("Quality filter engine specified as %s. Options are 'fastx' or 'python'." % engine)
+    if (first_base != 1 or last_base) and engine != 'python':
+        raise ValueError("Trimming while quality filtering needs engine = 'python'; use Trim after fastq_quality_filter instead.")
     if not checkFile(in_file):
         raise IOError("where is the input file: %s" % in_file)
     if not in_file.endswith("gz"):
@@ -441,30 +727,57 @@ def FASTQ_quality_filter(in_file, out_file, q, p, qualityFilter):
     info('Quality filtering %s' % in_file)
     info('Results saved to %s' % out_file)
     
+    if engine == 'python': # no FASTX Toolkit needed; qualityFilter is ignored
+        n_reads, n_kept = quality_filter_fastq(in_file, out, q, p, threads, first_base = first_base, last_base = last_base)
+        print 'Kept %d of %d reads from %s' % (n_kept, n_reads, in_file)
+        return
+    
     fqfStdinTemplate = Template('%s -q $q -p $p -Q33 -z -o $output' % qualityFilter)
     fqfFileTemplate = Template('%s -q $q -p $p -Q33 -z -i $input -o $output' % qualityFilter)
     
+    # wait for the filter, so the caller (and its CPU budget) knows when it is done, and fail the step if it failed
     if in_file.endswith('gz'): # chain a gz decompressor thread to fqf
         commandLine = fqfStdinTemplate.substitute(q = q, p = p, output = out)
         debug(commandLine)
-        zcatProcess = Popen('zcat %s' % in_file, shell = True, stdout = subprocess.PIPE)
+        zcatCommand = decompress_command(in_file)
+        zcatProcess = Popen(zcatCommand, shell = True, stdout = subprocess.PIPE)
         fqfProcess = Popen(commandLine, shell = True, stdin = zcatProcess.stdout)
+        zcatProcess.stdout.close() # so the decompressor sees a broken pipe if the filter dies
+        wait_pipe((zcatCommand, zcatProcess), (commandLine, fqfProcess))
     else:
         commandLine = fqfFileTemplate.substitute(q = q, p = p, output = out, input = in_file)
         debug(commandLine)
         fqfProcess = Popen(commandLine, shell = True) 
+        wait_pipe((commandLine, fqfProcess))
 
 ## TRIM R2 END OF MERGED SEQUENCE BEFORE DEMULTIPLEXING TO ENFORCE UNIFORM READ LENGTH?
 
+# Trim(engine = 'python') cuts the reads itself as they are read (see trim_batches), writing plain FASTQ, or gzip if
+# out_file ends in .gz, without a fastx_trimmer process. Only the bases are sliced, so the quality encoding doesn't
+# matter. Reads with fewer than first_base bases are dropped.
+TRIM_ENGINES = ('fastx', 'python')
+
+def trim_fastq(in_file, out_file, first_base, last_base = None):
+    '''
+    write the reads of in_file cut down to bases first_base to last_base to out_file; returns the number written
+    '''
+    n_reads = 0
+    with open_fastq(in_file) as handle, BlockWriter(out_file, 'gzip' if out_file.endswith('gz') else None, append = False) as out:
+        for batch in trim_batches(fastq_batches(handle), int(first_base), int(last_base) if last_base else None):
+            if batch:
+                out.write('\n'.join(itertools.chain.from_iterable(batch)) + '\n')
+                n_reads += len(batch)
+    return n_reads
+
 # parallel_Trim uses worker pools for parallelization
-def parallel_Trim(in_dir, out_dir, trimPath, threads, first_base, last_base=None, suffix = '_trimmed.fq', execute=True):
+def parallel_Trim(in_dir, out_dir, trimPath, threads, first_base, last_base=None, suffix = '_trimmed.fq', execute=True, engine='fastx'):
     
     # new directory for trimmed files
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
     
     trimProcess = []
-    uniformLengthTemplate = Template('%s -f $f -l $l -i $input -o $output' % trimPath)    
+    uniformLengthTemplate = Template('%s -Q33 -f $f -l $l -i $input -o $output' % trimPath)    
     pool = mp.Pool(processes=threads)
     for i in os.listdir(in_dir):
         # save file as out_file
@@ -479,29 +792,37 @@ def parallel_Trim(in_dir, out_dir, trimPath, threads, first_base, last_base=None
         						     first_base, 
         						     trimPath, 
         						     last_base, 
-        						     execute))
+        						     execute,
+        						     engine))
         						      
     pool.close()
     pool.join()
 
-def Trim(in_file, out_file, first_base, trimPath, last_base=None, execute=True):    
+def Trim(in_file, out_file, first_base, trimPath, last_base=None, execute=True, engine='fastx'):    
+    
+    if engine not in TRIM_ENGINES:
+        raise ValueError("Trim engine specified as %s. Options are 'fastx' or 'python'." % engine)
+    if engine == 'python': # no FASTX Toolkit needed; trimPath and execute are ignored
+        info('Trimming DBR and enzyme cut sites from %s.' % in_file)
+        print 'Trimmed %d reads from %s to %s' % (trim_fastq(in_file, out_file, first_base, last_base), in_file, out_file)
+        return
     
     info('Trimming DBR and enzyme cut sites from %s with FASTX Toolkit.' % in_file)
     
-    uniformLengthTemplate = Template('%s -f $f -l $l -i $input -o $output' % trimPath)
+    uniformLengthTemplate = Template('%s -Q33 -f $f -l $l -i $input -o $output' % trimPath)
     uniformLengthTemplate_Q33 = Template('%s -Q33 -f $f -i $input -o $output' % trimPath)
 
     # Remove barcodes and R1 enzyme cut site
     if last_base:
         trim_call = uniformLengthTemplate.substitute(f = str(first_base), l = str(last_base), input = in_file, output = out_file)
         print trim_call
-        #trim_call = "fastx_trimmer -f " + str(first_base) + ' -l ' + str(last_base) + " -i " + full_path + " -o " + new_path
+        #trim_call = "fastx_trimmer -Q33 -f " + str(first_base) + ' -l ' + str(last_base) + " -i " + full_path + " -o " + new_path
         if execute:
             subprocess.call(trim_call, shell=True)
         else:
             return trim_call
     else:
-        trim_call = uniformLengthTemplate_Q33.substitute(f = str(first_base), input = in_file, output = out_file) #can't recall why this one needs the Q33 arg and the other doesn't... something about whether or not FASTQ Trimmer recognizes the qual encoding of pear merged vs. raw illumina data?
+        trim_call = uniformLengthTemplate_Q33.substitute(f = str(first_base), input = in_file, output = out_file) # both need -Q33: FASTX Trimmer otherwise reads the Phred+33 qualities of PEAR merged reads as Phred+64 and rejects them
         #trim_call = "fastx_trimmer -Q33 -f " + str(first_base) + " -i " + full_path + " -o " + new_path
         if execute:
             subprocess.call(trim_call, shell=True)
@@ -514,7 +835,13 @@ def iterative_Demultiplex(in_dir, # directory of un-demultiplexed libraries
                           out_dir, # full path for outputs 
                           regexLibrary,
                           demultiplexPath,
-                          out_prefix = 'demultiplexed_'): # text string to add to file names
+                          out_prefix = 'demultiplexed_', # text string to add to file names
+                          cpu_budget = CPU_BUDGET, # threads to share among the demultiplexing steps
+                          manifest = None): # run manifest file (see run_pipeline)
+    run_pipeline(demultiplex_steps(in_dir, barcode_dir, out_dir, regexLibrary, demultiplexPath, out_prefix), cpu_budget, manifest)
+
+def demultiplex_steps(in_dir, barcode_dir, out_dir, regexLibrary, demultiplexPath, out_prefix = 'demultiplexed_', files = None):
+    # the steps of iterative_Demultiplex; files are the names in in_dir to use (by default, all of them)
 
     #if not checkDir(in_dir):
     #    raise IOError("Input is not a directory: %s" % in_dir)
@@ -522,7 +849,8 @@ def iterative_Demultiplex(in_dir, # directory of un-demultiplexed libraries
     #    raise IOError("Where is the barcode file? %s" % barcode_file)
     #pdb.set_trace()
     
-    files = os.listdir(in_dir) 
+    if files is None:
+        files = os.listdir(in_dir)
     
     demultiplexProcess = []
     
@@ -547,12 +875,9 @@ def iterative_Demultiplex(in_dir, # directory of un-demultiplexed libraries
                     in_f = in_dir + '/' + f
                     #Demultiplex(in_f, barcode_file, out_dir, out_name)
                     
-                    demultiplexProcess.append(mp.Process(target=Demultiplex, args=(in_f, barcode_file, out_dir, demultiplexPath, out_prefix)))
-                    
-    for dP in demultiplexProcess:
-        dP.start()
-    for dP in demultiplexProcess:
-        dP.join()
+                    demultiplexProcess.append(Step('demultiplex %s with %s' % (in_f, b), function=Demultiplex, args=(in_f, barcode_file, out_dir, demultiplexPath, out_prefix),
+                                                   inputs=[in_f, barcode_file], threads=2))
+    return demultiplexProcess
                 
 
 def iterative_Demultiplex2(in_dir, # directory of un-demultiplexed libraries
@@ -560,7 +885,15 @@ def iterative_Demultiplex2(in_dir, # directory of un-demultiplexed libraries
                           out_dir, # full path for outputs 
                           regexLibrary,
                           demultiplexPath,
-                          startPoint):
+                          startPoint,
+                          cpu_budget = CPU_BUDGET,
+                          manifest = None):
+    steps = demultiplex2_steps(in_dir, barcode_dir, out_dir, regexLibrary, demultiplexPath, startPoint)
+    if steps is not None:
+        run_pipeline(steps, cpu_budget, manifest)
+
+def demultiplex2_steps(in_dir, barcode_dir, out_dir, regexLibrary, demultiplexPath, startPoint, files = None):
+    # the steps of iterative_Demultiplex2; files are the names in in_dir to use (by default, all of them)
 
     #if not checkDir(in_dir):
     #    raise IOError("Input is not a directory: %s" % in_dir)
@@ -568,12 +901,15 @@ def iterative_Demultiplex2(in_dir, # directory of un-demultiplexed libraries
     #    raise IOError("Where is the barcode file? %s" % barcode_file)
     #pdb.set_trace()
     
+    if files is None:
+        files = os.listdir(in_dir)
+    
     if startPoint == 'barcodes':
         files1 = os.listdir(barcode_dir)
-        files2 = os.listdir(in_dir)
+        files2 = files
         
     elif startPoint == 'libraries':
-        files1 = os.listdir(in_dir)
+        files1 = files
         files2 = os.listdir(barcode_dir)
         
     else:
@@ -604,17 +940,16 @@ def iterative_Demultiplex2(in_dir, # directory of un-demultiplexed libraries
                         barcode_file = os.path.join(barcode_dir, f1)
                         suffix = os.path.splitext(f1)[0]
                         out_prefix = 'demultiplexed_' + ID + '_' + suffix
-                        demultiplexProcess.append(mp.Process(target=Demultiplex, args=(sequence_file, barcode_file, out_dir, demultiplexPath, out_prefix)))
+                        demultiplexProcess.append(Step('demultiplex %s with %s' % (f2, f1), function=Demultiplex, args=(sequence_file, barcode_file, out_dir, demultiplexPath, out_prefix),
+                                                       inputs=[sequence_file, barcode_file], threads=2))
                     elif startPoint == 'libraries':
                         sequence_file = os.path.join(in_dir, f1)
                         barcode_file = os.path.join(barcode_dir, f2)
                         suffix = os.path.splitext(f2)[0]
                         out_prefix = 'demultiplexed_' + ID + '_' + suffix
-                        demultiplexProcess.append(mp.Process(target=Demultiplex, args=(sequence_file, barcode_file, out_dir, demultiplexPath, out_prefix)))
-    for dP in demultiplexProcess:
-        dP.start()
-    for dP in demultiplexProcess:
-        dP.join()
+                        demultiplexProcess.append(Step('demultiplex %s with %s' % (f1, f2), function=Demultiplex, args=(sequence_file, barcode_file, out_dir, demultiplexPath, out_prefix),
+                                                       inputs=[sequence_file, barcode_file], threads=2))
+    return demultiplexProcess
 
 def Demultiplex(in_file, barcode_file, out_dir, demultiplexPath, out_prefix = 'demultiplexed_'): 
 #    if not checkFile(in_file):
@@ -636,12 +971,181 @@ def Demultiplex(in_file, barcode_file, out_dir, demultiplexPath, out_prefix = 'd
     commandLine = demultiplexStdinTemplate.substitute(b = barcode_file, p = prefix_path)
         
     if in_file.endswith('gz'): # chain a gz decompressor thread to fqf
-        zcatProcess = Popen('zcat %s' % in_file, shell = True, stdout = subprocess.PIPE)
-        demultiplexProcess = Popen(commandLine, shell = True, stdin = zcatProcess.stdout)
+        catCommand = decompress_command(in_file)
     else:
-        catProcess = Popen('cat %s' % in_file, shell = True, stdout = subprocess.PIPE)
-        demultiplexProcess = Popen(commandLine, shell = True, stdin = catProcess.stdout)
-    demultiplexProcess.wait()
+        catCommand = 'cat %s' % in_file
+    catProcess = Popen(catCommand, shell = True, stdout = subprocess.PIPE)
+    demultiplexProcess = Popen(commandLine, shell = True, stdin = catProcess.stdout)
+    catProcess.stdout.close() # so cat sees a broken pipe if the splitter dies
+    wait_pipe((catCommand, catProcess), (commandLine, demultiplexProcess))
+
+############################ STREAMING PRE-ALIGNMENT ###########################
+
+# stream_library runs PEAR, the quality filter, the barcode splitter and the trimmer on one library at once, with
+# each stage reading the last one's output from a pipe or FIFO, so the merged, filtered and demultiplexed reads never
+# go to disk: only each sample's trimmed FASTQ file is written (and, if asked for, a gzipped checkpoint of the quality
+# filtered library, which DBR_dict needs). PEAR can't write to stdout, so its merged reads go to a FIFO named like its
+# output file, and the reads it couldn't merge to /dev/null. The splitter opens a file per barcode, so each one is a
+# FIFO read by a trimmer of its own. The trimmed files are renamed into place once every stage has succeeded.
+
+def barcode_names(barcode_file):
+    # the sample names in a FASTX barcode file (name and barcode on each line; '#' starts a comment)
+    names = []
+    with open(barcode_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                names.append(fields[0])
+    return names
+
+def stream_outputs(barcode_file, out_dir, out_prefix, suffix, unmatched_name):
+    # the trimmed file written by stream_library for each of the splitter's outputs, in the order of barcode_names
+    names = barcode_names(barcode_file) + [unmatched_name]
+    return [os.path.join(out_dir, out_prefix + name + suffix) for name in names]
+
+def stream_library(R1, # read 1 of the library
+                   R2, # read 2 of the library
+                   barcode_file, # the barcodes of its samples, for the FASTX barcode splitter
+                   out_dir, # where the trimmed reads of each sample go
+                   pearPath,
+                   qualityFilter, # FASTQ quality filter executable
+                   q, # as FASTQ_quality_filter
+                   p,
+                   demultiplexPath, # FASTX barcode splitter executable
+                   trimPath, # FASTQ trimmer executable
+                   first_base, # as Trim
+                   last_base = None,
+                   out_prefix = 'demultiplexed_', # as Demultiplex
+                   suffix = '_trimmed.fq', # as parallel_Trim
+                   extra_params = None, # more PEAR arguments
+                   checkpoint = None, # optional .fastq.gz file for the quality filtered reads (for DBR_dict)
+                   unmatched_name = 'unmatched'): # the name of the reads that matched no barcode in the output file names
+    '''
+    PEAR, quality filter, demultiplex and trim one library, streaming the reads from each stage to the next
+    '''
+    if not checkFile(R1):
+        raise IOError("Where is the Read 1 file: %s" % R1)
+    if not checkFile(R2):
+        raise IOError("Where is the Read 2 read file: %s" % R2)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    names = barcode_names(barcode_file) + ['unmatched'] # as the splitter names its files
+    outputs = stream_outputs(barcode_file, out_dir, out_prefix, suffix, unmatched_name)
+    finished = outputs + ([checkpoint] if checkpoint else [])
+    
+    info('Streaming %s and %s through PEAR, quality filtering, demultiplexing and trimming into %s' % (R1, R2, out_dir))
+    
+    fifo_dir = tempfile.mkdtemp(prefix = 'stream_')
+    processes = [] # (stage, Popen), started from the last stage back, so each FIFO has its reader waiting
+    try:
+        split_prefix = os.path.join(fifo_dir, 'split_')
+        for name, out in zip(names, outputs):
+            os.mkfifo(split_prefix + name)
+            processes.append(('trim ' + name, Popen(Trim(split_prefix + name, out + '.tmp', first_base, trimPath, last_base, execute=False), shell = True)))
+        
+        splitter = Template('%s --bcfile $b --prefix $p --bol' % demultiplexPath).substitute(b = barcode_file, p = split_prefix)
+        pear_out = os.path.join(fifo_dir, 'pear')
+        os.mkfifo(pear_out + '.assembled.fastq')
+        for leftover in ('.unassembled.forward.fastq', '.unassembled.reverse.fastq', '.discarded.fastq'):
+            os.symlink(os.devnull, pear_out + leftover)
+        qualityFilterProcess = Popen(Template('%s -q $q -p $p -Q33 -i $input' % qualityFilter).substitute(q = q, p = p, input = pear_out + '.assembled.fastq'),
+                                     shell = True, stdout = PIPE)
+        if checkpoint: # a copy of the filtered reads goes through another FIFO to gzip
+            os.mkfifo(os.path.join(fifo_dir, 'checkpoint'))
+            processes.append(('checkpoint', Popen('gzip -c < %s > %s' % (os.path.join(fifo_dir, 'checkpoint'), checkpoint + '.tmp'), shell = True)))
+            teeProcess = Popen('tee %s' % os.path.join(fifo_dir, 'checkpoint'), shell = True, stdin = qualityFilterProcess.stdout, stdout = PIPE)
+            qualityFilterProcess.stdout.close() # so the filter sees a broken pipe if the tee dies
+            processes.append(('tee', teeProcess))
+            upstream = teeProcess
+        else:
+            upstream = qualityFilterProcess
+        processes.append(('demultiplex', Popen(splitter, shell = True, stdin = upstream.stdout)))
+        upstream.stdout.close()
+        processes.append(('quality filter', qualityFilterProcess))
+        
+        pear = Template('%s -f $f -r $r -o $o $e' % pearPath).substitute(f = R1, r = R2, o = pear_out, e = extra_params or '')
+        print pear
+        processes.append(('PEAR', Popen(pear, shell = True)))
+        
+        # wait for every stage; if one fails, the rest are stopped, as they may be blocked on it
+        running = list(processes)
+        while running:
+            for stage, process in running[:]:
+                code = process.poll()
+                if code is None:
+                    continue
+                running.remove((stage, process))
+                if code != 0:
+                    raise RuntimeError('Streaming %s failed: %s exited with code %s' % (R1, stage, code))
+                if stage == 'demultiplex': # a trimmer whose FIFO the splitter never opened would wait forever: end its input
+                    for name in names:
+                        try:
+                            os.close(os.open(split_prefix + name, os.O_WRONLY | os.O_NONBLOCK))
+                        except OSError: # no reader left; that trimmer is done
+                            pass
+            time.sleep(POLL_INTERVAL)
+        for out in finished:
+            os.rename(out + '.tmp', out)
+    except BaseException:
+        for stage, process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        for out in finished:
+            if os.path.exists(out + '.tmp'):
+                os.remove(out + '.tmp')
+        raise
+    finally:
+        shutil.rmtree(fifo_dir)
+
+def parallel_stream_libraries(in_dir, # read 1 and read 2 files of every library
+                              regexR1, # as parallel_PEAR_assemble
+                              regexR2,
+                              regexLibrary, # finds the library in the file names, to match its barcode file
+                              barcode_dir,
+                              out_dir,
+                              pearPath,
+                              qualityFilter,
+                              q,
+                              p,
+                              demultiplexPath,
+                              trimPath,
+                              first_base,
+                              last_base = None,
+                              out_prefix = 'demultiplexed_',
+                              suffix = '_trimmed.fq',
+                              extra_params = None,
+                              checkpoint_dir = None, # keep each library's quality filtered reads here, as <library>_quality_filtered.fastq.gz
+                              cpu_budget = CPU_BUDGET,
+                              manifest = None): # run manifest file (see run_pipeline)
+    run_pipeline(stream_steps(in_dir, regexR1, regexR2, regexLibrary, barcode_dir, out_dir, pearPath, qualityFilter, q, p, demultiplexPath,
+                              trimPath, first_base, last_base, out_prefix, suffix, extra_params, checkpoint_dir), cpu_budget, manifest)
+
+def stream_steps(in_dir, regexR1, regexR2, regexLibrary, barcode_dir, out_dir, pearPath, qualityFilter, q, p, demultiplexPath, trimPath, first_base,
+                 last_base = None, out_prefix = 'demultiplexed_', suffix = '_trimmed.fq', extra_params = None, checkpoint_dir = None, files = None):
+    # the steps of parallel_stream_libraries; files are the names in in_dir to use (by default, all of them)
+    if files is None:
+        files = os.listdir(in_dir)
+    steps = []
+    for r1 in fnmatch.filter(files, '*'+regexR1+'*'):
+        library = find_LibraryID(r1, regexLibrary)
+        barcode_file = find_BarcodeFile(library, barcode_dir)
+        if not barcode_file:
+            print 'No barcode file found for %s; skipping it.' % r1
+            continue
+        R1 = os.path.join(in_dir, r1)
+        R2 = os.path.join(in_dir, re.sub(regexR1, regexR2, r1))
+        checkpoint = os.path.join(checkpoint_dir, library + '_quality_filtered.fastq.gz') if checkpoint_dir else None
+        unmatched_name = library + '_unmatched' # the libraries share out_dir
+        outputs = stream_outputs(barcode_file, out_dir, out_prefix, suffix, unmatched_name)
+        # PEAR, the filter and the splitter are busy at once; the trimmers each take a fraction of a core
+        steps.append(Step('stream ' + library, function=stream_library,
+                          args=(R1, R2, barcode_file, out_dir, pearPath, qualityFilter, q, p, demultiplexPath, trimPath, first_base,
+                                last_base, out_prefix, suffix, extra_params, checkpoint, unmatched_name),
+                          inputs=[R1, R2, barcode_file], outputs=outputs + ([checkpoint] if checkpoint else []), threads=3))
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    return steps
 
 def denovo_Ustacks(in_dir, denovo_path, stacks_executables, out_dir, m, n, num_threads, b, D, unmatchedName, execute=True):    
     print 'Assembling sequences de novo using ustacks\n'
@@ -762,8 +1266,12 @@ def GeneratePseudoref(in_dir, out_file, BWA_path):
     subprocess.call(index_call, shell = True)
     return
 
-# parallel_refmap_BWA uses Joe's worker class for parallelization
-def parallel_refmap_BWA(in_dir, out_dir, BWA_path, pseudoref_full_path, extra_output_identifier=None):
+# parallel_refmap_BWA runs one bwa mem step per sample through run_pipeline
+def parallel_refmap_BWA(in_dir, out_dir, BWA_path, pseudoref_full_path, extra_output_identifier=None, threads=1, cpu_budget=CPU_BUDGET, manifest=None):
+    run_pipeline(refmap_steps(in_dir, out_dir, BWA_path, pseudoref_full_path, extra_output_identifier, threads), cpu_budget, manifest)
+
+def refmap_steps(in_dir, out_dir, BWA_path, pseudoref_full_path, extra_output_identifier=None, threads=1, files=None):
+    # the steps of parallel_refmap_BWA; files are the names in in_dir to use (by default, all of them)
 
     print 'Mapping sequence data to pseudoreference genome using BWA.\n'
     if not os.path.exists(out_dir):
@@ -778,30 +1286,30 @@ def parallel_refmap_BWA(in_dir, out_dir, BWA_path, pseudoref_full_path, extra_ou
     # the regex below also finds unmatched samples    
     rex = re.compile(r'\d+')
     
-    for i in os.listdir(in_dir):
+    steps = []
+    for i in (os.listdir(in_dir) if files is None else files):
         if 'unmatched' not in i: # independently check to remove unmatched files from the files to be refmapped
             if rex.search(i):
                 fname, fext = os.path.splitext(i)
                 in_file = in_dir + i
                 out_file = out_dir + fname + file_ext
-                commandline = refmap_BWA(in_file, fname, out_file, BWA_path, pseudoref_full_path, execute=False)
+                commandline = refmap_BWA(in_file, fname, out_file, BWA_path, pseudoref_full_path, execute=False, threads=threads)
                 #refmapProcess.append(mp.Process(target=refmap_BWA, args=(in_file, fname, out_file, BWA_path, pseudoref_full_path)))
         
-                processQueue.put(Work(commandline = commandline, shell = True), True, 360)
-    
-    processQueue.join()
+                steps.append(Step('refmap ' + fname, commandline = commandline, inputs = [in_file, pseudoref_full_path], outputs = [out_file], threads = threads))
+    return steps
               
-def refmap_BWA(in_file, fname, out_file, BWA_path, pseudoref_full_path, execute=True):    
+def refmap_BWA(in_file, fname, out_file, BWA_path, pseudoref_full_path, execute=True, threads=1):    
     
     #### NEED TO CHECK IF LIBRARIES SPLIT ACROSS LANES (AND IN DIFFERENT FASTQ FILES) HAVE SAMPLES OVERWRITTEN HERE
     #### I SUSPECT THIS IS THE CASE; IF SO FASTQ FILES SHOULD BE CONSOLIDATED BY LIBRARY (JUST CAT THE FILES)
     
-    BWAMemTemplate = Template('%s mem -M -R $rgh $p $input > $out' % BWA_path)
+    BWAMemTemplate = Template('%s mem -t $t -M -R $rgh $p $input > $out' % BWA_path)
     
     print 'Reference mapping ' + fname + '\n'
     
     read_group_header = '"@RG\\tID:' + fname + '\\tPL:Illumina\\tLB:' + fname + '"' 
-    bwa_mem_call = BWAMemTemplate.substitute(rgh = read_group_header, input = in_file, p = pseudoref_full_path, out = out_file)
+    bwa_mem_call = BWAMemTemplate.substitute(t = threads, rgh = read_group_header, input = in_file, p = pseudoref_full_path, out = out_file)
     #bwa_mem_call = BWA_path + ' mem -M -R ' + read_group_header + " " + pseudoref_full_path + ' ' + in_dir + i + ' > ' + out_dir + fname + '.sam'
     
     print bwa_mem_call
@@ -815,11 +1323,15 @@ def refmap_BWA(in_file, fname, out_file, BWA_path, pseudoref_full_path, execute=
     else:
         return bwa_mem_call
 
-def samtools_view_sort_index(sam_in, pseudoref, BCFout, VCFout, samtoolsPath, bcftoolsPath):
+def samtools_view_sort_index(sam_in, pseudoref, BCFout, VCFout, samtoolsPath, bcftoolsPath, threads=None, cpu_budget=CPU_BUDGET, manifest=None):
+    run_pipeline(samtools_steps(sam_in, samtoolsPath, threads or cpu_budget), cpu_budget, manifest)
+
+def samtools_steps(sam_in, samtoolsPath, threads, files=None):
+    # the steps of samtools_view_sort_index; files are the names in sam_in to use (by default, all of them)
     #print sam_in, pseudoref, BCFout, VCFout
     # set up the individual files for transfer from sam to bam and bam indexing
-    
-    threads = multiprocessing.cpu_count()
+    # each sample's view -> sort -> index chain is a set of pipeline steps; with threads (per samtools call) below
+    # cpu_budget, several samples run at once
     
     print 'Processing sam files into sorted bam files.'
     
@@ -827,8 +1339,10 @@ def samtools_view_sort_index(sam_in, pseudoref, BCFout, VCFout, samtoolsPath, bc
     samtoolsSort = Template('%s sort -@ $threads -o $output $input' % samtoolsPath)
     samtoolsIndex = Template('%s index $input' % samtoolsPath)
     
-    for sam in os.listdir(sam_in):
-        # TODO: add if 'sam' in sam (check that we don't already have bam files)
+    steps = []
+    for sam in (os.listdir(sam_in) if files is None else files):
+        if not sam.endswith('.sam'): # skip the bam files from an earlier run
+            continue
         # samtools view -F 4 will filter OUT reads with bitwise flag 0004 -- these are unmapped reads
         fname = os.path.splitext(sam)[0]
         
@@ -838,15 +1352,16 @@ def samtools_view_sort_index(sam_in, pseudoref, BCFout, VCFout, samtoolsPath, bc
         
         view_cmd = samtoolsView.substitute(threads = threads, output = bam, input = samPath)
         print view_cmd
-        subprocess.call(view_cmd, shell=True)
+        steps.append(Step('samtools view ' + fname, commandline = view_cmd, inputs = [samPath], outputs = [bam], threads = threads))
         
         sort_cmd = samtoolsSort.substitute(threads = threads, output = sorted_sam, input = bam)
         print sort_cmd
-        subprocess.call(sort_cmd, shell=True)
+        steps.append(Step('samtools sort ' + fname, commandline = sort_cmd, inputs = [bam], outputs = [sorted_sam], threads = threads))
         
         index_cmd = samtoolsIndex.substitute(input = sorted_sam)
         print index_cmd
-        subprocess.call(index_cmd, shell=True)
+        steps.append(Step('samtools index ' + fname, commandline = index_cmd, inputs = [sorted_sam], outputs = [sorted_sam + '.bai']))
+    return steps
 
 def samtools_mpileup(sam_in, pseudoref, BCFout, VCFout, samtoolsPath, bcftoolsPath):   
     
@@ -0,0 +1,366 @@
+import os
+import sys
+import gzip
+import json
+import random
+import shutil
+import subprocess
+import struct
+import tempfile
+import unittest
+from collections import defaultdict
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import assembled_DBR_filtering as A
+
+def write_sample(sam_dir, dict_dir, sample = 'SampleA', n_reads = 800, n_loci = 15, seed = 1):
+    '''
+    a SAM file of reads piled up on a few loci with a few DBRs each, so plenty of them are PCR duplicates, and its
+    DBR dictionary; returns {Illumina ID: (locus, DBR)} for the primary mapped reads
+    '''
+    rng = random.Random(seed)
+    dbr = {}
+    primary = {}
+    lines = ['@HD\tVN:1.0\tSO:unsorted\n'] + ['@SQ\tSN:locus_%d\tLN:1000\n' % i for i in range(n_loci)]
+    for i in range(n_reads):
+        ID = '8:%d:%d:%d' % (rng.choice([1101, 1102]), 1000 + i, rng.randint(1, 20000))
+        locus = 'locus_%d' % rng.randint(0, n_loci - 1)
+        dbr[ID] = rng.choice(['ACGTACGTAC', 'TTTTGGGGCC', 'ACGTNACGTA', 'GGGGCCCCAA'])
+        flag = rng.choice([0]*6 + [16, 4, 256])
+        if flag == 4:
+            locus = '*'
+        seq = ''.join(rng.choice('ACGT') for j in range(30))
+        qual = ''.join(chr(rng.randint(35, 74)) for j in range(30))
+        if flag in (0, 16):
+            primary[ID] = (locus, dbr[ID])
+        lines.append('\t'.join(['HWI:' + ID, str(flag), locus, '1', '40', '30M', '*', '0', '0', seq, qual, 'NM:i:0']) + '\n')
+    with open(os.path.join(sam_dir, sample + '_1.sam'), 'w') as f:
+        f.writelines(lines)
+    with open(os.path.join(dict_dir, sample + '.json'), 'w') as f:
+        json.dump(dbr, f)
+    return primary
+
+def kept_per_DBR(records, primary):
+    # the number of reads kept for each (locus, DBR)
+    kept = defaultdict(int)
+    for record in records:
+        kept[primary[record[0][1:]]] += 1
+    return dict(kept)
+
+def write_BAM(sam_file, bam_file):
+    # encode a SAM file (with @SQ lines, CIGAR nM and no optional fields past the twelfth column) as BAM
+    header = []
+    records = []
+    with open(sam_file) as f:
+        for line in f:
+            if line.startswith('@'):
+                header.append(line)
+            else:
+                records.append(line.rstrip('\n').split('\t'))
+    RNAMEs = [line.split('\tSN:')[1].split('\t')[0] for line in header if line.startswith('@SQ')]
+    refIDs = dict((RNAME, i) for i, RNAME in enumerate(RNAMEs))
+    text = ''.join(header)
+    data = [A.BAM_MAGIC, struct.pack('<i', len(text)), text, struct.pack('<i', len(RNAMEs))]
+    for RNAME in RNAMEs:
+        data.append(struct.pack('<i', len(RNAME) + 1) + RNAME + '\0' + struct.pack('<i', 1000))
+    for fields in records:
+        QNAME, FLAG, RNAME, POS, MAPQ, CIGAR, SEQ, QUAL = [fields[i] for i in (0, 1, 2, 3, 4, 5, 9, 10)]
+        codes = [A._BAM_BASES.index(base) for base in SEQ] + [0]
+        seq = ''.join(chr(codes[i] << 4 | codes[i + 1]) for i in range(0, len(SEQ), 2))
+        body = (A._BAM_CORE.pack(refIDs.get(RNAME, -1), int(POS) - 1, len(QNAME) + 1, int(MAPQ), 4680, 1, int(FLAG), len(SEQ), -1, -1, 0) +
+                QNAME + '\0' + struct.pack('<I', int(CIGAR[:-1]) << 4) + seq + ''.join(chr(ord(c) - 33) for c in QUAL))
+        data.append(struct.pack('<i', len(body)) + body)
+    with A.BlockWriter(bam_file, 'bgzf', append = False) as out:
+        out.write(''.join(data))
+
+def fastq_records(fastq):
+    with open(fastq) as f:
+        lines = f.read().split('\n')[:-1]
+    return sorted(tuple(lines[i:i+4]) for i in range(0, len(lines), 4))
+
+def log_totals(logfile):
+    with open(logfile) as f:
+        rows = [line.split(',') for line in f]
+    return sum(int(row[1]) for row in rows), sum(int(row[2]) for row in rows)
+
+class FilterTestCase(unittest.TestCase):
+    # one sample's SAM file and DBR dictionary in a temporary directory, filtered into its subdirectories
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for d in ('sam', 'dict', 'whole', 'parts', 'parallel', 'columnar'):
+            os.mkdir(os.path.join(self.tmp, d))
+        self.primary = write_sample(os.path.join(self.tmp, 'sam'), os.path.join(self.tmp, 'dict'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def filter(self, out, **kw):
+        return A.DBR_Filter(os.path.join(self.tmp, 'sam'), 'SampleA_1.sam', os.path.join(self.tmp, out), 1, self.tmp,
+                            os.path.join(self.tmp, 'dict'), '(Sample[A-Z]).*', test_dict = False, **kw)
+
+    def output(self, out):
+        return (fastq_records(os.path.join(self.tmp, out, 'DBR_filtered_sequences_SampleA.fastq')),
+                log_totals(os.path.join(self.tmp, out, 'DBR_filtered_sequences_logfile.csv')))
+
+class LocusPartitionTest(FilterTestCase):
+
+    def test_partitions_cover_every_locus_once(self):
+        RNAMEs = ['locus_%d' % i for i in range(100)] + ['*']
+        for k in (1, 2, 3, 7):
+            parts = [A.locus_partition(RNAME, k) for RNAME in RNAMEs]
+            self.assertTrue(all(0 <= part < k for part in parts))
+            self.assertEqual(parts, [A.locus_partition(RNAME, k) for RNAME in RNAMEs]) # the same every time
+            owned = [A.OwnedLoci((i, k)) for i in range(k)]
+            for RNAME in RNAMEs:
+                self.assertEqual(sum(o[RNAME] for o in owned), 1)
+
+    def test_merged_partitions_match_whole_file(self):
+        self.filter('whole')
+        whole = fastq_records(os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_SampleA.fastq'))
+        removed, primary = log_totals(os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_logfile.csv'))
+        # with n_expected = 1, one read is kept for each DBR at each locus
+        groups = set(self.primary.values())
+        self.assertEqual(len(set(DBR for locus, DBR in groups)), 4)
+        self.assertEqual(kept_per_DBR(whole, self.primary), dict.fromkeys(groups, 1))
+        self.assertEqual((removed, primary), (len(self.primary) - len(groups), len(self.primary)))
+        for k in (2, 3, 5):
+            results = [self.filter('parts', partition = (i, k)) for i in range(k)]
+            self.assertEqual(sum(result[0] for result in results), removed)
+            self.assertEqual(sum(result[1] for result in results), primary)
+            merged = []
+            for i in range(k):
+                merged.extend(fastq_records(os.path.join(self.tmp, 'parts', A.PARTS_DIR, 'SampleA', 'SampleA_1.sam.part%dof%d.fastq' % (i, k))))
+            self.assertEqual(sorted(merged), whole)
+
+    def test_parallel_partitions_match_whole_file(self):
+        self.filter('whole')
+        out = os.path.join(self.tmp, 'parallel')
+        A.parallel_DBR_Filter(os.path.join(self.tmp, 'sam'), out, 1, self.tmp, os.path.join(self.tmp, 'dict'), '(Sample[A-Z]).*', 2,
+                              test_dict = False, partitions = 3)
+        self.assertEqual(fastq_records(os.path.join(out, 'DBR_filtered_sequences_SampleA.fastq')),
+                         fastq_records(os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_SampleA.fastq')))
+        self.assertEqual(log_totals(os.path.join(out, 'DBR_filtered_sequences_logfile.csv')),
+                         log_totals(os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_logfile.csv')))
+
+    def test_removed_file_is_not_assembled(self):
+        sam = os.path.join(self.tmp, 'sam')
+        shutil.copy(os.path.join(sam, 'SampleA_1.sam'), os.path.join(sam, 'SampleA_2.sam'))
+        out = os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_SampleA.fastq')
+        self.filter('whole')
+        one = fastq_records(out)
+        A.DBR_Filter(sam, 'SampleA_2.sam', os.path.join(self.tmp, 'whole'), 1, self.tmp, os.path.join(self.tmp, 'dict'),
+                     '(Sample[A-Z]).*', test_dict = False)
+        self.assertEqual(fastq_records(out), sorted(one * 2))
+        # the rerun skips SampleA_1.sam as done, but rebuilds the sample without the part of the removed file
+        os.remove(os.path.join(sam, 'SampleA_2.sam'))
+        self.filter('whole')
+        self.assertEqual(fastq_records(out), one)
+
+class RerunTest(FilterTestCase):
+    '''
+    what a rerun on the same out_dir filters again, and how each sample's FASTQ file is put together
+    '''
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.assemble_parts = A.assemble_parts
+
+    def tearDown(self):
+        A.assemble_parts = self.assemble_parts
+        FilterTestCase.tearDown(self)
+
+    def test_each_sample_is_assembled_once(self):
+        sam = os.path.join(self.tmp, 'sam')
+        for i in (2, 3):
+            shutil.copy(os.path.join(sam, 'SampleA_1.sam'), os.path.join(sam, 'SampleA_%d.sam' % i))
+        self.filter('whole')
+        one, (removed, primary) = self.output('whole')
+        assembled = []
+        def count_assemble_parts(*args):
+            assembled.append(args[0])
+            return self.assemble_parts(*args)
+        A.assemble_parts = count_assemble_parts
+        A.parallel_DBR_Filter(sam, os.path.join(self.tmp, 'parallel'), 1, self.tmp, os.path.join(self.tmp, 'dict'), '(Sample[A-Z]).*', 2,
+                              test_dict = False)
+        self.assertEqual(len(assembled), 1)
+        self.assertEqual(self.output('parallel'), (sorted(one * 3), (3 * removed, 3 * primary)))
+
+    def test_changed_shard_is_filtered_again(self):
+        dict_dir = os.path.join(self.tmp, 'dict')
+        with open(os.path.join(dict_dir, 'SampleA.json')) as f:
+            dbr = json.load(f)
+        os.remove(os.path.join(dict_dir, 'SampleA.json'))
+        sharded = os.path.join(dict_dir, 'SampleA' + A.SHARD_EXTENSION)
+        A.write_sharded_DBRdictionary(dbr, sharded, 'json', 'hash', 4)
+        os.utime(sharded, (1000000000, 1000000000))
+        self.filter('whole')
+        self.filter('whole') # skipped
+        self.assertEqual(len(open(os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_logfile.csv')).readlines()), 1)
+        # one shard is rewritten in place: the directory itself looks the same
+        manifest = A.read_shard_manifest(sharded)
+        shard_file = os.path.join(sharded, manifest['shards'].values()[0])
+        with open(shard_file) as f:
+            shard = json.load(f)
+        with open(shard_file, 'w') as f:
+            json.dump(dict((ID, 'GGGGCCCCAA') for ID in shard), f)
+        os.utime(sharded, (1000000000, 1000000000))
+        self.filter('whole')
+        self.assertEqual(len(open(os.path.join(self.tmp, 'whole', 'DBR_filtered_sequences_logfile.csv')).readlines()), 2)
+
+class BAMTest(FilterTestCase):
+    '''
+    BAM input gives the same reads, and the same filtered output, as the SAM file it was made from
+    '''
+    def check(self, bam_file):
+        sam_file = os.path.join(self.tmp, 'sam', 'SampleA_1.sam')
+        self.assertTrue(A.is_BAM(bam_file))
+        self.assertFalse(A.is_BAM(sam_file))
+        for flags in ((0, A.SAM_FLAG_EXCLUDE), (0, 0), (A.SAM_REVERSE, 0)):
+            self.assertEqual(list(A.iter_BAM(bam_file, *flags)), list(A.iter_SAM(sam_file, *flags)))
+            for i in range(3):
+                self.assertEqual(list(A.iter_alignments(bam_file, *flags, partition = (i, 3))), list(A.iter_SAM(sam_file, *flags, partition = (i, 3))))
+        self.filter('whole')
+        bam_dir = os.path.dirname(bam_file)
+        A.DBR_Filter(bam_dir, os.path.basename(bam_file), os.path.join(self.tmp, 'parts'), 1, self.tmp, os.path.join(self.tmp, 'dict'),
+                     '(Sample[A-Z]).*', test_dict = False)
+        self.assertEqual(self.output('parts'), self.output('whole'))
+
+    def test_encoded_BAM(self):
+        os.mkdir(os.path.join(self.tmp, 'bam'))
+        bam_file = os.path.join(self.tmp, 'bam', 'SampleA_1.bam')
+        write_BAM(os.path.join(self.tmp, 'sam', 'SampleA_1.sam'), bam_file)
+        self.check(bam_file)
+
+    @unittest.skipIf(not find_executable('samtools'), 'samtools is not installed')
+    def test_samtools_BAM(self):
+        os.mkdir(os.path.join(self.tmp, 'bam'))
+        bam_file = os.path.join(self.tmp, 'bam', 'SampleA_1.bam')
+        subprocess.check_call(['samtools', 'view', '-b', '-o', bam_file, os.path.join(self.tmp, 'sam', 'SampleA_1.sam')])
+        self.check(bam_file)
+
+class AlignmentsOutputTest(FilterTestCase):
+    '''
+    out_format = 'alignments' keeps the records, unchanged and in order, of the reads written to the FASTQ file
+    '''
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.filter('whole')
+        self.kept = self.output('whole')
+        self.sam_file = os.path.join(self.tmp, 'sam', 'SampleA_1.sam')
+
+    def kept_reads(self, alignments):
+        # the kept records read back as FASTQ records
+        return sorted(('@' + QNAME, SEQ, '+', QUAL) for QNAME, RNAME, SEQ, QUAL, n in A.iter_alignments(alignments, 0, 0))
+
+    def test_SAM(self):
+        for out_compress in (None, 'gzip'):
+            out = os.path.join(self.tmp, 'parts', str(out_compress))
+            self.filter(out, out_format = 'alignments', out_compress = out_compress)
+            alignments = os.path.join(out, 'DBR_filtered_SampleA_1.sam' + ('.gz' if out_compress else ''))
+            with (gzip.open(alignments) if out_compress else open(alignments)) as f:
+                lines = f.readlines()
+            with open(self.sam_file) as f:
+                original = f.readlines()
+            header = [line for line in original if line.startswith('@')]
+            self.assertEqual(lines[:len(header)], header)
+            records = lines[len(header):]
+            self.assertEqual(records, [line for line in original if line in set(records)]) # in their original order
+            plain = os.path.join(self.tmp, 'kept.sam')
+            with open(plain, 'w') as f:
+                f.writelines(lines)
+            self.assertEqual(self.kept_reads(plain), self.kept[0])
+            self.assertEqual(log_totals(os.path.join(out, 'DBR_filtered_sequences_logfile.csv')), self.kept[1])
+
+    def test_BAM(self):
+        os.mkdir(os.path.join(self.tmp, 'bam'))
+        write_BAM(self.sam_file, os.path.join(self.tmp, 'bam', 'SampleA_1.bam'))
+        out = os.path.join(self.tmp, 'parts')
+        A.DBR_Filter(os.path.join(self.tmp, 'bam'), 'SampleA_1.bam', out, 1, self.tmp, os.path.join(self.tmp, 'dict'),
+                     '(Sample[A-Z]).*', test_dict = False, out_format = 'alignments')
+        alignments = os.path.join(out, 'DBR_filtered_SampleA_1.bam')
+        self.assertTrue(A.is_BAM(alignments))
+        self.assertEqual(self.kept_reads(alignments), self.kept[0])
+
+    def test_parallel_partitions(self):
+        out = os.path.join(self.tmp, 'parallel')
+        A.parallel_DBR_Filter(os.path.join(self.tmp, 'sam'), out, 1, self.tmp, os.path.join(self.tmp, 'dict'), '(Sample[A-Z]).*', 2,
+                              test_dict = False, partitions = 3, out_format = 'alignments')
+        self.assertEqual(self.kept_reads(os.path.join(out, 'DBR_filtered_SampleA_1.sam')), self.kept[0])
+        self.assertEqual(log_totals(os.path.join(out, 'DBR_filtered_sequences_logfile.csv')), self.kept[1])
+
+class ColumnarTest(FilterTestCase):
+    '''
+    DBR_Filter(columnar = True) keeps and counts the same reads as the dictionary of loci, with or without NumPy
+    '''
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.np = A.np
+
+    def tearDown(self):
+        A.np = self.np
+        FilterTestCase.tearDown(self)
+
+    def check(self):
+        self.filter('whole')
+        for qual_metric in ('median', 'mean', 'expected_errors'):
+            for out in ('whole', 'columnar'):
+                shutil.rmtree(os.path.join(self.tmp, out))
+            self.filter('whole', qual_metric = qual_metric)
+            self.filter('columnar', qual_metric = qual_metric, columnar = True)
+            self.assertEqual(self.output('columnar'), self.output('whole'))
+
+    @unittest.skipIf(A.np is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.check()
+
+    def test_plain(self):
+        A.np = None
+        self.check()
+
+    def test_iteritems(self):
+        # the rows seen one locus at a time, as LocusReads holds them
+        locus_reads = A.LocusReads()
+        columns = A.ColumnarReads()
+        for n, (ID, (locus, DBR)) in enumerate(sorted(self.primary.iteritems())):
+            for reads in (locus_reads, columns):
+                reads.add(locus, DBR, ID, 'IIII', 'ACGT', n)
+        for np in (self.np, None):
+            A.np = np
+            self.assertEqual(sorted((RNAME, sorted((DBR, repr(reads)) for DBR, reads in loci.iteritems())) for RNAME, loci in columns.iteritems()),
+                             sorted((RNAME, sorted((DBR, repr(reads)) for DBR, reads in loci.iteritems())) for RNAME, loci in locus_reads.iteritems()))
+
+class StreamingTest(FilterTestCase):
+    '''
+    DBR_Filter(streaming = True) keeps and counts the same reads as filtering the whole sample at once
+    '''
+    def sort_sample(self):
+        # order the SAM file by coordinate, as samtools sort does: by @SQ line, unmapped reads last
+        sam_file = os.path.join(self.tmp, 'sam', 'SampleA_1.sam')
+        with open(sam_file) as f:
+            lines = f.readlines()
+        header = [line for line in lines if line.startswith('@')]
+        records = [line for line in lines if not line.startswith('@')]
+        order = dict(('locus_%d' % i, i) for i in range(len(header)))
+        records.sort(key = lambda line: order.get(line.split('\t')[2], len(header)))
+        with open(sam_file, 'w') as f:
+            f.writelines(header + records)
+
+    def test_sorted(self):
+        self.sort_sample()
+        self.filter('whole')
+        self.filter('parts', streaming = True)
+        self.assertEqual(self.output('parts'), self.output('whole'))
+        self.assertEqual(kept_per_DBR(self.output('parts')[0], self.primary), kept_per_DBR(self.output('whole')[0], self.primary))
+
+    def test_unsorted(self):
+        self.assertRaises(ValueError, self.filter, 'parts', streaming = True)
+
+class AlignmentFilesTest(unittest.TestCase):
+    def test_one_file_per_sample(self):
+        names = ['SampleA_1.sam', 'SampleA_1.bam', 'SampleA_1.sorted.bam', 'SampleA_1.sorted.bam.bai',
+                 'SampleA_2.sam', 'SampleA_2.bam',
+                 'SampleB_1.sam', 'SampleB_1.sorted.bam.csi', 'SampleB_2.sorted.bam', 'notes.txt']
+        self.assertEqual(A.alignment_files(names), ['SampleA_1.sorted.bam', 'SampleA_2.bam', 'SampleB_1.sam', 'SampleB_2.sorted.bam'])
+
+if __name__ == '__main__':
+    unittest.main()
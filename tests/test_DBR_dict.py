@@ -0,0 +1,229 @@
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import assembled_DBR_filtering as A
+
+def baseline_DBR_dict(in_file, dbr_start, dbr_stop):
+    # the original DBR_dict loop: the sequence line is sliced with its newline still attached
+    dbr = {}
+    fq_line = 1
+    with open(in_file, 'r') as db:
+        for line in db:
+            if fq_line == 1:
+                ID = re.split('(\d[:|_]\d+[:|_]\d+[:|_]\d+)', line)[1]
+                fq_line = 2
+            elif fq_line == 2:
+                seq = list(line)
+                dbr[ID] = ''.join(seq[dbr_start:dbr_stop])
+                fq_line = 3
+            elif fq_line == 3:
+                fq_line = 4
+            elif fq_line == 4:
+                fq_line = 1
+    return dbr
+
+class DBRWindowTest(unittest.TestCase):
+    windows = [(2, 10), # read2
+               (-10, -2), # pear
+               (-9, -1),
+               (0, 8)]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fastq = os.path.join(self.tmp, 'Library1_R2.fastq')
+        bases = 'ACGTTGCANNGATC'
+        with open(self.fastq, 'w') as f:
+            for i in range(200):
+                seq = ''.join(bases[(i*7 + j*(i % 5 + 1)) % len(bases)] for j in range(20 + i % 31))
+                f.write('@HWI-ST1:8:1101:%d:%d 2:N:0:\n%s\n+\n%s\n' % (1000 + i, 2000 + 3*i, seq, 'I'*len(seq)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_pear_window(self):
+        one = os.path.join(self.tmp, 'one.fastq')
+        with open(one, 'w') as f:
+            f.write('@8:1101:15808:1492 1:N:0:\nTTTTACGTACGTACGTA\n+\nIIIIIIIIIIIIIIIII\n')
+        self.assertEqual(baseline_DBR_dict(one, -10, -2), {'8:1101:15808:1492': 'ACGTACGT'})
+        self.assertEqual(A.build_DBR_dicts(one, -10, -2)['forward'], {'8:1101:15808:1492': 'ACGTACGT'})
+
+    def test_matches_baseline(self):
+        for dbr_start, dbr_stop in self.windows:
+            expected = baseline_DBR_dict(self.fastq, dbr_start, dbr_stop)
+            built = A.build_DBR_dicts(self.fastq, dbr_start, dbr_stop, ('forward', 'reverse', 'counts'))
+            self.assertEqual(built['forward'], expected)
+            self.assertEqual(sorted(ID for IDs in built['reverse'].values() for ID in IDs), sorted(expected))
+            self.assertEqual(sum(built['counts'].values()), len(expected))
+            for tag, IDs in built['reverse'].items():
+                self.assertEqual(built['counts'][tag], len(IDs))
+                for ID in IDs:
+                    self.assertEqual(expected[ID], tag)
+
+    def test_saved_dictionaries_match_baseline(self):
+        save = os.path.join(self.tmp, 'dicts')
+        for dbr_start, dbr_stop in self.windows:
+            expected = baseline_DBR_dict(self.fastq, dbr_start, dbr_stop)
+            A.DBR_dict(self.tmp, 'Library1_R2.fastq', dbr_start, dbr_stop, save = save, saveType = 'json')
+            with open(os.path.join(save, 'Library1_R2.json')) as f:
+                self.assertEqual(json.load(f), expected)
+            A.DBR_dict(self.tmp, 'Library1_R2.fastq', dbr_start, dbr_stop, save = save, saveType = 'dbr')
+            with A.open_DBRdictionary(os.path.join(save, 'Library1_R2.dbr')) as dbr:
+                self.assertEqual(dict(dbr.iteritems()), expected)
+            A.sorted_DBR_dict(self.tmp, 'Library1_R2.fastq', dbr_start, dbr_stop, save, run_size = 37)
+            with A.open_DBRdictionary(os.path.join(save, 'Library1_R2.dbr')) as dbr:
+                self.assertEqual(dict(dbr.iteritems()), expected)
+
+class DuplicateIDTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fastq = os.path.join(self.tmp, 'Library1_R2.fastq')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, reads):
+        with open(self.fastq, 'w') as f:
+            for ID, seq in reads:
+                f.write('@%s 2:N:0:\n%s\n+\n%s\n' % (ID, seq, 'I'*len(seq)))
+
+    def reads(self, n):
+        return [('8:1101:%d:%d' % (1000 + i, 2000 + i), 'AA' + 'ACGT'[i % 4]*8 + 'TT') for i in range(n)]
+
+    def test_repeat_under_another_DBR(self):
+        reads = self.reads(3000)
+        reads.append((reads[10][0], 'AA' + 'ACGT'[11 % 4]*8 + 'TT')) # same ID, different DBR
+        self.write(reads)
+        for mode in ('exact', 'bloom'):
+            with self.assertRaises(ValueError) as e:
+                A.build_DBR_dicts(self.fastq, 2, 10, ('reverse',), mode)
+            self.assertEqual(str(e.exception), 'Duplicate Illumina ID 8:1101:1010:2010 found at line 12001')
+            # pieces of a split file are built unchecked and checked when they are merged
+            parts = [A.build_DBR_dicts(self.fastq, 2, 10, ('reverse',), None)]
+            self.assertRaises(ValueError, A.merge_DBR_dicts, parts, mode)
+
+    def test_no_false_duplicates(self):
+        self.write(self.reads(5000))
+        for mode in ('exact', 'bloom'):
+            # a tiny filter with a high error rate makes plenty of false hits, none of which may be reported
+            seen = A.DuplicateIDs(mode, 0.3, capacity = 64)
+            IDs = [ID for ID, seq in self.reads(5000)]
+            for i, ID in enumerate(IDs):
+                if seen.seen(ID):
+                    self.assertEqual(mode, 'bloom')
+                    seen.candidate(ID, i)
+            self.assertEqual(seen.confirm({'': IDs}), None)
+            built = A.build_DBR_dicts(self.fastq, 2, 10, ('reverse',), mode, 0.3)
+            self.assertEqual(sum(len(IDs) for IDs in built['reverse'].values()), 5000)
+
+class FindDBRdictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_skips_temporary_and_other_dictionaries(self):
+        for name in ('Library1_R2.dbr.tmp', 'Library1_R2_counts.json', 'Library1_R2_rev.json', 'Library1_R2.json.tmp123'):
+            open(os.path.join(self.tmp, name), 'w').close()
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), None)
+        open(os.path.join(self.tmp, 'Library1_R2.json'), 'w').close()
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), self.tmp + '/Library1_R2.json')
+        open(os.path.join(self.tmp, 'Library1_R2.dbr'), 'w').close()
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), self.tmp + '/Library1_R2.dbr')
+
+    def test_stale_conversion_is_ignored(self):
+        dict_json = os.path.join(self.tmp, 'Library1_R2.json')
+        dict_dbr = os.path.join(self.tmp, 'Library1_R2.dbr')
+        with open(dict_json, 'w') as f:
+            json.dump({'8:1101:15808:1492': 'ACGTACGT'}, f)
+        self.assertEqual(A.share_DBRdictionaries(['Library1_1.sam'], self.tmp, '(Library\d)'), {dict_json: dict_dbr})
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), dict_dbr)
+        # the JSON is rebuilt: the old copy is passed over until it is converted again
+        with open(dict_json, 'w') as f:
+            json.dump({'8:1101:15808:1492': 'TTTTACGT', '8:1101:15808:1493': 'ACGTACGT'}, f)
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), dict_json)
+        self.assertEqual(A.share_DBRdictionaries(['Library1_1.sam'], self.tmp, '(Library\d)'), {dict_json: dict_dbr})
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), dict_dbr)
+        with A.open_DBRdictionary(dict_dbr) as dbr:
+            self.assertEqual(dbr['8:1101:15808:1492'], 'TTTTACGT')
+        # a dictionary saved over the copy is the user's own
+        A.write_DBRdictionary({'8:1101:15808:1492': 'GGGG'}, dict_dbr)
+        os.utime(dict_json, (0, 0))
+        self.assertEqual(A.find_DBRdictionary('Library1', self.tmp), dict_dbr)
+
+    def test_count_needs_save(self):
+        fastq = os.path.join(self.tmp, 'Library1_R2.fastq')
+        with open(fastq, 'w') as f:
+            f.write('@8:1101:15808:1492 2:N:0:\nACGTACGTACGT\n+\nIIIIIIIIIIII\n')
+        self.assertRaises(ValueError, A.DBR_count, fastq, 2, 10, None, 'json')
+        # counts are keyed by DBR, which the binary format can't hold
+        save = os.path.join(self.tmp, 'counts')
+        self.assertRaises(ValueError, A.DBR_count, fastq, 2, 10, save, 'dbr')
+        self.assertFalse(os.path.exists(save))
+        A.DBR_count(fastq, 2, 10, save, 'json')
+        with open(os.path.join(save, 'Library1_R2.json')) as f:
+            self.assertEqual(json.load(f), {'GTACGTAC': 1})
+
+    def test_default_save_type(self):
+        # DBR_dict writes JSON unless asked for the binary format
+        fastq = os.path.join(self.tmp, 'Library1_R2.fastq')
+        with open(fastq, 'w') as f:
+            f.write('@8:1101:15808:1492 2:N:0:\nACGTACGTACGT\n+\nIIIIIIIIIIII\n')
+        save = os.path.join(self.tmp, 'saved')
+        A.DBR_dict(self.tmp, 'Library1_R2.fastq', 2, 10, save = save)
+        A.parallel_DBR_dict(self.tmp, 'read2', 2, 10, 1, save = save)
+        self.assertEqual(os.listdir(save), ['Library1_R2.json'])
+
+class BuildCacheTest(unittest.TestCase):
+    '''
+    parallel_DBR_dict(cache = True) records each input as it was before the build
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.in_dir = os.path.join(self.tmp, 'reads')
+        self.save = os.path.join(self.tmp, 'dicts')
+        os.mkdir(self.in_dir)
+        self.fastq = os.path.join(self.in_dir, 'Library1_R2.fastq')
+        with open(self.fastq, 'w') as f:
+            for i in range(50):
+                f.write('@HWI-ST1:8:1101:%d:%d 2:N:0:\nACGTACGTACGTACGT\n+\nIIIIIIIIIIIIIIII\n' % (1000 + i, 2000 + i))
+        self.schedule_jobs = A.schedule_jobs
+        self.md5 = A.hashlib.md5
+
+    def tearDown(self):
+        A.schedule_jobs = self.schedule_jobs
+        A.hashlib.md5 = self.md5
+        shutil.rmtree(self.tmp)
+
+    def build(self):
+        A.parallel_DBR_dict(self.in_dir, 'read2', 2, 10, 1, save = self.save, cache = True, hash_inputs = True)
+        return A.load_build_cache(self.save)
+
+    def test_changed_during_build_is_not_cached(self):
+        def touch_while_building(pool, jobs):
+            for name, result in self.schedule_jobs(pool, jobs):
+                os.utime(self.fastq, (0, 12345))
+                yield name, result
+        A.schedule_jobs = touch_while_building
+        self.assertEqual(self.build(), {})
+        A.schedule_jobs = self.schedule_jobs
+        entry = self.build()[self.fastq]
+        self.assertEqual(entry['fingerprint']['mtime'], os.stat(self.fastq).st_mtime)
+
+    def test_inputs_are_hashed_once(self):
+        hashed = []
+        def md5():
+            hashed.append(1)
+            return self.md5()
+        A.hashlib.md5 = md5
+        self.build()
+        self.assertEqual(len(hashed), 1)
+
+if __name__ == '__main__':
+    unittest.main()
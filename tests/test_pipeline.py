@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import integrated_denovo_pipeline as P
+
+class ExitStatusTest(unittest.TestCase):
+    '''
+    function steps that run external tools fail when the tools do
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fastq = os.path.join(self.tmp, 'reads.fastq')
+        with open(self.fastq, 'w') as f:
+            for i in range(10):
+                f.write('@8:1101:%d:1 1:N:0:\nACGTACGTAC\n+\nIIIIIIIIII\n' % i)
+        self.broken_gz = os.path.join(self.tmp, 'broken.fastq.gz')
+        with open(self.broken_gz, 'wb') as f:
+            f.write('\x1f\x8b\x08\x00' + 'not really gzip'*100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def tool(self, name, body):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + body + '\n')
+        os.chmod(path, 0755)
+        return path
+
+    def test_quality_filter(self):
+        # the stand-ins read stdin only if there is no -i
+        failing = self.tool('fqf_fail', 'case "$*" in *-i*) ;; *) cat > /dev/null ;; esac; exit 3')
+        working = self.tool('fqf_ok', 'case "$*" in *-i*) ;; *) cat > /dev/null ;; esac; exit 0')
+        out = os.path.join(self.tmp, 'filtered.fastq.gz')
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            P.FASTQ_quality_filter(self.fastq, out, 20, 90, failing)
+        self.assertEqual(e.exception.returncode, 3)
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            P.FASTQ_quality_filter(self.broken_gz, out, 20, 90, failing)
+        self.assertEqual(e.exception.returncode, 3)
+        # a filter that succeeds on a truncated stream still fails the step when the decompressor failed
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            P.FASTQ_quality_filter(self.broken_gz, out, 20, 90, working)
+        self.assertTrue('broken.fastq.gz' in e.exception.cmd)
+        P.FASTQ_quality_filter(self.fastq, out, 20, 90, working)
+
+    def test_demultiplex(self):
+        barcodes = os.path.join(self.tmp, 'barcodes.txt')
+        with open(barcodes, 'w') as f:
+            f.write('S1\tACGT\n')
+        out_dir = os.path.join(self.tmp, 'split')
+        self.assertRaises(subprocess.CalledProcessError, P.Demultiplex, self.fastq, barcodes, out_dir, self.tool('split_fail', 'cat > /dev/null; exit 2'))
+        self.assertRaises(subprocess.CalledProcessError, P.Demultiplex, self.broken_gz, barcodes, out_dir, self.tool('split_ok', 'cat > /dev/null'))
+        P.Demultiplex(self.fastq, barcodes, out_dir, self.tool('split_ok2', 'cat > /dev/null'))
+
+    def test_concatenate(self):
+        short = os.path.join(self.tmp, 'short.fastq')
+        with open(short, 'w') as f:
+            f.write('@8:1101:0:1 2:N:0:\nACGT\n+\nIIII\n')
+        self.assertRaises(IOError, P.concatenate, self.fastq, short, os.path.join(self.tmp, 'cat.fastq'))
+        P.concatenate(self.fastq, self.fastq, os.path.join(self.tmp, 'cat.fastq'))
+
+    def test_failed_tool_skips_downstream_steps(self):
+        failing = self.tool('fqf_fail', 'echo partial | gzip -c > "$(echo "$@" | sed "s/.*-o //")"; exit 1')
+        filtered = os.path.join(self.tmp, 'filtered.fastq.gz')
+        copied = os.path.join(self.tmp, 'copied.fastq.gz')
+        manifest = os.path.join(self.tmp, 'manifest.json')
+        steps = [P.Step('filter', function = P.FASTQ_quality_filter, args = (self.fastq, filtered, 20, 90, failing), inputs = [self.fastq], outputs = [filtered]),
+                 P.Step('copy', commandline = 'cp %s %s' % (filtered, copied), inputs = [filtered], outputs = [copied])]
+        self.assertRaises(RuntimeError, P.run_pipeline, steps, 1, manifest)
+        self.assertEqual([step.status for step in steps], ['failed', 'skipped'])
+        self.assertFalse(os.path.exists(filtered)) # the partial output is removed, not recorded
+        self.assertFalse(os.path.exists(manifest) and 'filter' in json.load(open(manifest)))
+
+    def test_qc_decompressor_failure(self):
+        in_dir = os.path.join(self.tmp, 'reads')
+        out_dir = os.path.join(self.tmp, 'qc')
+        os.mkdir(in_dir)
+        os.mkdir(out_dir)
+        shutil.copy(self.broken_gz, in_dir)
+        self.assertRaises(RuntimeError, P.qc_loop, in_dir, out_dir, 1, 4)
+        self.assertEqual(os.listdir(out_dir), [])
+        os.remove(os.path.join(in_dir, 'broken.fastq.gz'))
+        shutil.copy(self.fastq, in_dir)
+        P.qc_loop(in_dir, out_dir, 1, 4)
+        with open(os.path.join(out_dir, 'reads_output.txt')) as f:
+            self.assertEqual(f.read().split(), ['10', 'ACGT'])
+
+class StepsTest(unittest.TestCase):
+    '''
+    the steps of several stages run as one DAG
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_concatenate_then_filter(self):
+        in_dir = os.path.join(self.tmp, 'reads')
+        cat_dir = os.path.join(self.tmp, 'cat')
+        filter_dir = os.path.join(self.tmp, 'filtered')
+        os.mkdir(in_dir)
+        for read in ('R1', 'R2'):
+            with open(os.path.join(in_dir, 'Library1_%s.fastq' % read), 'w') as f:
+                for i in range(10):
+                    f.write('@8:1101:%d:1 %s:N:0:\nACGTACGTAC\n+\n%s\n' % (i, read[1], 'I'*10 if i % 2 else '#'*10))
+        steps = P.concatenate_steps(in_dir, 'R1', 'R2', cat_dir)
+        cat_files = [os.path.basename(out) for step in steps for out in step.outputs]
+        self.assertFalse(any(os.path.exists(os.path.join(cat_dir, f)) for f in cat_files))
+        steps += P.quality_filter_steps(cat_dir + '/', filter_dir + '/', '_filtered.fastq.gz', 20, 90, None, '.cat', engine = 'python', files = cat_files)
+        self.assertEqual([step.name for step in steps], ['concatenate Library1_R1.fastq', 'quality filter Library1_R1.fastq.cat'])
+        P.run_pipeline(steps, 2)
+        with P.open_fastq(os.path.join(filter_dir, 'Library1_R1.fastq_filtered.fastq.gz')) as f:
+            self.assertEqual(len(list(P.iter_fastq(f))), 5)
+
+class StreamLibraryTest(unittest.TestCase):
+    '''
+    stream_library runs each tool with the arguments of its stage, and their output reaches the trimmed files
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def tool(self, name, body):
+        # a stand-in that logs its arguments, then finds -f, -r, -i, -o and --prefix among them
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\necho "$*" >> %s.log\n' % path +
+                    'while [ $# -gt 0 ]; do case $1 in -f) f=$2;; -r) r=$2;; -i) i=$2;; -o) o=$2;; --prefix) prefix=$2;; esac; shift; done\n' +
+                    body + '\n')
+        os.chmod(path, 0755)
+        return path
+
+    def args(self, tool):
+        with open(tool + '.log') as f:
+            return [line.split() for line in f]
+
+    def test_command_lines(self):
+        R1 = os.path.join(self.tmp, 'Library1_R1.fastq')
+        R2 = os.path.join(self.tmp, 'Library1_R2.fastq')
+        reads = '@8:1101:1:1 1:N:0:\nACGTACGTAC\n+\n#II@IIIII+\n'
+        for read in (R1, R2):
+            with open(read, 'w') as f:
+                f.write(reads)
+        barcodes = os.path.join(self.tmp, 'barcodes.txt')
+        with open(barcodes, 'w') as f:
+            f.write('S1\tACGT\n')
+        out_dir = os.path.join(self.tmp, 'out')
+        pear = self.tool('pear', 'cat $f > $o.assembled.fastq')
+        fqf = self.tool('fqf', 'cat $i')
+        splitter = self.tool('split', 'cat > ${prefix}S1')
+        trimmer = self.tool('trim', 'cat $i > $o')
+        checkpoint = os.path.join(self.tmp, 'Library1_quality_filtered.fastq.gz')
+        P.stream_library(R1, R2, barcodes, out_dir, pear, fqf, 20, 90, splitter, trimmer, 2, 8, extra_params = '-j 2', checkpoint = checkpoint)
+
+        pear_args = self.args(pear)[0]
+        self.assertEqual(pear_args[:5] + pear_args[6:], ['-f', R1, '-r', R2, '-o', '-j', '2'])
+        fqf_args = self.args(fqf)[0]
+        self.assertEqual(fqf_args[:-1], ['-q', '20', '-p', '90', '-Q33', '-i'])
+        self.assertEqual(fqf_args[-1], pear_args[5] + '.assembled.fastq')
+        split_args = self.args(splitter)[0]
+        self.assertEqual(split_args[:3] + split_args[4:], ['--bcfile', barcodes, '--prefix', '--bol'])
+        self.assertEqual(sorted(args[:5] + [os.path.basename(args[6]), os.path.basename(args[8])] for args in self.args(trimmer)),
+                         [['-Q33', '-f', '2', '-l', '8', 'split_' + name, 'demultiplexed_%s_trimmed.fq.tmp' % name] for name in ('S1', 'unmatched')])
+
+        self.assertEqual(sorted(os.listdir(out_dir)), ['demultiplexed_S1_trimmed.fq', 'demultiplexed_unmatched_trimmed.fq'])
+        with open(os.path.join(out_dir, 'demultiplexed_S1_trimmed.fq')) as f:
+            self.assertEqual(f.read(), reads)
+        with P.open_fastq(checkpoint) as f:
+            self.assertEqual(f.read(), reads)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import assembled_DBR_filtering as A
+import integrated_denovo_pipeline as P
+
+def good_bases(QUAL, q):
+    # fastq_quality_filter, one base at a time
+    return sum(1 for c in QUAL if ord(c) - 33 >= q)
+
+def fastx_keeps(QUAL, q, p):
+    # fastq_quality_filter -q q -p p -Q33: the percentage of good bases, in whole percent, must reach p
+    return len(QUAL) > 0 and good_bases(QUAL, q) * 100 // len(QUAL) >= p
+
+def fastx_trim(record, first_base, last_base = None):
+    # fastx_trimmer -f first_base -l last_base: None if the read is shorter than first_base
+    header, SEQ, plus, QUAL = record
+    if len(SEQ) < first_base:
+        return None
+    end = min(last_base, len(SEQ)) if last_base else len(SEQ)
+    return header, SEQ[first_base - 1:end], plus, QUAL[first_base - 1:end]
+
+def random_batch(rng, n):
+    batch = []
+    for i in range(n):
+        length = rng.choice([0, 1, 2, 7, 30, 100, 151])
+        QUAL = ''.join(chr(rng.randint(33, 74)) for j in range(length))
+        SEQ = ''.join(rng.choice('ACGTN') for j in range(length))
+        batch.append(('@read%d' % i, SEQ, '+', QUAL))
+    return batch
+
+class CountGoodBasesTest(unittest.TestCase):
+    '''
+    the NumPy and plain paths of count_good_bases both count as fastq_quality_filter does
+    '''
+    def setUp(self):
+        self.np = A.np
+        self.batch = random_batch(random.Random(3), 4 * A.NUMPY_MIN_BATCH)
+
+    def tearDown(self):
+        A.np = self.np
+
+    def check(self):
+        QUALs = [record[3] for record in self.batch]
+        for q in (0, 1, 20, 30, 41, 42, 60):
+            expected = [good_bases(QUAL, q) for QUAL in QUALs]
+            self.assertEqual(A.count_good_bases(QUALs, q), expected) # one batch
+            self.assertEqual(A.count_good_bases(QUALs[:3], q), expected[:3]) # too few reads for NumPy
+            self.assertEqual(A.count_good_bases(['', ''] + QUALs + [''], q), [0, 0] + expected + [0])
+            for p in (0, 1, 50, 90, 100):
+                self.assertEqual(P.quality_filter_batch(self.batch, q, p),
+                                 [record for record in self.batch if fastx_keeps(record[3], q, p)])
+
+    @unittest.skipIf(A.np is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.check()
+        self.assertEqual(A.count_good_bases([''] * A.NUMPY_MIN_BATCH, 20), [0] * A.NUMPY_MIN_BATCH)
+
+    def test_plain(self):
+        A.np = None
+        self.check()
+
+    def test_empty_reads_are_dropped(self):
+        batch = [('@a', '', '+', ''), ('@b', 'A', '+', 'I'), ('@c', '', '+', '')]
+        for p in (0, 100):
+            self.assertEqual(P.quality_filter_batch(batch, 20, p), [batch[1]])
+
+class TrimTest(unittest.TestCase):
+    '''
+    trim_batch cuts reads as fastx_trimmer does, and filtering and trimming in one pass match running them in turn
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.batch = random_batch(random.Random(5), 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def expected(self, batch, first_base, last_base):
+        return [r for r in (fastx_trim(record, first_base, last_base) for record in batch) if r is not None]
+
+    def test_trim_batch(self):
+        for first_base, last_base in ((1, None), (2, None), (7, None), (8, None), (1, 30), (6, 30), (30, 30), (31, 200)):
+            self.assertEqual(A.trim_batch(self.batch, first_base, last_base), self.expected(self.batch, first_base, last_base))
+            self.assertEqual(list(A.trim_batches([self.batch[:50], [], self.batch[50:]], first_base, last_base)),
+                             [self.expected(self.batch[:50], first_base, last_base), [], self.expected(self.batch[50:], first_base, last_base)])
+
+    def test_filter_then_trim(self):
+        in_file = os.path.join(self.tmp, 'reads.fastq')
+        with open(in_file, 'w') as f:
+            f.writelines('\n'.join(record) + '\n' for record in self.batch)
+        for first_base, last_base in ((1, None), (8, None), (6, 30)):
+            fused = os.path.join(self.tmp, 'fused.fastq.gz')
+            filtered = os.path.join(self.tmp, 'filtered.fastq.gz')
+            trimmed = os.path.join(self.tmp, 'trimmed.fastq')
+            n_reads, n_kept = P.quality_filter_fastq(in_file, fused, 20, 50, first_base = first_base, last_base = last_base)
+            self.assertEqual(n_reads, len(self.batch))
+            P.quality_filter_fastq(in_file, filtered, 20, 50)
+            P.trim_fastq(filtered, trimmed, first_base, last_base)
+            with gzip.open(fused) as f:
+                fused_reads = f.read()
+            with open(trimmed) as f:
+                self.assertEqual(fused_reads, f.read())
+            kept = self.expected([record for record in self.batch if fastx_keeps(record[3], 20, 50)], first_base, last_base)
+            self.assertEqual(n_kept, len(kept)) # reads trimmed away aren't written, so they aren't counted as kept
+            self.assertEqual(fused_reads, ''.join('\n'.join(record) + '\n' for record in kept))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import assembled_DBR_filtering as A
+
+def read_in(reader, size):
+    # everything from reader, size bytes at a time
+    parts = []
+    for part in iter(lambda: reader.read(size), ''):
+        parts.append(part)
+    return ''.join(parts)
+
+class BrokenFile(object):
+    # a file that fails part of the way through
+    name = 'broken'
+
+    def __init__(self):
+        self.reads = 0
+
+    def read(self, size):
+        self.reads += 1
+        if self.reads > 2:
+            raise IOError('disk went away')
+        return 'x' * size
+
+    def close(self):
+        pass
+
+class ReaderTest(unittest.TestCase):
+    '''
+    the decompressing readers give back exactly what was written, and fail loudly when their source does
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        rng = random.Random(7)
+        # compressible but not trivially so, and several batches of 64 kB BGZF blocks long
+        words = [''.join(rng.choice('ACGT') for i in range(rng.randint(1, 30))) for j in range(500)]
+        self.data = '\n'.join(rng.choice(words) for i in range(300000)) + '\n'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_BGZF(self):
+        bgzf = os.path.join(self.tmp, 'data.gz')
+        with A.BlockWriter(bgzf, 'bgzf', append = False) as out:
+            for i in range(0, len(self.data), 1000003): # uneven writes, so blocks don't line up with them
+                out.write(self.data[i:i + 1000003])
+        return bgzf
+
+    def test_BGZF_round_trip(self):
+        bgzf = self.write_BGZF()
+        self.assertTrue(A.is_BGZF(bgzf))
+        with open(bgzf, 'rb') as f:
+            self.assertTrue(f.read().endswith(A.BGZF_EOF))
+        with gzip.open(bgzf, 'rb') as f: # a valid gzip file too
+            self.assertEqual(f.read(), self.data)
+        for threads in (1, 4):
+            with A.BGZFReader(bgzf, threads) as reader:
+                self.assertEqual(reader.read(), self.data)
+            with A.BGZFReader(bgzf, threads) as reader:
+                self.assertEqual(read_in(reader, 70001), self.data)
+        with A.open_compressed(bgzf) as reader:
+            self.assertTrue(isinstance(reader, A.BGZFReader))
+            self.assertEqual(reader.read(), self.data)
+
+    def test_BGZF_unread(self):
+        with A.BGZFReader(self.write_BGZF()) as reader:
+            start = reader.read(10)
+            reader.unread(start)
+            self.assertEqual(reader.read(), self.data)
+
+    def test_BGZF_damaged_block(self):
+        bgzf = self.write_BGZF()
+        with open(bgzf, 'r+b') as f:
+            f.seek(18 + 100) # inside the deflate data of the first block
+            f.write('\xff' * 50)
+        with A.BGZFReader(bgzf) as reader:
+            self.assertRaises(Exception, reader.read)
+
+    def test_gzip(self):
+        gz = os.path.join(self.tmp, 'plain.gz')
+        with gzip.open(gz, 'wb') as f:
+            f.write(self.data)
+        self.assertFalse(A.is_BGZF(gz))
+        with A.open_compressed(gz) as reader:
+            self.assertEqual(read_in(reader, 65536), self.data)
+        with A.ThreadedReader(gzip.open(gz, 'rb'), depth = 2) as reader:
+            self.assertEqual(read_in(reader, 12345), self.data)
+
+    def test_pipe_reader(self):
+        with A.PipeReader('printf abc', 'abc') as reader:
+            self.assertEqual(reader.read(), 'abc')
+        # a decompressor that fails, before or after writing anything
+        for command in ('exit 3', 'printf abc; exit 2'):
+            with A.PipeReader(command, 'broken') as reader:
+                self.assertRaises(IOError, reader.read)
+        # one that is still writing when the caller stops reading is stopped
+        reader = A.PipeReader('yes 2>/dev/null', 'endless')
+        self.assertEqual(reader.read(4), 'y\ny\n')
+        reader.close()
+
+    def test_threaded_reader(self):
+        with A.ThreadedReader(StringIO(self.data), depth = 2) as reader:
+            self.assertEqual(reader.read(), self.data)
+        with A.ThreadedReader(BrokenFile()) as reader:
+            self.assertRaises(IOError, reader.read)
+        # closed before the end, with the queue full
+        reader = A.ThreadedReader(StringIO(self.data), depth = 1)
+        self.assertEqual(reader.read(3), self.data[:3])
+        reader.close()
+
+def random_fastq(rng, n):
+    # records whose quality lines often start with '@' or '+', as real Phred+33 qualities can
+    records = []
+    for i in range(n):
+        length = rng.choice([1, 2, 5, 50, 151])
+        SEQ = ''.join(rng.choice('ACGTN') for j in range(length))
+        QUAL = rng.choice('@+I#') + ''.join(chr(rng.randint(33, 74)) for j in range(length - 1))
+        records.append(('@read%d %d:N:0:%s' % (i, rng.randint(1, 2), 'ACGT'[:rng.randint(0, 4)]), SEQ, rng.choice(['+', '+read%d' % i]), QUAL))
+    return records
+
+class SplitFastqTest(unittest.TestCase):
+    '''
+    the FastqRanges from split_fastq, read with fastq_range_batches, give back every record of the file exactly once and in order
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        rng = random.Random(11)
+        self.small = random_fastq(rng, 40)
+        self.large = random_fastq(rng, 12000) # several dozen BGZF blocks
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, records, compress = None):
+        fastq = os.path.join(self.tmp, name)
+        with A.BlockWriter(fastq, compress, append = False) as out:
+            out.write(''.join('\n'.join(record) + '\n' for record in records))
+        return fastq
+
+    def check(self, fastq, records, chunk_bytes, chunk_size = A.FASTQ_CHUNK_SIZE):
+        with A.open_fastq(fastq) as handle:
+            self.assertEqual(list(A.iter_fastq(handle)), records)
+        ranges = A.split_fastq(fastq, chunk_bytes)
+        rebuilt = []
+        for fastq_range in ranges:
+            for batch in A.fastq_range_batches(fastq, fastq_range, chunk_size):
+                rebuilt.extend(batch)
+        self.assertEqual(rebuilt, records, 'chunk_bytes %d, chunk_size %d' % (chunk_bytes, chunk_size))
+        return ranges
+
+    def test_plain(self):
+        small = self.write('small.fastq', self.small)
+        for chunk_bytes in (1, 2, 3, 5, 7, 64, 1000, 10 * 1024**2):
+            self.check(small, self.small, chunk_bytes)
+        self.check(small, self.small, 7, chunk_size = 1)
+        large = self.write('large.fastq', self.large)
+        for chunk_bytes in (999, 4096, 65536, 10**6, 10 * 1024**2):
+            self.check(large, self.large, chunk_bytes)
+        self.check(large, self.large, 65536, chunk_size = 100)
+
+    def test_BGZF(self):
+        large = self.write('large.fastq.gz', self.large, 'bgzf')
+        for chunk_bytes in (1, 1000, 65536, 10**6, 10 * 1024**2):
+            ranges = self.check(large, self.large, chunk_bytes)
+            if chunk_bytes == 1:
+                self.assertTrue(len(ranges) > 10)
+        self.check(large, self.large, 1, chunk_size = 100)
+        small = self.write('small.fastq.gz', self.small, 'bgzf')
+        self.check(small, self.small, 1)
+
+    def test_gzip(self):
+        # ordinary gzip can't be split, so it comes back as one range
+        gz = self.write('large.fastq.gz', self.large, 'gzip')
+        self.assertEqual(len(self.check(gz, self.large, 1000)), 1)
+
+class WriterTest(unittest.TestCase):
+    '''
+    what FastqWriter writes, plain or compressed, in one go or appended, reads back as the records written
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.records = [record for record in random_fastq(random.Random(13), 3000) if record[2] == '+']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, out_file, records, compress, append):
+        # a small buffer, so the records go out in many writes (gzip members or runs of BGZF blocks)
+        with A.FastqWriter(out_file, compress, buffer_size = 5000, append = append) as out:
+            for header, SEQ, plus, QUAL in records:
+                out.write_read(header[1:], SEQ, QUAL)
+
+    def read(self, out_file):
+        with A.open_fastq(out_file) as handle:
+            return list(A.iter_fastq(handle))
+
+    def test_round_trip(self):
+        for compress in A.OUT_COMPRESSION:
+            out_file = os.path.join(self.tmp, 'out.fastq' + ('.gz' if compress else ''))
+            self.write(out_file, self.records, compress, False)
+            self.assertEqual(self.read(out_file), self.records, compress)
+            self.assertEqual(os.listdir(self.tmp), [os.path.basename(out_file)]) # the temporary file was put in place
+            if compress:
+                self.assertEqual(A.is_BGZF(out_file), compress == 'bgzf')
+                with gzip.open(out_file, 'rb') as f:
+                    self.assertEqual(f.read(), ''.join('\n'.join(record) + '\n' for record in self.records))
+            os.remove(out_file)
+
+    def test_append(self):
+        # as a sample's parts are joined: each writer adds whole gzip members or BGZF blocks (and an EOF block) to the file
+        for compress in A.OUT_COMPRESSION:
+            out_file = os.path.join(self.tmp, 'out.fastq' + ('.gz' if compress else ''))
+            self.write(out_file, self.records[:1000], compress, True)
+            self.write(out_file, self.records[1000:], compress, True)
+            self.assertEqual(self.read(out_file), self.records, compress)
+            os.remove(out_file)
+
+    def test_error_discards_output(self):
+        out_file = os.path.join(self.tmp, 'out.fastq.gz')
+        try:
+            with A.FastqWriter(out_file, 'bgzf', append = False) as out:
+                out.write_read('read1', 'ACGT', 'IIII')
+                raise KeyError('read2')
+        except KeyError:
+            pass
+        self.assertEqual(os.listdir(self.tmp), [])
+        self.assertRaises(ValueError, A.FastqWriter, out_file, 'zip')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import assembled_DBR_filtering as A
+
+class ExternalSortTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_line_endings(self):
+        lines = ['d\n', 'b\r\n', 'c\n', 'a', 'e\n', 'f']
+        for run_size in (1, 2, 4, 100):
+            self.assertEqual(list(A.external_sort(iter(lines), self.tmp, run_size)), ['a\n', 'b\n', 'c\n', 'd\n', 'e\n', 'f\n'])
+
+class SortedDBRDictTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fastq = os.path.join(self.tmp, 'Library1_R2.fastq')
+        reads = []
+        for i in range(500):
+            # every ID is repeated with another DBR a little later, and the later DBRs sort both before and after
+            ID = '8:1101:%d:%d' % (1000 + i % 300, 2000)
+            reads.append((ID, 'AA' + 'GTCA'[(i*3 + i//300) % 4]*6 + 'ACGT'[i % 4]*2 + 'TTTT'))
+        with open(self.fastq, 'w') as f:
+            for ID, seq in reads:
+                f.write('@%s 2:N:0:\n%s\n+\n%s\n' % (ID, seq, 'I'*len(seq)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_repeated_IDs_keep_the_last_DBR(self):
+        expected = A.build_DBR_dicts(self.fastq, 2, 10)['forward']
+        save = os.path.join(self.tmp, 'dicts')
+        for run_size in (7, 100000):
+            A.sorted_DBR_dict(self.tmp, 'Library1_R2.fastq', 2, 10, save, run_size = run_size)
+            with A.open_DBRdictionary(os.path.join(save, 'Library1_R2.dbr')) as dbr:
+                self.assertEqual(dict(dbr.iteritems()), expected)
+            A.DBR_dict(self.tmp, 'Library1_R2.fastq', 2, 10, save = os.path.join(self.tmp, 'dict_engine'), saveType = 'dbr')
+            with open(os.path.join(save, 'Library1_R2.dbr'), 'rb') as f, open(os.path.join(self.tmp, 'dict_engine', 'Library1_R2.dbr'), 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+class SortMergeSAMTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.sam = os.path.join(self.tmp, 'SampleA.sam')
+        self.dbr = {}
+        lines = ['@HD\tVN:1.0\tSO:unsorted\n']
+        for i in range(200):
+            ID = '8:1101:%d:%d' % (5000 - 7*i, 100 + i % 13)
+            if i % 3:
+                self.dbr[ID] = 'ACGT'[i % 4]*8
+            seq = 'ACGTACGTAC'
+            lines.append('HWI:%s\t%d\tlocus%d\t1\t40\t10M\t*\t0\t0\t%s\t%s\n' % (ID, 16 if i % 5 == 0 else 0, i % 9, seq, 'IIIIIHHHHH'))
+        lines[-1] = lines[-1].rstrip('\n') # no newline at the end of the file
+        with open(self.sam, 'w') as f:
+            f.writelines(lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_same_reads_as_dict_lookup(self):
+        expected = sorted(A.dict_SAM(self.sam, self.dbr), key = lambda read: read[-1])
+        self.assertEqual(len(expected), 200)
+        self.assertEqual(expected[-1][3], 'IIIIIHHHHH')
+        for run_size in (11, 1000):
+            merged = A.sort_merge_SAM(self.sam, A._sorted_DBR_items(self.dbr), self.tmp, run_size)
+            self.assertEqual(sorted(merged, key = lambda read: read[-1]), expected)
+
+if __name__ == '__main__':
+    unittest.main()